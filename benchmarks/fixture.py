@@ -0,0 +1,109 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Synthetic camera stream for benchmarks: H.264 video (Annex B, SPS/PPS repeated on every keyframe like
+RTMP ingest stores it) and ADTS AAC audio, encoded with PyAV and loaded into a stream store.
+"""
+
+import fractions
+import io
+import time
+import av
+import numpy
+
+def video_packets(seconds=30, fps=25, width=1280, height=720, gop=50, bframes=0):
+    """
+    Encoded video of a moving gradient with noise (so P frames aren't empty)
+
+    Returns
+    -------
+    List of H.264 packets (bytes) in decoding order
+    """
+    encoder = av.CodecContext.create("libx264", "w")
+    encoder.width = width
+    encoder.height = height
+    encoder.pix_fmt = "yuv420p"
+    encoder.time_base = fractions.Fraction(1, fps)
+    encoder.framerate = fps
+    encoder.options = {"g": str(gop), "keyint_min": str(gop), "bf": str(bframes), "sc_threshold": "0", "preset": "veryfast", "x264-params": "repeat-headers=1"}
+
+    rng = numpy.random.default_rng(0)
+    gradient = numpy.add.outer(numpy.arange(height), numpy.arange(width)).astype(numpy.uint16)
+    packets = []
+    for i in range(seconds * fps):
+        luma = ((gradient + i * 4) % 256).astype(numpy.uint8)
+        luma[rng.integers(0, height, 500), rng.integers(0, width, 500)] = 255
+        planes = numpy.concatenate([luma, numpy.full((height // 2, width), 128, numpy.uint8)])
+        frame = av.VideoFrame.from_ndarray(planes, format="yuv420p")
+        frame.pts = i
+        packets.extend(bytes(packet) for packet in encoder.encode(frame))
+    packets.extend(bytes(packet) for packet in encoder.encode(None))
+    return packets
+
+def audio_packets(seconds=30, sample_rate=44100, channels=2, frequency=440):
+    """
+    Encoded sine tone, every packet an ADTS frame of 1024 samples
+
+    Returns
+    -------
+    List of (offset in ms, ADTS frame bytes)
+    """
+    buffer = io.BytesIO()
+    container = av.open(buffer, "w", format="adts")
+    stream = container.add_stream("aac", rate=sample_rate)
+    stream.layout = "stereo" if channels == 2 else "mono"
+    samples = numpy.arange(seconds * sample_rate) / sample_rate
+    tone = (0.5 * numpy.sin(2 * numpy.pi * frequency * samples)).astype(numpy.float32)
+    for pos in range(0, len(tone) - 1024, 1024):
+        frame = av.AudioFrame.from_ndarray(numpy.stack([tone[pos:pos + 1024]] * channels), format="fltp", layout=stream.layout)
+        frame.sample_rate = sample_rate
+        frame.pts = pos
+        for packet in stream.encode(frame):
+            container.mux(packet)
+    for packet in stream.encode(None):
+        container.mux(packet)
+    container.close()
+
+    data = buffer.getvalue()
+    frames = []
+    pos = 0
+    while pos + 7 <= len(data):
+        # ADTS frame length: 13 bits starting at bit 30 of the header
+        length = ((data[pos + 3] & 0x03) << 11) | (data[pos + 4] << 3) | (data[pos + 5] >> 5)
+        frames.append((int(len(frames) * 1024 * 1000 / sample_rate), data[pos:pos + length]))
+        pos += length
+    return frames
+
+def load(store, video, audio=None, fps=25, end_timestamp=None, video_stream="input_rtmp_stream", audio_stream="input_rtmp_audio_stream"):
+    """
+    Adds packets to the store with stream IDs ending at end_timestamp (in ms, default now)
+
+    Returns
+    -------
+    (timestamp of the first video entry, timestamp of the last video entry)
+    """
+    if end_timestamp is None:
+        end_timestamp = int(time.time() * 1000)
+    start_timestamp = end_timestamp - int((len(video) - 1) * 1000 / fps)
+    for i, payload in enumerate(video):
+        store.xadd(video_stream, {"frame": payload}, id=str(start_timestamp + int(i * 1000 / fps)) + "-0")
+    last_ms = None
+    for offset, payload in audio or []:
+        ms = start_timestamp + offset
+        # two frames within the same ms get consecutive sequence numbers
+        seq = 0 if ms != last_ms else seq + 1
+        store.xadd(audio_stream, {"frame": payload}, id=str(ms) + "-" + str(seq))
+        last_ms = ms
+    return start_timestamp, start_timestamp + int((len(video) - 1) * 1000 / fps)
@@ -0,0 +1,74 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Packets per second of building av.Packet objects from stream entries (no decoding).
+
+Compares the previous dictionary/BytesIO based chunker with Chunker.packets:
+
+    python -m benchmarks.packet_chunker --entries 3000 --payload 20000
+"""
+
+import argparse
+import io
+import os
+import time
+import av
+from chrysalis.chunker import Chunker
+
+def legacy_packet_chunker(buffer):
+    packet_results = {}
+    buffer_array = []
+    buffer_array_ts = []
+    for x in buffer:
+        timestamp_x = x[0].decode("utf-8")
+        content = {}
+        for key, value in x[1].items():
+            content[key.decode("utf-8")] = value
+        buffer_array.append(content["frame"])
+        buffer_array_ts.append(int(timestamp_x.split("-")[0]))
+    for idx, fr in enumerate(buffer_array):
+        frame_buf = io.BytesIO(fr)
+        packet = av.Packet(frame_buf.getbuffer().nbytes)
+        frame_buf.readinto(packet)
+        packet_results[buffer_array_ts[idx]] = packet
+    return packet_results
+
+def synthetic_entries(entries, payload):
+    start = int(time.time() * 1000)
+    return [(str(start + i * 33).encode() + b"-0", {b"frame": os.urandom(payload)}) for i in range(entries)]
+
+def packets_per_second(fn, buffer, repeat):
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn(buffer)
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return len(buffer) / best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=3000)
+    parser.add_argument("--payload", type=int, default=20000, help="bytes per packet")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    buffer = synthetic_entries(args.entries, args.payload)
+    chunker = Chunker(av.Codec('h264', 'r').create())
+    before = packets_per_second(legacy_packet_chunker, buffer, args.repeat)
+    after = packets_per_second(lambda b: list(chunker.packets(b)), buffer, args.repeat)
+    print("entries: %d, payload: %d bytes" % (args.entries, args.payload))
+    print("before: %10.0f packets/s" % before)
+    print("after:  %10.0f packets/s (%.2fx)" % (after, after / before))
@@ -0,0 +1,240 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Throughput, latency and memory of the SDK hot paths on a synthetic stream, no server needed.
+
+A synthetic H.264/AAC stream is encoded once and spooled into a FileStore. Every benchmark then runs
+in a fresh process (so peak RSS is its own) reading the spool, or a MemoryStore copy of it:
+
+    python -m benchmarks.suite --seconds 30 --width 1280 --height 720
+    python -m benchmarks.suite --only past_image screenshot --json results.json
+    python -m benchmarks.suite --pix-fmt planes
+
+Reported per benchmark: frames (or calls) per second, p50 and p99 latency of a frame (or call) and peak RSS.
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import chrysalis
+from chrysalis.chunker import Chunker
+from chrysalis.decoder import create_decoder
+from benchmarks.fixture import video_packets, audio_packets, load
+
+VIDEO_STREAM = "input_rtmp_stream"
+AUDIO_STREAM = "input_rtmp_audio_stream"
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def timed(iterable):
+    """
+    Yields items of iterable with the seconds it took to produce each one
+    """
+    started = time.perf_counter()
+    for item in iterable:
+        now = time.perf_counter()
+        yield item, now - started
+        started = time.perf_counter()
+
+def with_data(images):
+    """
+    Yields images with their data accessed (it's converted lazily), as a consumer using every frame would
+    """
+    for img in images:
+        if img is not None:
+            img.data
+        yield img
+
+def open_store(spool_dir, store_kind):
+    store = chrysalis.FileStore(spool_dir)
+    if store_kind == "memory":
+        memory = chrysalis.MemoryStore()
+        chrysalis.copy_stream(store, memory, VIDEO_STREAM)
+        chrysalis.copy_stream(store, memory, AUDIO_STREAM)
+        store = memory
+    return store
+
+def bench_chunker_packets(store, fixture, args):
+    entries = store.xrange(VIDEO_STREAM)
+    chunker = Chunker(create_decoder())
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        latencies.extend(latency for _, latency in timed(chunker.packets(entries)))
+    return len(entries) * args.repeat, time.perf_counter() - started, latencies
+
+def bench_chunker_frames(store, fixture, args):
+    entries = store.xrange(VIDEO_STREAM)
+    chunker = Chunker(create_decoder(thread_type=args.thread_type, thread_count=args.thread_count))
+    started = time.perf_counter()
+    latencies = [latency for _, latency in timed(chunker.frames(entries, flush=True))]
+    return len(latencies), time.perf_counter() - started, latencies
+
+def bench_latest_image(store, fixture, args):
+    """
+    Live: frames are appended in real time, latency is from the append until VideoLatestImage returns the frame
+    """
+    ch = chrysalis.Connect(store=store, rtmp_video_stream="live", pix_fmt=args.pix_fmt, thread_type=args.thread_type, thread_count=args.thread_count)
+    payloads = [fields[b"frame"] for _, fields in store.xrange(VIDEO_STREAM)]
+    appended = {}
+    stopped = threading.Event()
+
+    def camera():
+        for payload in payloads[:args.live_seconds * fixture["fps"]]:
+            if stopped.is_set():
+                return
+            appended[store.xadd("live", {"frame": payload})] = time.perf_counter()
+            time.sleep(1 / fixture["fps"])
+        stopped.set()
+
+    writer = threading.Thread(target=camera, daemon=True)
+    writer.start()
+    latencies = []
+    started = time.perf_counter()
+    while not stopped.is_set():
+        img = ch.VideoLatestImage()
+        if img is not None:
+            img.data
+            latencies.append(time.perf_counter() - appended[img.entry_id.encode("utf-8")])
+    writer.join()
+    ch.Close()
+    return len(latencies), time.perf_counter() - started, latencies
+
+def bench_past_image(store, fixture, args):
+    ch = chrysalis.Connect(store=store, buffer_size=args.buffer_size, pix_fmt=args.pix_fmt, thread_type=args.thread_type, thread_count=args.thread_count)
+    latencies = []
+    started = time.perf_counter()
+    for img, latency in timed(with_data(iter(lambda: ch.VideoPastImage(fixture["start"], fixture["end"]), None))):
+        latencies.append(latency)
+    ch.Close()
+    return len(latencies), time.perf_counter() - started, latencies
+
+def bench_past_images(store, fixture, args):
+    ch = chrysalis.Connect(store=store, pix_fmt=args.pix_fmt, thread_type=args.thread_type, thread_count=args.thread_count)
+    started = time.perf_counter()
+    latencies = [latency for _, latency in timed(with_data(ch.VideoPastImages(fixture["start"], fixture["end"])))]
+    ch.Close()
+    return len(latencies), time.perf_counter() - started, latencies
+
+def bench_screenshot(store, fixture, args):
+    ch = chrysalis.Connect(store=store, pix_fmt=args.pix_fmt, thread_type=args.thread_type, thread_count=args.thread_count)
+    rng = random.Random(0)
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(args.calls):
+        ts = rng.randint(fixture["start"], fixture["end"])
+        t = time.perf_counter()
+        list(with_data([ch.Screenshot(dt=datetime.fromtimestamp(ts / 1000), within_seconds=4)]))
+        latencies.append(time.perf_counter() - t)
+    ch.Close()
+    return args.calls, time.perf_counter() - started, latencies
+
+def bench_probe(store, fixture, args):
+    ch = chrysalis.Connect(store=store)
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(args.calls):
+        t = time.perf_counter()
+        ch.Probe(max_age=0)
+        latencies.append(time.perf_counter() - t)
+    ch.Close()
+    return args.calls, time.perf_counter() - started, latencies
+
+BENCHMARKS = {
+    "chunker_packets": bench_chunker_packets,
+    "chunker_frames": bench_chunker_frames,
+    "latest_image": bench_latest_image,
+    "past_image": bench_past_image,
+    "past_images": bench_past_images,
+    "screenshot": bench_screenshot,
+    "probe": bench_probe,
+}
+
+def run(name, spool_dir, fixture, args):
+    """
+    Runs one benchmark, meant to be called in a fresh process
+
+    Returns
+    -------
+    Dictionary of results
+    """
+    # history playback hands its process the redis connection, it needs fork (spawned benchmark processes default to spawn)
+    mp.set_start_method("fork", force=True)
+    store = open_store(spool_dir, args.store)
+    count, elapsed, latencies = BENCHMARKS[name](store, fixture, args)
+    return {
+        "benchmark": name,
+        "count": count,
+        "per_second": count / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        # kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=int, default=30, help="length of the synthetic stream")
+    parser.add_argument("--fps", type=int, default=25)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--gop", type=int, default=50)
+    parser.add_argument("--bframes", type=int, default=0)
+    parser.add_argument("--store", choices=("memory", "file"), default="memory")
+    parser.add_argument("--pix-fmt", choices=chrysalis.chunker.PIX_FMTS, default="bgr24", help="pixel format of returned images")
+    parser.add_argument("--thread-type", default="SLICE")
+    parser.add_argument("--thread-count", type=int, default=0)
+    parser.add_argument("--buffer-size", type=int, default=10)
+    parser.add_argument("--live-seconds", type=int, default=5, help="length of the live benchmark")
+    parser.add_argument("--calls", type=int, default=50, help="calls of screenshot and probe benchmarks")
+    parser.add_argument("--repeat", type=int, default=5, help="passes of the packet benchmark")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--json", help="also write results into this file")
+    args = parser.parse_args()
+
+    spool_dir = tempfile.mkdtemp(prefix="chrysalis-bench-")
+    try:
+        started = time.perf_counter()
+        video = video_packets(args.seconds, args.fps, args.width, args.height, gop=args.gop, bframes=args.bframes)
+        audio = audio_packets(args.seconds)
+        start, end = load(chrysalis.FileStore(spool_dir), video, audio, fps=args.fps, video_stream=VIDEO_STREAM, audio_stream=AUDIO_STREAM)
+        fixture = {"start": start, "end": end, "fps": args.fps}
+        print("fixture: %d s of %dx%d@%d, %d video and %d audio packets, encoded in %.1f s" % (args.seconds, args.width, args.height, args.fps, len(video), len(audio), time.perf_counter() - started))
+        print("%-16s %8s %12s %10s %10s %10s" % ("benchmark", "count", "per second", "p50 ms", "p99 ms", "peak RSS MB"))
+
+        results = []
+        context = mp.get_context("spawn")
+        for name in args.only:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(run, name, spool_dir, fixture, args).result()
+            results.append(result)
+            print("%-16s %8d %12.1f %10.3f %10.3f %10.1f" % (name, result["count"], result["per_second"], result["p50_ms"], result["p99_ms"], result["peak_rss_mb"]))
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"args": vars(args), "results": results}, f, indent=2)
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
@@ -14,4 +14,9 @@
 # limitations under the License.
 
 from chrysalis.chrysalis import Connect
+from chrysalis.frame_cache import FrameCache
+from chrysalis.metrics import Metrics
+from chrysalis.sampling import Sampling
+from chrysalis.history_session import HistorySession
+from chrysalis.store import MemoryStore, FileStore, copy_stream
 from chrysalis.ch_errors import VideoFailedToStart, VideoHistoryNotFound, InfrequentException
\ No newline at end of file
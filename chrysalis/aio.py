@@ -0,0 +1,334 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import redis
+from .log import logger
+from .chunker import Chunker, ChImage, PIX_FMTS
+from .live_video_image import LiveVideoImage
+from .multi_video_image import MultiLiveVideoImage
+from .decoder import create_decoder, THREAD_TYPES
+from .probe import Probe, ProbeInfo
+from .h264 import reorders
+from .screenshot import search_range, decode_keyframe, closest_iframe
+from .keyframe_index import KeyframeIndex, KeyframeLookup
+from .ch_errors import InfrequentException
+from .seek import keyframe_query, previous_id, next_id, drop_disposable_before, leading_bidirectional, entry_timestamp, MAX_TAIL
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    # redis-py < 4.2
+    aioredis = None
+
+class Connect:
+    """
+    asyncio counterpart of chrysalis.Connect
+
+    Redis queries are awaited on a pooled async redis client while PyAV decoding runs in a thread pool,
+    so a single event loop can serve many streams.
+
+    Attributes:
+    host (string): Server host (e.g. 127.0.0.1, http://mystream.chrysvideo.com)
+    port (int): Port of the streaming media server cache
+    max_connections (int): Maximum number of pooled redis connections (default unlimited)
+    executor (concurrent.futures.Executor): Executor to decode in (default a new ThreadPoolExecutor)
+    rtmp_video_stream (string): Name of the video stream in the streaming media server cache (default input_rtmp_stream)
+    rtmp_audio_stream (string): Name of the audio stream in the streaming media server cache (default input_rtmp_audio_stream)
+    pix_fmt (string): Pixel format of returned images: bgr24, rgb24, gray, yuv420p or planes (views of the decoded planes, no conversion, see ChImage.planes) (default bgr24)
+    size (tuple): (width, height) returned images are scaled to while converting, None keeps the stream resolution (default None)
+    thread_type (string): Video decoder threading: NONE, SLICE, FRAME or AUTO (default SLICE)
+    thread_count (int): Number of threads per video decoder, 0 uses one per CPU (default 0)
+    """
+
+    def __init__(self, host, port, password=None, ssl_ca_cert=None, max_connections=None, executor=None, rtmp_video_stream="input_rtmp_stream", rtmp_audio_stream="input_rtmp_audio_stream", pix_fmt="bgr24", size=None, thread_type="SLICE", thread_count=0):
+        if aioredis is None:
+            raise ImportError("chrysalis.aio requires redis-py >= 4.2 (redis.asyncio)")
+        if pix_fmt not in PIX_FMTS:
+            raise ValueError("unsupported pixel format " + str(pix_fmt) + ", expected one of " + ", ".join(PIX_FMTS))
+        if thread_type not in THREAD_TYPES:
+            raise ValueError("unsupported thread type " + str(thread_type) + ", expected one of " + ", ".join(THREAD_TYPES))
+        self.password = password
+        self.pix_fmt = pix_fmt
+        self.size = size
+        self.__decoder_options = {"thread_type": thread_type, "thread_count": thread_count}
+        self.rtmp_video_stream = rtmp_video_stream
+        self.rtmp_audio_stream = rtmp_audio_stream
+        if ssl_ca_cert is not None:
+            pool = aioredis.ConnectionPool(host=host, port=port, password=password, max_connections=max_connections, connection_class=aioredis.SSLConnection, ssl_cert_reqs="required", ssl_ca_certs=ssl_ca_cert)
+        else:
+            pool = aioredis.ConnectionPool(host=host, port=port, password=password, max_connections=max_connections)
+        self.redis_conn = aioredis.StrictRedis(connection_pool=pool)
+
+        self.__own_executor = executor is None
+        self.__executor = executor if executor is not None else ThreadPoolExecutor(thread_name_prefix="chrysalis-decode")
+        # redis connection is only used through the async client, LiveVideoImage keeps the cursor and decoder
+        self.__playvideo = LiveVideoImage(redis_conn=None, stream_name=self.rtmp_video_stream, codec=create_decoder(**self.__decoder_options), pix_fmt=pix_fmt, size=size)
+        self.__playvideo_lock = asyncio.Lock()
+        self.__multivideo = {}
+        self.__probe = Probe(self.redis_conn, self.rtmp_video_stream)
+        # maintained through the async client, see KeyframeIndex.queue_update
+        self.__keyframe_index = KeyframeIndex(redis_conn=None, stream_name=self.rtmp_video_stream)
+        self.__playpastvideo = PastVideoImage(redis_conn=self.redis_conn, stream_name=self.rtmp_video_stream, executor=self.__executor, pix_fmt=pix_fmt, size=size, **self.__decoder_options)
+        logger.debug("Chrysalis async SDK init with host " + host + ":" + str(port))
+
+    async def __aenter__(self):
+        try:
+            test_time = await self.redis_conn.time() # test connection right away
+            logger.info("redis current time: " + str(test_time[0]))
+        except redis.ConnectionError as ex:
+            logger.error("failed to connect to remote streaming instance: " + str(ex), stack_info=True)
+            await self.Close()
+            raise ConnectionError()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.Close()
+
+    async def Close(self):
+        """
+        Closes pooled redis connections and the decoding thread pool (if created by Connect)
+        """
+        if hasattr(self.redis_conn, "aclose"):
+            await self.redis_conn.aclose()
+        else:
+            await self.redis_conn.close()
+        await self.redis_conn.connection_pool.disconnect()
+        if self.__own_executor:
+            self.__executor.shutdown(wait=False)
+
+    async def VideoLatestImage(self):
+        """
+        Latest frame from the video stream.
+
+        Returns:
+        ChImage object
+        """
+        async with self.__playvideo_lock:
+            redis_time = await self.redis_conn.time()
+            last_query = self.__playvideo.next_query(redis_time)
+            buffer = await self.redis_conn.xread({self.rtmp_video_stream:last_query}, block=1000)
+            if len(buffer) == 0:
+                return None
+            return await self.__decode(self.__playvideo.latest_image, buffer)
+
+    async def VideoLatestImages(self):
+        """
+        Async iterator over the latest frames of the video stream (skipping None)
+        """
+        while True:
+            img = await self.VideoLatestImage()
+            if img is not None:
+                yield img
+
+    async def VideoLatestImageMulti(self, stream_names):
+        """
+        Latest frame from each of the given video streams read with a single XREAD
+
+        Returns
+        -------
+        Dictionary of key = stream name, value = ChImage or None if stream has no new frame
+        """
+        key = tuple(stream_names)
+        if key not in self.__multivideo:
+            self.__multivideo[key] = (MultiLiveVideoImage(redis_conn=None, stream_names=stream_names, pix_fmt=self.pix_fmt, size=self.size, **self.__decoder_options), asyncio.Lock())
+        multivideo, lock = self.__multivideo[key]
+        async with lock:
+            redis_time = await self.redis_conn.time()
+            buffer = await self.redis_conn.xread(multivideo.next_queries(redis_time), block=1000)
+            return await self.__decode(multivideo.latest_images, buffer)
+
+    async def VideoPastImage(self, fromTsMs, toTsMs):
+        """
+        Frame from the video buffer between two timestamps (in milliseconds).
+
+        Returns:
+        ChImage object or None when toTsMs reached
+        """
+        return await self.__playpastvideo.get_latest_image_from(fromtimestamp=fromTsMs, totimestamp=toTsMs)
+
+    async def VideoPastImages(self, fromTsMs, toTsMs):
+        """
+        Async iterator over all frames from the video buffer between two timestamps (in milliseconds)
+        """
+        while True:
+            img = await self.VideoPastImage(fromTsMs, toTsMs)
+            if img is None:
+                return
+            yield img
+
+    def VideoPastImageStopNow(self):
+        """
+        Stopping VideoPastImage before it reached it's natural end
+        """
+        self.__playpastvideo.stop_now()
+
+    async def Probe(self, max_age:float=None) -> ProbeInfo:
+        """
+        Probe the video stream, see chrysalis.Connect.Probe
+
+        Returns:
+        ProbeInfo object
+        """
+        cached = self.__probe.cached(max_age)
+        if cached is not None:
+            return cached
+        pipe = self.redis_conn.pipeline(transaction=False)
+        self.__probe.queue(pipe)
+        stream_info, recent = await pipe.execute(raise_on_error=False)
+        return self.__probe.info_from(stream_info, recent)
+
+    async def Screenshot(self, dt:datetime=None, within_seconds:int=10) -> ChImage:
+        """
+        I frame closest to dt, see chrysalis.Connect.Screenshot
+
+        Returns
+        -------
+        ChImage or None if not found
+        """
+        if dt is None:
+            dt = datetime.now()
+        timestamp = int(dt.timestamp() * 1000)
+        ranges = [search_range(timestamp, within_seconds, int(time.time() * 1000))]
+
+        pipe = self.redis_conn.pipeline(transaction=False)
+        pending = self.__keyframe_index.queue_update(pipe, ranges)
+        while pending is not None:
+            pending = self.__keyframe_index.update_from(pending, await pipe.execute(), pipe)
+        if len(self.__keyframe_index) == 0:
+            # no keyframes recognized from packet headers, search for I frames by decoding
+            buffer = await self.redis_conn.xrange(name=self.rtmp_video_stream, min=ranges[0][0], max=ranges[0][1])
+            return await self.__decode(lambda b: self.__closest_image(b, timestamp), buffer)
+
+        lookup = KeyframeLookup(self.__keyframe_index, self.rtmp_video_stream, [timestamp], ranges)
+        while lookup.queue(pipe):
+            for keyframe, buffer in lookup.fetched(await pipe.execute()):
+                # decoder per keyframe, concurrent screenshots must not share decoder state
+                img = await self.__decode(lambda b: decode_keyframe(b, keyframe[0], pix_fmt=self.pix_fmt, size=self.size, codec=create_decoder(**self.__decoder_options)), buffer)
+                lookup.resolve(keyframe, img)
+        return lookup.results[0]
+
+    def __closest_image(self, buffer, timestamp):
+        chunker = Chunker(create_decoder(**self.__decoder_options), pix_fmt=self.pix_fmt, size=self.size)
+        found = closest_iframe(chunker.frames(buffer, flush=True), timestamp)
+        if found is None:
+            return None
+        entry_id, frame = found
+        return chunker.image(entry_timestamp(entry_id), frame, entry_id=entry_id)
+
+    async def __decode(self, fn, buffer):
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, lambda b: converted(fn(b)), buffer)
+
+def converted(result):
+    """
+    Converts image data of a decoding result (ChImage, list or dictionary of them) right away, so it's
+    done in the executor instead of the event loop
+    """
+    images = result.values() if isinstance(result, dict) else result if isinstance(result, list) else [result]
+    for img in images:
+        if img is not None:
+            img.materialize()
+    return result
+
+
+class PastVideoImage:
+    """
+    Async history playback, reads the video buffer forward from fromtimestamp in batches of 10 entries
+    and decodes them in the executor
+    """
+
+    def __init__(self, redis_conn, stream_name, executor, pix_fmt="bgr24", size=None, thread_type="SLICE", thread_count=0):
+        self.__redis_conn = redis_conn
+        self.__decoder_options = {"thread_type": thread_type, "thread_count": thread_count}
+        self.__pix_fmt = pix_fmt
+        self.__size = size
+        self.__stream_name = stream_name
+        self.__executor = executor
+        self.__lock = asyncio.Lock()
+        self.__history_chunker = None
+        self.__history_queue = collections.deque()
+        self.__history_cleanup()
+
+    async def get_latest_image_from(self, fromtimestamp, totimestamp) -> ChImage:
+        async with self.__lock:
+            redis_time = await self.__redis_conn.time()
+            redis_time = int(redis_time[0] + (redis_time[1] / 1000000)) * 1000
+
+            if self.__last_history_request_time == 0:
+                self.__last_history_request_time = redis_time
+
+            if self.__last_history_query_timestamp == 0:
+                self.__last_history_query_timestamp = fromtimestamp
+                self.__history_chunker = Chunker(codec=create_decoder(**self.__decoder_options), pix_fmt=self.__pix_fmt, size=self.__size)
+                # start decoding from the closest keyframe so the first frame returned is the one at fromtimestamp
+                self.__last_history_query = await self.__keyframe_before(fromtimestamp)
+                if self.__last_history_query is None:
+                    self.__last_history_query = str(fromtimestamp)
+            elif abs(self.__last_history_request_time - redis_time) > 10*1000:
+                # check if more than 10 seconds between 2 queries, throw exception
+                self.__history_cleanup()
+                raise InfrequentException
+            self.__last_history_request_time = redis_time
+
+            while len(self.__history_queue) == 0 and self.__last_history_query_timestamp < totimestamp:
+                buffer = await self.__redis_conn.xread({self.__stream_name:self.__last_history_query}, block=1000, count=10)
+                if len(buffer) == 0:
+                    continue
+                inner_buffer = buffer[0][1]
+                self.__last_history_query = inner_buffer[-1][0]
+                self.__last_history_query_timestamp = int(self.__last_history_query.decode('utf-8').split("-")[0])
+                if entry_timestamp(inner_buffer[0][0]) < fromtimestamp:
+                    inner_buffer = drop_disposable_before(inner_buffer, fromtimestamp)
+                # frames the decoder holds back are drained with the last batch
+                flush = self.__last_history_query_timestamp >= totimestamp
+                if flush and (self.__history_chunker.codec.has_b_frames or reorders([entry[1].get(b"frame") for entry in inner_buffer])):
+                    # see chrysalis.seek.reorder_tail
+                    tail = await self.__redis_conn.xrange(self.__stream_name, min=next_id(self.__last_history_query), max="+", count=MAX_TAIL)
+                    inner_buffer = inner_buffer + leading_bidirectional(tail)
+                images = await asyncio.get_running_loop().run_in_executor(self.__executor, lambda: converted(list(self.__history_chunker.images(inner_buffer, fromtimestamp, flush=flush))))
+                self.__history_queue.extend(img for img in images if img.timestamp <= totimestamp)
+
+            if len(self.__history_queue) > 0:
+                return self.__history_queue.popleft()
+            self.__history_cleanup()
+            return None
+
+    async def __keyframe_before(self, timestamp, within_seconds=10, count=60):
+        # see chrysalis.seek.keyframe_before
+        max_id = str(timestamp)
+        min_id = str(timestamp - within_seconds * 1000)
+        while True:
+            entries = await self.__redis_conn.xrevrange(self.__stream_name, max=max_id, min=min_id, count=count)
+            if len(entries) == 0:
+                return None
+            query = keyframe_query(entries)
+            if query is not None:
+                return query
+            max_id = previous_id(entries[-1][0])
+
+    def stop_now(self):
+        self.__history_queue.clear()
+        self.__last_history_query_timestamp = sys.maxsize
+
+    def __history_cleanup(self):
+        self.__last_history_query_timestamp = 0
+        self.__last_history_query = None
+        self.__last_history_request_time = 0
+        self.__history_chunker = None
+        self.__history_queue.clear()
@@ -0,0 +1,142 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import av
+import numpy
+from .log import logger
+from .models import ChAudio
+from .seek import entry_timestamp
+
+# sample formats audio can be returned in, numpy dtype and packed libswresample format
+SAMPLE_FORMATS = {"float32": (numpy.float32, "flt"), "int16": (numpy.int16, "s16")}
+LAYOUTS = {1: "mono", 2: "stereo"}
+# larger distance between entry timestamps and samples decoded so far is filled with silence
+MAX_GAP_MS = 100
+
+class AudioChunker:
+    """
+    Decodes AAC entries of the audio stream into fixed windows of samples.
+
+    Decoded frames are resampled by libswresample straight into the requested rate, channel layout and
+    sample format, and copied into a preallocated window array. Windows start at window_start and follow
+    each other without gaps, window timestamps are on the stream clock (entry IDs) shared with video.
+    Gaps in the stream are filled with silence.
+
+    Attributes
+    ----------
+    codec : av.CodecContext
+        AAC decoder (default new decoder, ADTS framed packets), raw AAC needs extradata set on the decoder
+    sample_rate : int
+        output samples per second (default 16000)
+    channels : int
+        output channels, 1 or 2 (default 1)
+    sample_format : string
+        float32 or int16 (default float32)
+    window_ms : int
+        length of a chunk in ms (default 1000)
+    window_start : int
+        timestamp (in ms) of the first chunk, earlier samples are dropped. None starts at the first
+        multiple of window_ms after the first entry
+    """
+
+    def __init__(self, codec=None, sample_rate=16000, channels=1, sample_format="float32", window_ms=1000, window_start=None):
+        if sample_format not in SAMPLE_FORMATS:
+            raise ValueError("unsupported sample format " + str(sample_format) + ", expected one of " + ", ".join(SAMPLE_FORMATS))
+        if channels not in LAYOUTS:
+            raise ValueError("unsupported number of channels " + str(channels))
+        self.codec = codec if codec is not None else av.Codec('aac', 'r').create()
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_format = sample_format
+        self.window_ms = window_ms
+        self.window_start = window_start
+
+        dtype, av_format = SAMPLE_FORMATS[sample_format]
+        self.__dtype = dtype
+        self.__resampler = av.AudioResampler(format=av_format, layout=LAYOUTS[channels], rate=sample_rate)
+        self.__window_samples = int(sample_rate * window_ms / 1000)
+        self.__window = numpy.zeros((self.__window_samples, channels), dtype=dtype)
+        self.__filled = 0
+        # stream time of the next decoded sample in ms
+        self.__next_sample_ms = None
+
+    def chunks(self, buffer):
+        """
+        Decodes audio stream entries (XREAD/XRANGE reply)
+
+        Returns
+        -------
+        Generator of ChAudio windows completed by the entries
+        """
+        for entry_id, fields in buffer or []:
+            ts = entry_timestamp(entry_id)
+            if self.__next_sample_ms is None:
+                if self.window_start is None:
+                    self.window_start = int(math.ceil(ts / self.window_ms) * self.window_ms)
+                self.__next_sample_ms = min(ts, self.window_start)
+            if ts - self.__next_sample_ms > MAX_GAP_MS:
+                for chunk in self.__append(numpy.zeros((int((ts - self.__next_sample_ms) * self.sample_rate / 1000), self.channels), dtype=self.__dtype)):
+                    yield chunk
+            try:
+                frames = self.codec.decode(av.Packet(fields[b"frame"]))
+            except Exception as e:
+                logger.warning("audio packet decoding failed: " + str(e))
+                continue
+            for frame in frames:
+                for resampled in self.__resample(frame):
+                    for chunk in self.__append(resampled.to_ndarray().reshape(-1, self.channels)):
+                        yield chunk
+
+    def flush(self):
+        """
+        Partial window of samples decoded so far
+
+        Returns
+        -------
+        ChAudio or None if there are no samples
+        """
+        if self.__filled == 0:
+            return None
+        chunk = ChAudio(data=self.__window[:self.__filled], timestamp=self.window_start, sample_rate=self.sample_rate, channels=self.channels)
+        self.__next_window()
+        return chunk
+
+    def __resample(self, frame):
+        resampled = self.__resampler.resample(frame)
+        # PyAV < 9 returns a single frame
+        if isinstance(resampled, list):
+            return resampled
+        return [resampled] if resampled is not None else []
+
+    def __append(self, samples):
+        if self.__next_sample_ms < self.window_start:
+            # samples before the first window
+            skip = min(len(samples), int(math.ceil((self.window_start - self.__next_sample_ms) * self.sample_rate / 1000)))
+            self.__next_sample_ms += skip * 1000 / self.sample_rate
+            samples = samples[skip:]
+        while len(samples) > 0:
+            n = min(len(samples), self.__window_samples - self.__filled)
+            self.__window[self.__filled:self.__filled + n] = samples[:n]
+            self.__filled += n
+            self.__next_sample_ms += n * 1000 / self.sample_rate
+            samples = samples[n:]
+            if self.__filled == self.__window_samples:
+                yield ChAudio(data=self.__window, timestamp=self.window_start, sample_rate=self.sample_rate, channels=self.channels)
+                self.__next_window()
+
+    def __next_window(self):
+        self.__window = numpy.zeros((self.__window_samples, self.channels), dtype=self.__dtype)
+        self.__filled = 0
+        self.window_start += self.window_ms
@@ -20,9 +20,21 @@ import collections
 import logging as logger
 from datetime import datetime
 from .live_video_image import LiveVideoImage
-from .past_video_image import PastVideoImage
-from .chunker import Chunker, ChImage
-from .probe import Probe, ProbeInfo
+from .live_video_buffer import LiveVideoBuffer
+from .multi_video_image import MultiLiveVideoImage
+from .past_video_image import PastVideoImage, iter_past_images
+from .parallel_history import iter_parallel_images
+from .history_session import HistorySession
+from .live_audio import LiveAudio
+from .past_audio import iter_past_audio
+from .export import export_clip
+from .chunker import Chunker, ChImage, PIX_FMTS, output_format
+from .probe import Probe, ProbeInfo, probe_all
+from .screenshot import search_range, merge_ranges, decode_keyframe
+from .seek import next_id, entry_timestamp
+from .keyframe_index import KeyframeIndex, KeyframeLookup
+from .decoder import create_decoder, DecoderPool, THREAD_TYPES
+from .metrics import InstrumentedConnection
 import sys
 
 class Connect:
@@ -33,49 +45,133 @@ class Connect:
     host (string): Server host (e.g. 127.0.0.1, http://mystream.chrysvideo.com)
     port (int): Port of the streaming media server cache
     buffer_size (int): The default buffer size for decoded frame per frame data (audio or video) when streaming live video (default 10)
+    prefetch (bool): Read and decode the live stream in a background thread into a ring of buffer_size frames (default False)
+    rtmp_video_stream (string): Name of the video stream in the streaming media server cache (default input_rtmp_stream)
+    rtmp_audio_stream (string): Name of the audio stream in the streaming media server cache (default input_rtmp_audio_stream)
+    frame_cache (FrameCache): Cache of decoded images checked by VideoLatestImage, VideoPastImage and Screenshot, can be shared between Connect instances (default None)
+    pix_fmt (string): Pixel format of returned images: bgr24, rgb24, gray, yuv420p or planes (views of the decoded planes, no conversion, see ChImage.planes) (default bgr24)
+    size (tuple): (width, height) returned images are scaled to while converting, None keeps the stream resolution (default None)
+    audio_sample_rate (int): Sample rate audio is resampled to (default 16000)
+    audio_channels (int): Number of audio channels, 1 or 2 (default 1)
+    audio_sample_format (string): Audio samples as float32 or int16 (default float32)
+    audio_window_ms (int): Length of returned audio chunks in ms (default 1000)
+    sampling (Sampling): Frames returned by live and history playback, e.g. keyframes only or at most N per second, None returns all (default None)
+    thread_type (string): Video decoder threading: NONE, SLICE, FRAME or AUTO (default SLICE). FRAME threading (part of AUTO) decodes faster but holds back up to thread_count frames, live images lag behind by as many frames
+    thread_count (int): Number of threads per video decoder, 0 uses one per CPU (default 0)
+    store (StreamStore): Local store to read streams from instead of the server at host and port, e.g. MemoryStore or FileStore (default None)
+    metrics (Metrics): Registry recording redis round trips, bytes fetched, decode and conversion times, queue depths, dropped frames and decode errors per stream, None measures nothing (default None)
+    max_frame_bytes (int): Largest shared memory slot of VideoPastImage, slots are sized for the first returned image and larger images are pickled, None doesn't limit slot size (default None)
     """
 
-    def __init__(self, host, port, password=None, ssl_ca_cert=None, buffer_size=10):
+    def __init__(self, host=None, port=None, password=None, ssl_ca_cert=None, buffer_size=10, prefetch=False, rtmp_video_stream="input_rtmp_stream", rtmp_audio_stream="input_rtmp_audio_stream", frame_cache=None, pix_fmt="bgr24", size=None,
+                 audio_sample_rate=16000, audio_channels=1, audio_sample_format="float32", audio_window_ms=1000, sampling=None, thread_type="SLICE", thread_count=0, store=None, metrics=None, max_frame_bytes=None):
+        if pix_fmt not in PIX_FMTS:
+            raise ValueError("unsupported pixel format " + str(pix_fmt) + ", expected one of " + ", ".join(PIX_FMTS))
+        if thread_type not in THREAD_TYPES:
+            raise ValueError("unsupported thread type " + str(thread_type) + ", expected one of " + ", ".join(THREAD_TYPES))
         self.password = password
+        self.frame_cache = frame_cache
+        self.pix_fmt = pix_fmt
+        self.size = size
+        self.sampling = sampling
+        self.metrics = metrics
+        self.__output_format = output_format(pix_fmt, size)
+        self.__decoder_options = {"thread_type": thread_type, "thread_count": thread_count}
+        self.__audio_options = {"sample_rate": audio_sample_rate, "channels": audio_channels, "sample_format": audio_sample_format, "window_ms": audio_window_ms}
         self.buffer_size = buffer_size
-        self.rtmp_video_stream = "input_rtmp_stream"
-        self.rtmp_audio_stream = "input_rtmp_audio_stream"
-        try:
-            ssl_cert_reqs = None
-            if ssl_ca_cert is not None:
-                ssl_cert_reqs = "required"
-                pool = redis.ConnectionPool(host=host, port=port, password=password, connection_class=redis.SSLConnection, ssl_cert_reqs=ssl_cert_reqs, ssl_ca_certs=ssl_ca_cert)
-            else:
-                pool = redis.ConnectionPool(host=host, port=port, password=password)
-            self.redis_conn = redis.StrictRedis(connection_pool=pool)
-            test_time = self.redis_conn.time() # test connection right away
-            logger.info("redis current time: " + str(test_time[0]))
-        except redis.ConnectionError as ex:
-            logger.error("failed to connect to remote streaming instance: " + str(ex), stack_info=True)
-            raise ConnectionError()
-        except:
-            print("Error: ", sys.exc_info()[0])
-            # logger.error("failed to connect to remote streaming instance", stack_info=True)
-            raise ConnectionError()
+        self.rtmp_video_stream = rtmp_video_stream
+        self.rtmp_audio_stream = rtmp_audio_stream
+        if store is not None:
+            # store stands in for the redis connection
+            self.redis_conn = store
+        else:
+            self.redis_conn = self.__connect(host, port, password, ssl_ca_cert)
+        if metrics is not None:
+            self.redis_conn = InstrumentedConnection(self.redis_conn, metrics)
 
         self.audio_codec = av.Codec('aac', 'r').create()
-        self.video_codec = av.Codec('h264', 'r').create()
-        self.__playvideo = LiveVideoImage(redis_conn=self.redis_conn, stream_name=self.rtmp_video_stream)
-        self.__playpastvideo = PastVideoImage(redis_conn=self.redis_conn, stream_name=self.rtmp_video_stream, audio_stream_name=self.rtmp_audio_stream)
-        logger.debug("Chrysalis SDK init success with host " + host + ":" + str(port) + ", buffer size: " + str(buffer_size))
+        self.video_codec = create_decoder(**self.__decoder_options)
+        # decoders reused by screenshots, every player creates its own
+        self.__decoders = DecoderPool(**self.__decoder_options)
+        self.__playvideo = LiveVideoImage(redis_conn=self.redis_conn, stream_name=self.rtmp_video_stream, codec=create_decoder(**self.__decoder_options), frame_cache=frame_cache, pix_fmt=pix_fmt, size=size, sampling=self.__sampling_copy(), metrics=metrics)
+        self.__livebuffer = None
+        self.__multivideo = {}
+        self.__probes = {}
+        self.__keyframe_index = KeyframeIndex(redis_conn=self.redis_conn, stream_name=self.rtmp_video_stream)
+        if prefetch:
+            self.__livebuffer = LiveVideoBuffer(redis_conn=self.redis_conn, stream_name=self.rtmp_video_stream, buffer_size=buffer_size, codec=create_decoder(**self.__decoder_options), frame_cache=frame_cache, pix_fmt=pix_fmt, size=size, sampling=self.__sampling_copy(), metrics=metrics)
+            self.__livebuffer.start()
+        self.__playaudio = LiveAudio(redis_conn=self.redis_conn, stream_name=self.rtmp_audio_stream, codec=self.audio_codec, **self.__audio_options)
+        self.__playpastvideo = PastVideoImage(redis_conn=self.redis_conn, stream_name=self.rtmp_video_stream, audio_stream_name=self.rtmp_audio_stream, buffer_size=buffer_size, max_frame_bytes=max_frame_bytes, frame_cache=frame_cache, pix_fmt=pix_fmt, size=size, sampling=self.__sampling_copy(), metrics=metrics, **self.__decoder_options)
+        logger.debug("Chrysalis SDK init success with " + (type(store).__name__ if store is not None else "host " + str(host) + ":" + str(port)) + ", buffer size: " + str(buffer_size))
 
     def VideoLatestImage(self):
         """
         Latest frame from the video stream.
 
-        Decoding the latest image from video stream
+        Decoding the latest image from video stream. With prefetch enabled returns the newest frame
+        already decoded by the background reader without blocking.
 
         Returns:
         ChImage object
         """
+        if self.__livebuffer is not None:
+            return self.__livebuffer.get_latest_image()
         img = self.__playvideo.get_latest_image()
         return img
 
+    def VideoLatestImages(self, timeout=None):
+        """
+        Iterator over live video frames in stream order.
+
+        With prefetch enabled every decoded frame still in the buffer is returned, otherwise
+        it keeps returning the latest image (same as calling VideoLatestImage in a loop).
+
+        Attributes
+        ----------
+        timeout : float
+            seconds to wait for the next frame before the iteration ends (default: wait forever), prefetch only
+
+        Returns
+        -------
+        Generator of ChImage objects
+        """
+        if self.__livebuffer is not None:
+            yield from self.__livebuffer.frames(timeout=timeout)
+            return
+        while True:
+            img = self.__playvideo.get_latest_image()
+            if img is not None:
+                yield img
+
+    def VideoLatestImageMulti(self, stream_names):
+        """
+        Latest frame from each of the given video streams (e.g. many cameras on the same server).
+
+        All streams are read with a single blocking XREAD over the shared connection pool,
+        each stream keeps its own decoder.
+
+        Attributes
+        ----------
+        stream_names : list
+            names of the video streams
+
+        Returns
+        -------
+        Dictionary of key = stream name, value = ChImage or None if stream has no new frame
+        """
+        key = tuple(stream_names)
+        if key not in self.__multivideo:
+            self.__multivideo[key] = MultiLiveVideoImage(redis_conn=self.redis_conn, stream_names=stream_names, frame_cache=self.frame_cache, pix_fmt=self.pix_fmt, size=self.size, metrics=self.metrics, **self.__decoder_options)
+        return self.__multivideo[key].get_latest_images()
+
+    def Close(self):
+        """
+        Stops the background live stream reader (if prefetch enabled)
+        """
+        if self.__livebuffer is not None:
+            self.__livebuffer.stop()
+
     def VideoPastImage(self, fromTsMs, toTsMs):
         """
         Frame from the video buffer between two timestamps (in milliseconds).
@@ -88,6 +184,56 @@ class Connect:
         img = self.__playpastvideo.get_latest_image_from(fromtimestamp=fromTsMs, totimestamp=toTsMs)
         return img
 
+    def VideoPastImages(self, fromTsMs, toTsMs):
+        """
+        Iterates over all frames from the video buffer between two timestamps (in milliseconds).
+
+        Frames are decoded in the calling thread while iterating, only a single batch of stream entries
+        is held in memory at once, so long ranges can be scanned in constant memory.
+        Independent of VideoPastImage, many iterators can run at the same time.
+
+        Returns:
+        Generator of ChImage objects
+        """
+        return iter_past_images(self.redis_conn, self.rtmp_video_stream, fromTsMs, toTsMs, pix_fmt=self.pix_fmt, size=self.size, sampling=self.__sampling_copy(), metrics=self.metrics, **self.__decoder_options)
+
+    def VideoPastImagesParallel(self, fromTsMs, toTsMs, ordered=True, processes=None, segment_seconds=10):
+        """
+        Iterates over all frames from the video buffer between two timestamps (in milliseconds) decoded in a pool of processes.
+
+        The range is split into segments starting at keyframes, decoded independently on all cores.
+        Meant for bulk export and analysis of the buffered history.
+
+        Attributes:
+        ordered (bool): Yield frames in stream order, otherwise as soon as a segment is decoded (default True)
+        processes (int): Number of decoding processes (default number of CPUs)
+        segment_seconds (int): Length of a segment decoded by one process (default 10)
+
+        Decoders of the pool run single threaded, thread_type and thread_count don't apply.
+
+        Returns:
+        Generator of ChImage objects
+        """
+        return iter_parallel_images(self.redis_conn, self.rtmp_video_stream, fromTsMs, toTsMs, ordered=ordered, processes=processes, segment_seconds=segment_seconds, pix_fmt=self.pix_fmt, size=self.size, sampling=self.sampling, metrics=self.metrics)
+
+    def OpenHistory(self, fromTsMs, toTsMs, resume_from=None, read_ahead=4) -> HistorySession:
+        """
+        History playback session between two timestamps (in milliseconds) with its own cursor, decoder and read-ahead buffer.
+
+        Unlike VideoPastImage, sessions are independent of each other, so many ranges can be played at once
+        (e.g. from a pool of worker threads over the shared connection pool), and they can be consumed as slowly as needed.
+        session.checkpoint() is the entry ID of the last returned frame, a session opened with it as resume_from
+        continues with the next frame, even in another process.
+
+        Attributes:
+        resume_from (string): Checkpoint of an earlier session over the same range (default None plays from fromTsMs)
+        read_ahead (int): Number of batches of stream entries read ahead (default 4)
+
+        Returns:
+        HistorySession, iterate over it or call next() for ChImage objects, close it when done
+        """
+        return HistorySession(self.redis_conn, self.rtmp_video_stream, fromTsMs, toTsMs, resume_from=resume_from, pix_fmt=self.pix_fmt, size=self.size, sampling=self.__sampling_copy(), read_ahead=read_ahead, metrics=self.metrics, **self.__decoder_options)
+
     def VideoPastImageStopNow(self):
         """
         Stopping VideoPastImage before it reached it's natural end
@@ -99,28 +245,93 @@ class Connect:
         """
         self.__playpastvideo.stop_now()
 
-    def Probe(self) -> ProbeInfo:
+    def VideoPastImageSeek(self, tsMs):
+        """
+        Continues running VideoPastImage from the given timestamp (in milliseconds).
+
+        Frames already buffered before the seek are discarded.
+        """
+        self.__playpastvideo.seek(tsMs)
+
+    def AudioLatestChunk(self):
+        """
+        Next window of audio from the live audio stream.
+
+        Windows follow each other without gaps from the first call on, timestamps are on the same clock as video images.
+
+        Returns:
+        ChAudio object or None if the next window isn't complete yet
+        """
+        return self.__playaudio.get_next_chunk()
+
+    def AudioPastChunks(self, fromTsMs, toTsMs):
+        """
+        Iterates over windows of audio from the audio buffer between two timestamps (in milliseconds).
+
+        The first window starts at fromTsMs, so windows line up with video images of the same range.
+
+        Returns:
+        Generator of ChAudio objects
+        """
+        codec = av.Codec('aac', 'r').create()
+        if self.audio_codec.extradata is not None:
+            codec.extradata = self.audio_codec.extradata
+        return iter_past_audio(self.redis_conn, self.rtmp_audio_stream, fromTsMs, toTsMs, codec=codec, **self.__audio_options)
+
+    def ExportClip(self, fromTsMs, toTsMs, file, container="mp4", audio=True):
+        """
+        Exports the video (and audio) buffer between two timestamps (in milliseconds) into a media file.
+
+        Packets are remuxed as they are, without decoding or encoding. The clip starts with the I-Frame at or before fromTsMs.
+        Streams with B-frames are presented in picture order, read from the slice headers.
+
+        Attributes:
+        file (string or file object): Path or writable file object
+        container (string): Container format, e.g. mp4, mpegts, matroska (default mp4)
+        audio (bool): Include the audio stream (default True)
+
+        Returns:
+        Number of exported video frames
+        """
+        return export_clip(self.redis_conn, self.rtmp_video_stream, self.rtmp_audio_stream, fromTsMs, toTsMs, file, container=container, audio=audio)
+
+    def Probe(self, max_age:float=None) -> ProbeInfo:
         """
         Probe the video stream.
 
         Determening approximate cached video duration, start timestamp of the cache and end timestamp of the cache.
+        Stream stats and the frame rate of the newest frames are queried in a single round trip.
+
+        Attributes:
+        max_age (float): Result of a previous probe up to max_age seconds old is returned, 0 always queries the stream (default 1 second)
 
         Returns:
         ProbeInfo object
         """
-        p = Probe(self.redis_conn, self.rtmp_video_stream)
-        return p.info()
+        return self.__probe(self.rtmp_video_stream).info(max_age=max_age)
 
-    def Screenshot(self, dt:datetime=datetime.now(), within_seconds:int=10) -> ChImage:
+    def ProbeMulti(self, stream_names, max_age:float=None):
+        """
+        Probe many video streams (e.g. every camera on the same server) in a single round trip, see Probe.
+
+        Returns:
+        Dictionary of key = stream name, value = ProbeInfo
+        """
+        probes = [self.__probe(stream_name) for stream_name in stream_names]
+        return dict(zip(stream_names, probe_all(self.redis_conn, probes, max_age=max_age)))
+
+    def Screenshot(self, dt:datetime=None, within_seconds:int=10) -> ChImage:
         """
         BGR24 image as numpy array. Screenshot does not guarantee to find an image withing the given timespan.
         This is due to H264 algorithm stream chunking the frames into I,B,P frames. Screenshot function actually returns an I frame if found
         withing given timestamp +/- (within_seconds/2)
 
+        Keyframes are looked up in an index maintained from packet headers, so only the closest keyframe is fetched and decoded.
+
         Attributes
         ----------
-        timestamp : int
-            around which  timestamp  to look for I frame
+        dt : datetime
+            around which time to look for I frame (default now)
         within_seconds : int
             allowed search area around timestamp
 
@@ -128,45 +339,113 @@ class Connect:
         -------
         ChImage or None if not found
         """
-        timestamp = int(dt.timestamp() * 1000)
-        
-        # if less than 10 ms from time it's the latest time
-        buffer_to_ts = timestamp
-        if abs(int(time.time() * 1000) - timestamp) > 10:
-            # otherwise we're searching withing_seconds/2 ahead
-            logger.debug("searching 1/2 of withing seconds in the future")
-            buffer_to_ts = timestamp  + int(within_seconds / 2 * 1000)
-
-        min_found = None
-        # seeks in the past 5 seconds (second per second)
-        
-        for stride in range(within_seconds):
-            buffer_to_ts = buffer_to_ts - (stride * 1000)
-            # reverse 1 second back in time
-            buffer_from_ts = buffer_to_ts - (stride * 1000) - 1000
+        if dt is None:
+            dt = datetime.now()
+        return self.Screenshots([dt], within_seconds=within_seconds)[0]
+
+    def Screenshots(self, dts, within_seconds:int=10):
+        """
+        Screenshots at many times in one call, see Screenshot.
+
+        All keyframes needed are fetched in a single pipelined round trip and each of them is decoded once,
+        no matter how many of the requested times it serves.
+
+        Attributes
+        ----------
+        dts : list
+            datetimes around which to look for I frames
+        within_seconds : int
+            allowed search area around each timestamp
+
+        Returns
+        -------
+        List of ChImage or None (if not found), one per requested datetime
+        """
+        if len(dts) == 0:
+            return []
+        timestamps = [int(dt.timestamp() * 1000) for dt in dts]
+        now_ms = int(time.time() * 1000)
+        ranges = [search_range(ts, within_seconds, now_ms) for ts in timestamps]
+
+        self.__keyframe_index.update(ranges)
+        if len(self.__keyframe_index) == 0:
+            # no keyframes recognized from packet headers, search for I frames by decoding
+            return self.__screenshots_by_decoding(timestamps, ranges)
+
+        cached = None
+        if self.frame_cache is not None:
+            cached = lambda entry_id: self.frame_cache.get(self.rtmp_video_stream, entry_id, self.__output_format)
+        lookup = KeyframeLookup(self.__keyframe_index, self.rtmp_video_stream, timestamps, ranges, cached=cached)
+        pipe = self.redis_conn.pipeline(transaction=False)
+        while lookup.queue(pipe):
+            for keyframe, buffer in lookup.fetched(pipe.execute()):
+                with self.__decoders.decoder() as codec:
+                    img = decode_keyframe(buffer, keyframe[0], pix_fmt=self.pix_fmt, size=self.size, codec=codec, metrics=self.metrics, stream_name=self.rtmp_video_stream)
+                if self.frame_cache is not None:
+                    self.frame_cache.put(self.rtmp_video_stream, img, self.__output_format)
+                lookup.resolve(keyframe, img)
+        return lookup.results
+
+    def __connect(self, host, port, password, ssl_ca_cert):
+        try:
+            ssl_cert_reqs = None
+            if ssl_ca_cert is not None:
+                ssl_cert_reqs = "required"
+                pool = redis.ConnectionPool(host=host, port=port, password=password, connection_class=redis.SSLConnection, ssl_cert_reqs=ssl_cert_reqs, ssl_ca_certs=ssl_ca_cert)
+            else:
+                pool = redis.ConnectionPool(host=host, port=port, password=password)
+            redis_conn = redis.StrictRedis(connection_pool=pool)
+            test_time = redis_conn.time() # test connection right away
+            logger.info("redis current time: " + str(test_time[0]))
+            return redis_conn
+        except redis.ConnectionError as ex:
+            logger.error("failed to connect to remote streaming instance: " + str(ex), stack_info=True)
+            raise ConnectionError()
+        except:
+            print("Error: ", sys.exc_info()[0])
+            # logger.error("failed to connect to remote streaming instance", stack_info=True)
+            raise ConnectionError()
+
+    def __probe(self, stream_name):
+        # probes are kept per stream for their cached results
+        if stream_name not in self.__probes:
+            self.__probes[stream_name] = Probe(self.redis_conn, stream_name)
+        return self.__probes[stream_name]
+
+    def __sampling_copy(self):
+        # every playback samples on its own
+        return self.sampling.copy() if self.sampling is not None else None
+
+    def __screenshots_by_decoding(self, timestamps, ranges):
+        # every part of the stream covered by (merged) search ranges is fetched and decoded once
+        iframes = {}
+        for buffer_from_ts, buffer_to_ts in merge_ranges(ranges):
             logger.debug("querying stream " + self.rtmp_video_stream + "between " + str(buffer_from_ts) + " and " + str(buffer_to_ts) + ", diff[ms]: " + str(buffer_to_ts-buffer_from_ts))
-            buffer = self.redis_conn.xrange(name=self.rtmp_video_stream, min=buffer_from_ts, max=buffer_to_ts, count=60)
-            frames = Chunker(self.video_codec).frames(buffer)
+            chunker = Chunker(create_decoder(**self.__decoder_options), pix_fmt=self.pix_fmt, size=self.size, metrics=self.metrics, stream_name=self.rtmp_video_stream)
+            min_id = str(buffer_from_ts)
+            while True:
+                buffer = self.redis_conn.xrange(name=self.rtmp_video_stream, min=min_id, max=buffer_to_ts, count=500)
+                for entry_id, frame in chunker.frames(buffer, flush=len(buffer) < 500):
+                    if frame.pict_type.name == "I":
+                        iframes[entry_timestamp(entry_id)] = (entry_id, frame)
+                if len(buffer) < 500:
+                    break
+                min_id = next_id(buffer[-1][0])
 
+        results = []
+        images = {}
+        for timestamp, (lo, hi) in zip(timestamps, ranges):
             # find closest image to given timestamp
-            min_diff = None
-            for ts, frame in frames.items():
-                if frame.pict_type.name == "I":
-                    logger.debug("found I frame at " + str(ts))
-                    if min_found is None:
-                        d = frame.to_ndarray(format="bgr24")
-                        chImage = ChImage(data=d, width=frame.width, height=frame.height, timestamp=ts)
-                        min_found = chImage
-                        min_diff = abs(timestamp - ts)
-                        continue
-
-                    diff = abs(timestamp - ts)
-                    if diff < min_diff:
-                        d = frame.to_ndarray(format="bgr24")
-                        chImage = ChImage(data=d, width=frame.width, height=frame.height, timestamp=ts)
-                        min_diff = diff
-                        min_found = chImage
-            if  min_found is not None:
-                break
-
-        return min_found
\ No newline at end of file
+            min_ts = None
+            for ts in iframes:
+                if lo <= ts <= hi and (min_ts is None or abs(timestamp - ts) < abs(timestamp - min_ts)):
+                    min_ts = ts
+            if min_ts is None:
+                results.append(None)
+                continue
+            # each I frame converted only once
+            if min_ts not in images:
+                entry_id, frame = iframes[min_ts]
+                images[min_ts] = chunker.image(min_ts, frame, entry_id=entry_id)
+            results.append(images[min_ts])
+        return results
@@ -12,86 +12,234 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import io
+import functools
+import heapq
+import time
 import av
 from .log import logger
-from .models import ChImage
+from .models import ChImage, frame_planes
 import numpy
 
+# pixel formats images can be converted to, planes keeps the decoder's format
+PIX_FMTS = ("bgr24", "rgb24", "gray", "yuv420p", "planes")
+
+# most frames an H.264 decoder holds back for reordering (DPB size)
+MAX_REORDER = 16
+
+def output_format(pix_fmt="bgr24", size=None):
+    """
+    Name of the image output (pixel format and size), e.g. bgr24 or rgb24@640x360
+    """
+    if size is None:
+        return pix_fmt
+    return pix_fmt + "@" + str(size[0]) + "x" + str(size[1])
+
+def convert_frame(frame, pix_fmt="bgr24", size=None, metrics=None, stream_name=""):
+    """
+    Decoded frame as numpy.ndarray in the pixel format and size
+    """
+    if metrics is not None:
+        started = time.perf_counter()
+    if size is not None:
+        frame = frame.reformat(width=size[0], height=size[1], format=pix_fmt)
+    elif frame.format.name != pix_fmt:
+        frame = frame.reformat(format=pix_fmt)
+    data = frame.to_ndarray()
+    if metrics is not None:
+        metrics.observe("convert_seconds", time.perf_counter() - started, stream=stream_name)
+    return data
+
 class Chunker:
+    """
+    Decodes raw video packets from the stream
 
-    def __init__(self, codec):
+    Attributes
+    ----------
+    codec : av.CodecContext
+        decoder
+    pix_fmt : string
+        pixel format of image data, one of bgr24, rgb24, gray, yuv420p (Y, U and V planes stacked vertically)
+        or planes (views of the decoded frame's planes, no conversion nor copy)
+    size : tuple
+        (width, height) images are scaled to, None keeps decoded size
+    metrics : Metrics
+        records decode and conversion times and decode errors, None measures nothing
+    stream_name : string
+        stream label of recorded metrics
+    """
+
+    def __init__(self, codec, pix_fmt="bgr24", size=None, metrics=None, stream_name=""):
+        if pix_fmt not in PIX_FMTS:
+            raise ValueError("unsupported pixel format " + str(pix_fmt) + ", expected one of " + ", ".join(PIX_FMTS))
         self.codec = codec
+        self.pix_fmt = pix_fmt
+        self.size = size
+        self.output_format = output_format(pix_fmt, size)
+        self.metrics = metrics
+        self.stream_name = stream_name
+        # packets are numbered in decoding order (the number is set as packet pts), frames are paired with
+        # stream entries by the pts the decoder passes on, whatever delay threading or reordering adds
+        self.__next_pts = 0
+        # pts -> frame selected for an image, of packets whose frame wasn't output yet (in decoding order)
+        self.__pending = {}
+        # pts of entries not paired with a frame yet, and their entry IDs
+        self.__labels = []
+        self.__entry_ids = {}
 
-    def frames(self, buffer):
+    def frames(self, buffer, flush=False, emit=None):
         """
         Decoding raw video packets into frames
 
+        Attributes
+        ----------
+        flush : bool
+            drain frames the decoder holds back (reordering, frame threading) at the end of a range,
+            the decoder is reset afterwards
+        emit : set
+            see images
+
         Returns
         -------
-        Returns dictionary od key = timestamp, value = av.frame.Frame
+        Generator of (stream entry ID string, av.frame.Frame) in presentation order. Without reordering
+        (no B frames) a frame is paired with the entry of its own packet, otherwise entry IDs of
+        the decoded packets are handed out in ascending order, one per frame
         """
-        frames = self.__decode_video_packets_to_frames(buffer)
-        return frames
+        for entry_id, frame, selected in self.__frames(buffer, flush, emit):
+            if selected:
+                yield entry_id, frame
 
-    def packets(self, buffer):
+    def images(self, buffer, from_timestamp=0, emit=None, flush=False):
         """
-        Raw packets
+        Decoding raw video packets into images
+
+        Attributes
+        ----------
+        from_timestamp : int
+            frames before this timestamp (in ms) are decoded but not converted nor returned
+        emit : set
+            stream entry IDs (strings) to convert into images, None converts all. Applies to the frames of
+            the packets in buffer, also when the decoder outputs them later on
+        flush : bool
+            see frames
 
         Returns
         -------
-        Returns dictionary with key as timestamp of a packet and av.Packet value
+        Generator of ChImage objects in presentation order, each one converted only when requested
         """
-        return self.__packet_chunker(buffer)
+        for entry_id, frame, selected in self.__frames(buffer, flush, emit):
+            ts = int(entry_id[:entry_id.index("-")])
+            if ts < from_timestamp or not selected:
+                continue
+            yield self.image(ts, frame, entry_id=entry_id)
 
-    def __decode_video_packets_to_frames(self, buffer):
+    def reset(self):
         """
-        Decoding raw video packets into frames
+        Drops frames the decoder holds back, so it can decode from a keyframe again (also after a flush)
+        """
+        self.codec.flush_buffers()
+        self.__pending.clear()
+        self.__labels.clear()
+        self.__entry_ids.clear()
+
+    def image(self, ts, frame, entry_id=None, dropped_frames=0):
+        """
+        Decoded frame as ChImage, pixel format conversion and scaling is done in a single libswscale pass
+        when image data is first accessed
+        """
+        frame_type = frame.pict_type.name
+        if self.pix_fmt == "planes":
+            if self.metrics is not None:
+                started = time.perf_counter()
+            if self.size is not None:
+                # scaled in the decoder's format
+                frame = frame.reformat(width=self.size[0], height=self.size[1])
+            planes = frame_planes(frame)
+            img = ChImage(data=planes[0], width=frame.width, height=frame.height, timestamp=ts, frame_type=frame_type, dropped_frames=dropped_frames, entry_id=entry_id, pix_fmt=frame.format.name, planes=planes, frame=frame)
+            if self.metrics is not None:
+                self.metrics.observe("convert_seconds", time.perf_counter() - started, stream=self.stream_name)
+            return img
+        width, height = self.size if self.size is not None else (frame.width, frame.height)
+        # converted on first access of ChImage.data
+        convert = functools.partial(convert_frame, frame, self.pix_fmt, self.size, self.metrics, self.stream_name)
+        return ChImage(width=width, height=height, timestamp=ts, frame_type=frame_type, dropped_frames=dropped_frames, entry_id=entry_id, pix_fmt=self.pix_fmt, convert=convert)
+
+    def packets(self, buffer):
+        """
+        Raw packets
 
         Returns
         -------
-        Returns dictionary od key = timestamp, value = av.frame.Frame
+        Generator of (stream entry ID string, av.Packet) in stream order
         """
-        all_frames = {}
-        packets = self.__packet_chunker(buffer)
-        if len(packets) > 0:
-            for ts, packet in packets.items():
-                try:
-                    frames = self.codec.decode(packet)
-                    for frame in frames:
-                        all_frames[ts] = frame
-                except Exception as e:
-                    print(e)
-                    continue
-                    # logger.debug("packet decoding failed", exc_info=True)
-        return all_frames
+        for entry_id, packet in self.__packet_chunker(buffer):
+            yield entry_id.decode("utf-8"), packet
 
-    def __packet_chunker(self, buffer):
+    def __frames(self, buffer, flush, emit=None):
+        for entry_id, packet in self.__packet_chunker(buffer):
+            entry_id = entry_id.decode("utf-8")
+            pts = self.__next_pts
+            self.__next_pts += 1
+            packet.pts = pts
+            self.__pending[pts] = emit is None or entry_id in emit
+            heapq.heappush(self.__labels, pts)
+            self.__entry_ids[pts] = entry_id
+            try:
+                decoded = self.__decode(packet)
+            except Exception as e:
+                self.__decode_failed(entry_id, e)
+                continue
+            for frame in decoded:
+                paired = self.__paired(frame)
+                if paired is not None:
+                    yield paired
+        if flush:
+            try:
+                decoded = self.__decode(None)
+            except Exception as e:
+                self.__decode_failed(None, e)
+                decoded = []
+            for frame in decoded:
+                paired = self.__paired(frame)
+                if paired is not None:
+                    yield paired
+            self.reset()
+
+    def __paired(self, frame):
         """
-        Chunks packets into a dictionary with key as timestamp of a packet and av.Packet value
+        (entry ID, frame, selected) of a decoded frame, None if its packet is unknown (decoded before a reset)
         """
-        packet_results = {}
-        if buffer:
-            buffer_array = []
-            buffer_array_ts = []
-            for x in buffer:
-                timestamp_x = x[0].decode("utf-8")
-                dictionary_x = x[1]
-                splitted = timestamp_x.split("-")
-                timestamp = splitted[0]
-                content = {}
-                for key, value in dictionary_x.items():
-                    content[key.decode("utf-8")] = value
-                buffer_array.append(content["frame"])
-                buffer_array_ts.append(int(timestamp))
-            for idx, fr in enumerate(buffer_array):
-                frame_buf = io.BytesIO(fr)
-                size = frame_buf.getbuffer().nbytes
-                packet = av.Packet(size)
-                frame_buf.readinto(packet)
-                
-                frame_ts = buffer_array_ts[idx]
-                packet_results[frame_ts] = packet
-
-        return packet_results
+        if frame.pts not in self.__pending:
+            return None
+        selected = self.__pending.pop(frame.pts)
+        # packets that never produced a frame (corrupt, undecodable without their references) are
+        # out of reordering reach, their entries are dropped so later frames aren't mislabeled
+        reach = MAX_REORDER if self.codec.has_b_frames else 0
+        while len(self.__pending) > 0:
+            oldest = next(iter(self.__pending))
+            if oldest >= frame.pts - reach:
+                break
+            del self.__pending[oldest]
+            self.__entry_ids.pop(heapq.heappop(self.__labels))
+        entry_id = self.__entry_ids.pop(heapq.heappop(self.__labels))
+        return entry_id, frame, selected
 
+    def __decode(self, packet):
+        if self.metrics is None:
+            return self.codec.decode(packet)
+        started = time.perf_counter()
+        frames = self.codec.decode(packet)
+        self.metrics.observe("decode_seconds", time.perf_counter() - started, stream=self.stream_name)
+        return frames
+
+    def __decode_failed(self, entry_id, ex):
+        logger.warning("failed to decode " + ("packet " + entry_id if entry_id is not None else "end of range") + " of " + (self.stream_name or "video stream") + ": " + str(ex))
+        if self.metrics is not None:
+            self.metrics.inc("decode_errors", stream=self.stream_name)
+
+    def __packet_chunker(self, buffer):
+        """
+        Lazily yields (entry ID, av.Packet) for every stream entry, the entry payload is handed to
+        av.Packet as is (no intermediate buffers)
+        """
+        for entry_id, fields in buffer or []:
+            yield entry_id, av.Packet(fields[b"frame"])
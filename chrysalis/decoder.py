@@ -0,0 +1,82 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import queue
+import av
+
+# libavcodec threading modes
+THREAD_TYPES = ("NONE", "SLICE", "FRAME", "AUTO")
+
+def create_decoder(codec_name="h264", thread_type="SLICE", thread_count=0):
+    """
+    New decoder context, every decoding session needs its own one
+
+    Attributes
+    ----------
+    thread_type : string
+        NONE, SLICE (parallel slices of a frame, default), FRAME (several frames at once, delays output
+        by a frame per thread) or AUTO (both)
+    thread_count : int
+        number of decoding threads, 0 picks one per CPU
+
+    Returns
+    -------
+    av.CodecContext
+    """
+    if thread_type not in THREAD_TYPES:
+        raise ValueError("unsupported thread type " + str(thread_type) + ", expected one of " + ", ".join(THREAD_TYPES))
+    codec = av.Codec(codec_name, 'r').create()
+    # threading has to be set up before the first packet opens the decoder
+    codec.thread_type = thread_type
+    codec.thread_count = thread_count
+    return codec
+
+class DecoderPool:
+    """
+    Reusable decoder contexts for independent decoding sessions (e.g. screenshots), so opening a
+    decoder and spinning up its threads isn't paid on every call. Up to size decoders are kept idle,
+    more are created when all of them are in use.
+
+    Attributes
+    ----------
+    size : int
+        number of idle decoders kept around
+    thread_type, thread_count :
+        threading of created decoders, see create_decoder
+    """
+
+    def __init__(self, size=2, codec_name="h264", thread_type="SLICE", thread_count=0):
+        self.__codec_name = codec_name
+        self.__thread_type = thread_type
+        self.__thread_count = thread_count
+        self.__idle = queue.LifoQueue(maxsize=size)
+
+    @contextlib.contextmanager
+    def decoder(self):
+        """
+        Context manager lending a decoder in its initial state, it's reset and returned to the pool on exit
+        """
+        try:
+            codec = self.__idle.get_nowait()
+        except queue.Empty:
+            codec = create_decoder(self.__codec_name, thread_type=self.__thread_type, thread_count=self.__thread_count)
+        # on error the decoder is dropped, its state is unknown
+        yield codec
+        # drops buffered frames and the end of stream state of a flushed decoder
+        codec.flush_buffers()
+        try:
+            self.__idle.put_nowait(codec)
+        except queue.Full:
+            pass
@@ -0,0 +1,226 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fractions
+import heapq
+import io
+import itertools
+import av
+from .log import logger
+from .h264 import is_keyframe, reorders, nal_headers, poc_parameters, pic_order_cnt_lsb, NAL_SLICE, NAL_IDR_SLICE
+from .seek import keyframe_before, next_id, entry_timestamp
+
+MS_TIME_BASE = fractions.Fraction(1, 1000)
+# packets handed to libavformat to probe codec parameters of a stream
+PROBE_PACKETS = 30
+
+def stream_entries(redis_conn, stream_name, min_id, totimestamp, count=500):
+    """
+    Entries of the stream from min_id (inclusive) up to totimestamp (in ms), read with XRANGE in batches
+
+    Returns
+    -------
+    Generator of (stream ID, fields)
+    """
+    while True:
+        buffer = redis_conn.xrange(stream_name, min=min_id, max=str(totimestamp), count=count)
+        for entry in buffer:
+            yield entry
+        if len(buffer) < count:
+            return
+        min_id = next_id(buffer[-1][0])
+
+def probe_template(payloads, format_name):
+    """
+    Input stream with codec parameters probed from concatenated raw packets (Annex B H.264 or ADTS AAC)
+
+    Returns
+    -------
+    (input container, stream) or (None, None) if the packets can't be probed
+    """
+    try:
+        container = av.open(io.BytesIO(b"".join(payloads)), format=format_name)
+    except Exception as e:
+        logger.warning("failed to probe " + format_name + " packets: " + str(e))
+        return None, None
+    streams = container.streams.video if format_name == "h264" else container.streams.audio
+    if len(streams) == 0:
+        container.close()
+        return None, None
+    return container, streams[0]
+
+def tagged(kind, entries):
+    """
+    Generator of (timestamp, kind, payload, presentation timestamp) of stream entries, entries are
+    (stream ID, fields) or (stream ID, fields, presentation timestamp in ms)
+    """
+    for entry in entries:
+        ts = entry_timestamp(entry[0])
+        yield ts, kind, entry[1][b"frame"], entry[2] if len(entry) > 2 else ts
+
+def gop_presentation(gop):
+    """
+    Pairs the pictures of a GOP with its entry timestamps in presentation order: the Nth picture shown
+    gets the Nth entry timestamp, the same pairing decoding with Chunker ends up with
+
+    Attributes
+    ----------
+    gop : list
+        ((stream ID, fields), picture order count or None) in decoding order
+
+    Returns
+    -------
+    List of (stream ID, fields, presentation timestamp in ms), presentation timestamps are the entry
+    timestamps if a picture order count is missing
+    """
+    timestamps = [entry_timestamp(entry[0]) for entry, _ in gop]
+    if any(poc is None for _, poc in gop):
+        return [(entry[0], entry[1], ts) for (entry, _), ts in zip(gop, timestamps)]
+    shown = sorted(range(len(gop)), key=lambda idx: (gop[idx][1], idx))
+    presented = [None] * len(gop)
+    for ts, idx in zip(sorted(timestamps), shown):
+        presented[idx] = ts
+    return [(entry[0], entry[1], ts) for (entry, _), ts in zip(gop, presented)]
+
+def presentation_entries(entries, stream_name):
+    """
+    Adds presentation timestamps to H.264 entries of a stream with B-frames from the picture order counts
+    (POC) in their slice headers. Every GOP is held back until the next keyframe. Pictures of streams whose
+    picture order counts can't be read (no SPS, pic_order_cnt_type 1, interlaced) keep decoding order.
+
+    Returns
+    -------
+    Generator of (stream ID, fields, presentation timestamp in ms)
+    """
+    parameters = None
+    warned = False
+    gop = []
+    # PicOrderCntMsb and pic_order_cnt_lsb of the previous reference picture (ITU-T H.264 8.2.1.1)
+    prev_msb, prev_lsb = 0, 0
+    for entry in entries:
+        payload = entry[1].get(b"frame")
+        keyframe = is_keyframe(payload)
+        if keyframe:
+            yield from gop_presentation(gop)
+            gop = []
+            prev_msb, prev_lsb = 0, 0
+        parameters = poc_parameters(payload) or parameters
+        lsb = pic_order_cnt_lsb(payload, parameters) if parameters is not None else None
+        if lsb is None:
+            if not warned:
+                logger.warning("can't read picture order counts of " + stream_name + ", B-frames are exported in decoding order")
+                warned = True
+            gop.append((entry, None))
+            continue
+        max_lsb = 1 << parameters[1]
+        if lsb < prev_lsb and prev_lsb - lsb >= max_lsb // 2:
+            msb = prev_msb + max_lsb
+        elif lsb > prev_lsb and lsb - prev_lsb > max_lsb // 2:
+            msb = prev_msb - max_lsb
+        else:
+            msb = prev_msb
+        for ref_idc, nal_type in nal_headers(payload):
+            if nal_type == NAL_SLICE or nal_type == NAL_IDR_SLICE:
+                if ref_idc != 0:
+                    prev_msb, prev_lsb = msb, lsb
+                break
+        gop.append((entry, msb + lsb))
+    yield from gop_presentation(gop)
+
+def export_clip(redis_conn, video_stream_name, audio_stream_name, fromtimestamp, totimestamp, file, container="mp4", audio=True):
+    """
+    Remuxes video (and audio) entries between fromtimestamp and totimestamp (in ms) into a container,
+    packets are copied as they are, nothing is decoded nor encoded. The clip starts at the keyframe at or
+    before fromtimestamp.
+
+    Entry timestamps are decoding timestamps. Presentation timestamps of streams with B-frames are derived
+    from the picture order counts of the slices, and the whole clip is presented later by the reordering
+    delay (so no frame is shown before it's decoded), audio included.
+
+    Returns
+    -------
+    Number of video packets written
+    """
+    query = keyframe_before(redis_conn, video_stream_name, fromtimestamp)
+    min_id = next_id(query) if query is not None else str(fromtimestamp)
+    video = stream_entries(redis_conn, video_stream_name, min_id, totimestamp)
+    # a clip can only start with a keyframe
+    video = itertools.dropwhile(lambda entry: not is_keyframe(entry[1].get(b"frame")), video)
+    video_head = list(itertools.islice(video, PROBE_PACKETS))
+    if len(video_head) == 0:
+        return 0
+    start_timestamp = entry_timestamp(video_head[0][0])
+
+    templates = []
+    video_probe, video_template = probe_template([entry[1][b"frame"] for entry in video_head], "h264")
+    if video_probe is None:
+        return 0
+    templates.append(video_probe)
+    video = itertools.chain(video_head, video)
+    # presentation delay (ms) keeping presentation timestamps at or after decoding timestamps
+    delay = 0
+    if reorders([entry[1][b"frame"] for entry in video_head]):
+        video = presentation_entries(video, video_stream_name)
+        video_head = list(itertools.islice(video, PROBE_PACKETS))
+        delay = max(0, max(entry_timestamp(entry[0]) - entry[2] for entry in video_head))
+        video = itertools.chain(video_head, video)
+    sources = [("video", video)]
+
+    audio_template = None
+    if audio:
+        audio_entries = stream_entries(redis_conn, audio_stream_name, str(start_timestamp), totimestamp)
+        audio_head = list(itertools.islice(audio_entries, PROBE_PACKETS))
+        if len(audio_head) > 0:
+            audio_probe, audio_template = probe_template([entry[1][b"frame"] for entry in audio_head], "aac")
+            if audio_probe is not None:
+                templates.append(audio_probe)
+                sources.append(("audio", itertools.chain(audio_head, audio_entries)))
+            else:
+                logger.warning("audio stream " + audio_stream_name + " isn't ADTS framed AAC, exporting video only")
+
+    output = av.open(file, mode="w", format=container)
+    streams = {"video": output.add_stream(template=video_template)}
+    if audio_template is not None and len(sources) > 1:
+        streams["audio"] = output.add_stream(template=audio_template)
+
+    written = 0
+    # every packet is written once the next one of its stream tells its duration
+    pending = {}
+    durations = {}
+    try:
+        merged = heapq.merge(*[tagged(kind, entries) for kind, entries in sources], key=lambda item: item[0])
+        for ts, kind, payload, pts in merged:
+            packet = av.Packet(payload)
+            packet.stream = streams[kind]
+            packet.time_base = MS_TIME_BASE
+            # entries of the same millisecond still need increasing timestamps
+            packet.dts = ts - start_timestamp
+            if kind == "audio":
+                packet.dts += delay
+            if kind in pending:
+                packet.dts = max(packet.dts, pending[kind].dts + 1)
+                pending[kind].duration = durations[kind] = packet.dts - pending[kind].dts
+                output.mux(pending[kind])
+            packet.pts = max(packet.dts, pts - start_timestamp + delay)
+            pending[kind] = packet
+            if kind == "video":
+                written += 1
+        for kind, packet in pending.items():
+            packet.duration = durations.get(kind, 0)
+            output.mux(packet)
+    finally:
+        output.close()
+        for probe in templates:
+            probe.close()
+    return written
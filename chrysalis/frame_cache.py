@@ -0,0 +1,111 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import multiprocessing as mp
+import threading
+
+HITS = 0
+MISSES = 1
+EVICTIONS = 2
+
+class FrameCache:
+    """
+    LRU cache of decoded images keyed by (stream name, stream entry ID, pixel format), bounded by the
+    total size of cached image data. One cache can be shared by many Connect instances.
+
+    Attributes
+    ----------
+    max_bytes : int
+        budget for cached image data, least recently used images are evicted above it (default 256 MB)
+    """
+
+    def __init__(self, max_bytes=256*1024*1024):
+        self.max_bytes = max_bytes
+        self.__images = collections.OrderedDict()
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+        # hits, misses, evictions in shared memory, so lookups from history playback processes are counted too
+        self.__counters = mp.Array('q', 3)
+
+    def get(self, stream_name, entry_id, pix_fmt="bgr24"):
+        """
+        Returns
+        -------
+        Cached ChImage or None
+        """
+        key = (stream_name, self.__entry_id(entry_id), pix_fmt)
+        with self.__lock:
+            cached = self.__images.get(key)
+            if cached is not None:
+                self.__images.move_to_end(key)
+        self.__count(HITS if cached is not None else MISSES)
+        return cached[0] if cached is not None else None
+
+    def contains(self, stream_name, entry_id, pix_fmt="bgr24"):
+        """
+        True if image is cached, doesn't count as a lookup nor refreshes the image
+        """
+        with self.__lock:
+            return (stream_name, self.__entry_id(entry_id), pix_fmt) in self.__images
+
+    def put(self, stream_name, img, pix_fmt="bgr24"):
+        """
+        Caches image under its entry_id, images not converted yet are cached as they are (converted on first use)
+        """
+        if img is None or img.entry_id is None:
+            return
+        # size of an image changes from the estimate once converted, the one at caching time is accounted
+        nbytes = img.nbytes
+        if nbytes > self.max_bytes:
+            return
+        key = (stream_name, self.__entry_id(img.entry_id), pix_fmt)
+        evicted = 0
+        with self.__lock:
+            previous = self.__images.pop(key, None)
+            if previous is not None:
+                self.__bytes -= previous[1]
+            self.__images[key] = (img, nbytes)
+            self.__bytes += nbytes
+            while self.__bytes > self.max_bytes:
+                _, (_, oldest_bytes) = self.__images.popitem(last=False)
+                self.__bytes -= oldest_bytes
+                evicted += 1
+        if evicted > 0:
+            self.__count(EVICTIONS, evicted)
+
+    def stats(self):
+        """
+        Returns
+        -------
+        Dictionary with hits, misses, evictions, number of cached images and their size in bytes
+        """
+        with self.__counters.get_lock():
+            hits, misses, evictions = self.__counters[:]
+        with self.__lock:
+            return {"hits": hits, "misses": misses, "evictions": evictions, "images": len(self.__images), "bytes": self.__bytes}
+
+    def clear(self):
+        with self.__lock:
+            self.__images.clear()
+            self.__bytes = 0
+
+    def __count(self, counter, value=1):
+        with self.__counters.get_lock():
+            self.__counters[counter] += value
+
+    def __entry_id(self, entry_id):
+        if isinstance(entry_id, bytes):
+            return entry_id.decode('utf-8')
+        return entry_id
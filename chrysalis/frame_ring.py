@@ -0,0 +1,186 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing as mp
+from multiprocessing import resource_tracker, shared_memory
+import numpy
+from .models import ChImage
+
+# per slot metadata: generation, timestamp, width, height, nbytes, frame type, shape (3), entry ID sequence
+META_FIELDS = 10
+# nbytes markers
+END_OF_STREAM = -1
+OVERSIZED = -2
+
+FRAME_TYPES = (None, "NONE", "I", "P", "B", "S", "SI", "SP", "BI")
+
+class SharedFrameRing:
+    """
+    Ring of preallocated frame slots in shared memory, handing decoded images from a producer process to a consumer.
+
+    Frame pixels are copied once into a free slot instead of being pickled through a pipe. Producer and
+    consumer wait on semaphores (free and filled slots), so there's no sleep polling on either side.
+    Every slot is tagged with a generation, slots of an older generation (e.g. before a seek) are skipped by the consumer.
+
+    Shared memory is allocated by the producer when the first frame is put, slots are the size of that frame
+    (output pixel format and size), the consumer attaches to it on the first frame read.
+
+    Attributes
+    ----------
+    slots : int
+        number of frames buffered between the processes
+    max_slot_bytes : int
+        largest slot allocated, frames larger than a slot (also after a change of the stream resolution)
+        fall back to a regular multiprocessing queue. None doesn't limit slot size
+    pix_fmt : string
+        pixel format of the frames
+    """
+
+    def __init__(self, slots=10, max_slot_bytes=None, pix_fmt="bgr24"):
+        self.slots = slots
+        self.max_slot_bytes = max_slot_bytes
+        self.pix_fmt = pix_fmt
+        # producer and consumer share one resource tracker, a segment created by the producer
+        # isn't removed when the producer process ends
+        resource_tracker.ensure_running()
+        self.__shm = None
+        self.__shm_name = mp.Array('c', 64, lock=False)
+        self.__slot_bytes = mp.Value('q', 0, lock=False)
+        self.__meta = mp.Array('q', slots * META_FIELDS, lock=False)
+        self.__free = mp.Semaphore(slots)
+        self.__filled = mp.Semaphore(0)
+        self.__overflow = mp.Queue()
+        # each side only ever touches its own index
+        self.__write_idx = 0
+        self.__read_idx = 0
+
+    def put(self, img, generation, stop):
+        """
+        Copies image into the next free slot, None marks the end of the stream.
+        Blocks while the ring is full.
+
+        Returns
+        -------
+        False if stop event was set while waiting for a free slot
+        """
+        while not self.__free.acquire(timeout=0.5):
+            if stop.is_set():
+                return False
+
+        idx = self.__write_idx
+        self.__write_idx = (idx + 1) % self.slots
+        meta = idx * META_FIELDS
+        self.__meta[meta] = generation
+        if img is None:
+            self.__meta[meta + 4] = END_OF_STREAM
+        elif img.planes is not None or not self.__allocated(img.data.nbytes) or img.data.nbytes > self.__slot_bytes.value:
+            # plane views of a decoded frame are pickled, so are frames too large for a slot
+            self.__meta[meta + 4] = OVERSIZED
+            self.__overflow.put(img)
+        else:
+            data = img.data
+            self.__meta[meta + 1] = img.timestamp
+            self.__meta[meta + 2] = img.width
+            self.__meta[meta + 3] = img.height
+            self.__meta[meta + 4] = data.nbytes
+            self.__meta[meta + 5] = FRAME_TYPES.index(img.frame_type) if img.frame_type in FRAME_TYPES else 0
+            shape = data.shape + (0,) * (3 - data.ndim)
+            self.__meta[meta + 6:meta + 9] = shape
+            self.__meta[meta + 9] = int(img.entry_id.split("-")[1]) if img.entry_id is not None else -1
+            slot = numpy.ndarray(data.shape, dtype=numpy.uint8, buffer=self.__shm.buf, offset=idx * self.__slot_bytes.value)
+            slot[...] = data
+            del slot
+        self.__filled.release()
+        return True
+
+    def get(self, generation, is_alive=None):
+        """
+        Next image of the given generation, blocks until the producer fills a slot.
+
+        Attributes
+        ----------
+        generation : int
+            current generation, slots of other generations are dropped
+        is_alive : callable
+            checked while waiting, stops waiting when it returns False (e.g. producer process died)
+
+        Returns
+        -------
+        ChImage or None at the end of the stream
+        """
+        while True:
+            while not self.__filled.acquire(timeout=0.5):
+                if is_alive is not None and not is_alive():
+                    return None
+
+            idx = self.__read_idx
+            self.__read_idx = (idx + 1) % self.slots
+            meta = idx * META_FIELDS
+            slot_generation = self.__meta[meta]
+            nbytes = self.__meta[meta + 4]
+            img = None
+            if nbytes == OVERSIZED:
+                img = self.__overflow.get()
+            elif nbytes >= 0 and slot_generation == generation:
+                shape = tuple(d for d in self.__meta[meta + 6:meta + 9] if d > 0)
+                self.__attach()
+                slot = numpy.ndarray(shape, dtype=numpy.uint8, buffer=self.__shm.buf, offset=idx * self.__slot_bytes.value)
+                data = slot.copy()
+                del slot
+                timestamp = self.__meta[meta + 1]
+                entry_id = str(timestamp) + "-" + str(self.__meta[meta + 9]) if self.__meta[meta + 9] >= 0 else None
+                img = ChImage(data=data, width=self.__meta[meta + 2], height=self.__meta[meta + 3], timestamp=timestamp, frame_type=FRAME_TYPES[self.__meta[meta + 5]], entry_id=entry_id, pix_fmt=self.pix_fmt)
+            self.__free.release()
+
+            if slot_generation != generation:
+                continue
+            return img
+
+    @property
+    def slot_bytes(self):
+        """
+        Size of a slot, 0 until the first frame was put
+        """
+        return self.__slot_bytes.value
+
+    def close(self, unlink=False):
+        if unlink:
+            # consumer removes the segment, also if it never read a frame
+            self.__attach()
+        if self.__shm is not None:
+            self.__shm.close()
+            if unlink:
+                self.__shm.unlink()
+            self.__shm = None
+
+    def __allocated(self, nbytes):
+        """
+        Allocates slots of nbytes on the first frame (producer side)
+
+        Returns
+        -------
+        False if there's no shared memory, frames go through the queue
+        """
+        if self.__shm is not None:
+            return True
+        if self.__slot_bytes.value > 0 or (self.max_slot_bytes is not None and nbytes > self.max_slot_bytes):
+            return False
+        self.__shm = shared_memory.SharedMemory(create=True, size=self.slots * nbytes)
+        self.__shm_name.value = self.__shm.name.encode("utf-8")
+        self.__slot_bytes.value = nbytes
+        return True
+
+    def __attach(self):
+        if self.__shm is None and self.__slot_bytes.value > 0:
+            self.__shm = shared_memory.SharedMemory(name=self.__shm_name.value.decode("utf-8"))
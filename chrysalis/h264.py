@@ -0,0 +1,255 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# H.264 NAL unit types we care about (ITU-T H.264 table 7-1)
+NAL_SLICE = 1
+NAL_IDR_SLICE = 5
+NAL_SPS = 7
+
+# slice_type modulo 5 (ITU-T H.264 table 7-6)
+SLICE_B = 1
+
+START_CODE = b"\x00\x00\x01"
+
+# slice header fields read here fit in this many bytes of a slice NAL unit
+SLICE_HEADER_BYTES = 32
+
+# profiles with chroma format, bit depth and scaling matrices in their SPS (ITU-T H.264 7.3.2.1.1)
+HIGH_PROFILES = (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135)
+
+def nal_headers(payload):
+    """
+    Walks Annex B start codes of a raw H.264 packet without decoding it
+
+    Returns
+    -------
+    Generator of (nal_ref_idc, nal_unit_type) tuples
+    """
+    if not payload:
+        return
+    if not isinstance(payload, bytes):
+        payload = bytes(payload)
+    size = len(payload)
+    # 00 00 01 also matches the tail of a 4 byte 00 00 00 01 start code
+    pos = payload.find(START_CODE)
+    while pos != -1 and pos + 3 < size:
+        header = payload[pos + 3]
+        yield (header >> 5) & 0x03, header & 0x1f
+        pos = payload.find(START_CODE, pos + 3)
+
+def is_keyframe(payload):
+    """
+    True if packet contains an IDR slice (decoding can start from this packet)
+    """
+    for _, nal_type in nal_headers(payload):
+        if nal_type == NAL_IDR_SLICE:
+            return True
+        if nal_type == NAL_SLICE:
+            return False
+    return False
+
+def is_disposable(payload):
+    """
+    True if packet holds only slices no other frame references (nal_ref_idc == 0).
+    Such packets can be dropped before decode without breaking the decoder state.
+    """
+    for ref_idc, nal_type in nal_headers(payload):
+        if nal_type == NAL_SLICE or nal_type == NAL_IDR_SLICE:
+            return ref_idc == 0
+    return False
+
+def first_nal(payload, nal_types, limit=None):
+    """
+    First NAL unit of one of nal_types in the packet, from its header byte on (at most limit bytes of it),
+    with emulation prevention bytes removed
+
+    Returns
+    -------
+    bytes or None if the packet has no such NAL unit
+    """
+    if not payload:
+        return None
+    if not isinstance(payload, bytes):
+        payload = bytes(payload)
+    pos = payload.find(START_CODE)
+    while pos != -1 and pos + 3 < len(payload):
+        if payload[pos + 3] & 0x1f in nal_types:
+            end = payload.find(START_CODE, pos + 3)
+            if end == -1:
+                end = len(payload)
+            if limit is not None:
+                end = min(end, pos + 3 + limit)
+            return payload[pos + 3:end].replace(b"\x00\x00\x03", b"\x00\x00")
+        pos = payload.find(START_CODE, pos + 3)
+    return None
+
+class BitReader:
+    """
+    Reads fixed length (u) and Exp-Golomb coded (ue, se) fields, IndexError past the end of data
+    """
+
+    def __init__(self, data):
+        self.__data = data
+        self.__pos = 0
+
+    def u(self, bits):
+        value = 0
+        for _ in range(bits):
+            value = (value << 1) | ((self.__data[self.__pos >> 3] >> (7 - (self.__pos & 7))) & 1)
+            self.__pos += 1
+        return value
+
+    def ue(self):
+        zeros = 0
+        while self.u(1) == 0:
+            zeros += 1
+            if zeros > 31:
+                raise ValueError("invalid Exp-Golomb code")
+        return (1 << zeros) - 1 + self.u(zeros)
+
+    def se(self):
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+def slice_type(payload):
+    """
+    Reads slice_type from the header of the first slice in the packet
+
+    Returns
+    -------
+    slice_type modulo 5 (0 P, 1 B, 2 I, 3 SP, 4 SI), None if the packet holds no slice
+    """
+    nal = first_nal(payload, (NAL_SLICE, NAL_IDR_SLICE), limit=SLICE_HEADER_BYTES)
+    if nal is None:
+        return None
+    bits = BitReader(nal[1:])
+    try:
+        # first_mb_in_slice, slice_type
+        bits.ue()
+        return bits.ue() % 5
+    except (IndexError, ValueError):
+        return None
+
+def poc_parameters(payload):
+    """
+    Fields of the packet's sequence parameter set (SPS) needed to read picture order counts of slices
+
+    Returns
+    -------
+    (log2_max_frame_num, log2_max_pic_order_cnt_lsb, frame_mbs_only_flag, separate_colour_plane_flag),
+    None if the packet has no SPS or pictures aren't ordered by pic_order_cnt_lsb (pic_order_cnt_type 1 or 2)
+    """
+    nal = first_nal(payload, (NAL_SPS,))
+    if nal is None:
+        return None
+    bits = BitReader(nal[1:])
+    try:
+        profile_idc = bits.u(8)
+        # constraint flags and level_idc, seq_parameter_set_id
+        bits.u(16)
+        bits.ue()
+        separate_colour_plane = 0
+        if profile_idc in HIGH_PROFILES:
+            chroma_format_idc = bits.ue()
+            if chroma_format_idc == 3:
+                separate_colour_plane = bits.u(1)
+            # bit depths, qpprime_y_zero_transform_bypass_flag
+            bits.ue()
+            bits.ue()
+            bits.u(1)
+            if bits.u(1):
+                for idx in range(8 if chroma_format_idc != 3 else 12):
+                    if bits.u(1):
+                        last_scale = next_scale = 8
+                        for _ in range(16 if idx < 6 else 64):
+                            if next_scale != 0:
+                                next_scale = (last_scale + bits.se() + 256) % 256
+                            last_scale = next_scale if next_scale != 0 else last_scale
+        log2_max_frame_num = bits.ue() + 4
+        if bits.ue() != 0:
+            return None
+        log2_max_poc_lsb = bits.ue() + 4
+        # max_num_ref_frames, gaps_in_frame_num_value_allowed_flag, picture size in macroblocks
+        bits.ue()
+        bits.u(1)
+        bits.ue()
+        bits.ue()
+        frame_mbs_only = bits.u(1)
+    except (IndexError, ValueError):
+        return None
+    return log2_max_frame_num, log2_max_poc_lsb, frame_mbs_only, separate_colour_plane
+
+def pic_order_cnt_lsb(payload, parameters):
+    """
+    Reads pic_order_cnt_lsb from the header of the first slice in the packet
+
+    Attributes
+    ----------
+    parameters : tuple
+        poc_parameters of the stream's SPS
+
+    Returns
+    -------
+    int, None if the packet holds no slice or a field (interlaced) slice
+    """
+    nal = first_nal(payload, (NAL_SLICE, NAL_IDR_SLICE), limit=SLICE_HEADER_BYTES)
+    if nal is None:
+        return None
+    log2_max_frame_num, log2_max_poc_lsb, frame_mbs_only, separate_colour_plane = parameters
+    bits = BitReader(nal[1:])
+    try:
+        # first_mb_in_slice, slice_type, pic_parameter_set_id
+        bits.ue()
+        bits.ue()
+        bits.ue()
+        if separate_colour_plane:
+            bits.u(2)
+        bits.u(log2_max_frame_num)
+        if not frame_mbs_only and bits.u(1):
+            return None
+        if nal[0] & 0x1f == NAL_IDR_SLICE:
+            # idr_pic_id
+            bits.ue()
+        return bits.u(log2_max_poc_lsb)
+    except (IndexError, ValueError):
+        return None
+
+def is_bidirectional(payload):
+    """
+    True if packet holds a B slice. Streams with B frames output frames in a different order than
+    they are decoded in, so which packets get dropped changes how frames pair with entries.
+    """
+    return slice_type(payload) == SLICE_B
+
+def reorders(payloads):
+    """
+    True if any of the packets holds a B slice
+    """
+    for payload in payloads:
+        if is_bidirectional(payload):
+            return True
+    return False
+
+def last_keyframe_index(payloads):
+    """
+    Index of the last packet decoding can start from
+
+    Returns
+    -------
+    Index into payloads, 0 if no keyframe was found
+    """
+    for idx in range(len(payloads) - 1, -1, -1):
+        if is_keyframe(payloads[idx]):
+            return idx
+    return 0
@@ -0,0 +1,229 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import queue
+import threading
+import time
+import redis
+from .log import logger
+from .seek import next_id, MAX_SEQUENCE
+
+# weight of the newest measurement in moving averages
+EWMA_WEIGHT = 0.3
+
+def id_tuple(entry_id):
+    """
+    (milliseconds, sequence) of a stream ID, comparable
+    """
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode('utf-8')
+    if "-" not in entry_id:
+        return (int(entry_id), 0)
+    ms, seq = entry_id.split("-")
+    return (int(ms), int(seq))
+
+class HistoryReader:
+    """
+    Reads a video stream forward in a background thread, ahead of the decoder.
+
+    While the stream holds more entries than read so far, `depth` XRANGE queries over consecutive time
+    windows are sent in a single pipeline (entries up to the newest stream ID can't change anymore).
+    Once caught up with the stream, new entries are awaited with a blocking XREAD.
+
+    Batch size follows the measured round trip time and the rate the consumer takes entries at, so one
+    round trip brings in what the consumer gets through in two. It doubles whenever the consumer had
+    to wait for a batch. Up to `depth` batches are queued, then the reader waits for the consumer.
+
+    Attributes
+    ----------
+    query : string
+        stream ID to read after
+    until_timestamp : int
+        reading stops after the first entry at or after this timestamp (in ms)
+    depth : int
+        number of pipelined queries and queued batches
+    min_count, max_count : int
+        bounds of entries per batch
+    metrics : Metrics
+        records the number of queued batches, None measures nothing
+    """
+
+    def __init__(self, redis_conn, stream_name, query, until_timestamp, depth=4, min_count=10, max_count=1000, metrics=None):
+        self.__redis_conn = redis_conn
+        self.__metrics = metrics
+        self.__stream_name = stream_name
+        self.__cursor = id_tuple(query)
+        self.__until_timestamp = until_timestamp
+        self.__depth = depth
+        self.__min_count = min_count
+        self.__max_count = max_count
+        self.count = min_count
+
+        self.__batches = queue.Queue(maxsize=depth)
+        self.__stopped = threading.Event()
+        self.__thread = None
+        # moving averages: round trip in seconds, consumer rate in entries per second, entries per ms of stream
+        self.__rtt = None
+        self.__rate = None
+        self.__density = None
+        self.__starved = False
+        self.__last_get = None
+        self.__last_batch_size = 0
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, name="chrysalis-history-reader", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout=2)
+
+    def get(self, timeout=1):
+        """
+        Next batch of entries in stream order
+
+        Returns
+        -------
+        List of (stream ID, fields), empty if nothing was read within timeout, None when until_timestamp was reached
+        """
+        now = time.monotonic()
+        if self.__last_get is not None and self.__last_batch_size > 0 and now > self.__last_get:
+            # time the consumer spent on the previous batch
+            self.__rate = self.__average(self.__rate, self.__last_batch_size / (now - self.__last_get))
+        if self.__batches.empty():
+            self.__starved = True
+        try:
+            batch = self.__batches.get(timeout=timeout)
+        except queue.Empty:
+            batch = []
+        self.__last_get = time.monotonic()
+        self.__last_batch_size = len(batch) if batch is not None else 0
+        return batch
+
+    def __run(self):
+        tail = None
+        behind = True
+        try:
+            while not self.__stopped.is_set() and self.__cursor[0] < self.__until_timestamp:
+                if behind:
+                    tail = self.__tail()
+                if tail is not None and self.__cursor < tail:
+                    batches = self.__read_windows(tail)
+                else:
+                    batches = self.__read_new()
+                    # a full batch means the stream got ahead of us again
+                    behind = len(batches) > 0 and len(batches[0]) >= self.count
+                for batch in batches:
+                    if not self.__put(batch):
+                        return
+                self.__adapt()
+        except redis.RedisError as ex:
+            logger.error("history reader failed reading " + self.__stream_name + ": " + str(ex))
+        except Exception as ex:
+            logger.error("history reader of " + self.__stream_name + " failed: " + repr(ex), exc_info=True)
+        finally:
+            # the consumer always learns the reading ended
+            self.__put(None)
+
+    def __tail(self):
+        entries = self.__redis_conn.xrevrange(self.__stream_name, max="+", min="-", count=1)
+        if len(entries) == 0:
+            return None
+        return id_tuple(entries[0][0])
+
+    def __read_new(self):
+        started = time.monotonic()
+        cursor = str(self.__cursor[0]) + "-" + str(self.__cursor[1])
+        buffer = self.__redis_conn.xread({self.__stream_name:cursor}, block=1000, count=self.count)
+        if len(buffer) == 0:
+            return []
+        self.__rtt = self.__average(self.__rtt, time.monotonic() - started)
+        batch = buffer[0][1]
+        self.__cursor = id_tuple(batch[-1][0])
+        return [batch]
+
+    def __read_windows(self, tail):
+        """
+        Pipelined XRANGE over up to depth time windows of about count entries each, never past tail
+        nor until_timestamp
+        """
+        window_ms = 1 if self.__density is None else max(1, int(self.count / self.__density))
+        windows = 1 if self.__density is None else self.__depth
+        start_ms = self.__cursor[0]
+        range_min = next_id(str(self.__cursor[0]) + "-" + str(self.__cursor[1]))
+        limit = min(tail, (self.__until_timestamp, MAX_SEQUENCE))
+        ends = []
+        pipe = self.__redis_conn.pipeline(transaction=False)
+        for i in range(windows):
+            end = (start_ms + window_ms * (i + 1), MAX_SEQUENCE)
+            if self.__density is None or end >= limit:
+                end = limit
+            range_max = str(end[0]) + "-" + str(end[1])
+            # first window without density known yet is bounded by count only
+            count = self.count if self.__density is None else self.__max_count
+            pipe.xrange(self.__stream_name, min=range_min, max=range_max, count=count)
+            ends.append((end, count))
+            if end == limit:
+                break
+            range_min = str(end[0] + 1) + "-0"
+
+        started = time.monotonic()
+        replies = pipe.execute()
+        self.__rtt = self.__average(self.__rtt, time.monotonic() - started)
+
+        batches = []
+        read_from = self.__cursor
+        for (end, count), entries in zip(ends, replies):
+            if len(entries) >= count:
+                # window cut short by count, continue after its last entry (later windows are read again)
+                self.__cursor = id_tuple(entries[-1][0])
+                batches.append(entries)
+                break
+            self.__cursor = end
+            if len(entries) > 0:
+                batches.append(entries)
+
+        read_ms = self.__cursor[0] - read_from[0]
+        entries_read = sum(len(batch) for batch in batches)
+        if read_ms > 0 and entries_read > 0:
+            self.__density = self.__average(self.__density, entries_read / read_ms)
+        return batches
+
+    def __put(self, batch):
+        while not self.__stopped.is_set():
+            try:
+                self.__batches.put(batch, timeout=0.5)
+                if self.__metrics is not None:
+                    self.__metrics.set("queue_depth", self.__batches.qsize(), stream=self.__stream_name, queue="history_reader")
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __adapt(self):
+        count = self.count
+        if self.__rtt is not None and self.__rate is not None:
+            # entries the consumer takes during two round trips, spread over pipelined windows
+            count = math.ceil(2 * self.__rate * self.__rtt / self.__depth)
+        if self.__starved:
+            count = max(count, self.count * 2)
+            self.__starved = False
+        self.count = max(self.__min_count, min(self.__max_count, count))
+
+    def __average(self, average, value):
+        if average is None:
+            return value
+        return average + EWMA_WEIGHT * (value - average)
@@ -0,0 +1,181 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import weakref
+from .chunker import Chunker
+from .decoder import create_decoder
+from .history_reader import HistoryReader, id_tuple
+from .sampling import sampled_images
+from .seek import keyframe_before, drop_disposable_before, reorder_tail, entry_timestamp
+
+# a resumed session decodes from a keyframe at least this long before the checkpoint (more than any
+# reordering delay), so frames after it are paired with the same entries as in an uninterrupted playback
+RESUME_WARMUP_MS = 1000
+
+class HistorySession:
+    """
+    History playback between two timestamps (in ms) with its own cursor, decoder and read-ahead buffer.
+
+    Stream entries are read ahead in a background thread, frames are decoded in the thread calling next.
+    Sessions don't depend on each other (nor on VideoPastImage), many of them can play at once over the
+    shared connection pool and a single session can be consumed from many threads. There's no limit on
+    how slowly a session is consumed, reading ahead pauses while the buffer is full.
+
+    The position of a session is the entry ID of the last returned frame, a session opened with that
+    checkpoint as resume_from continues with the next frame.
+
+    Attributes
+    ----------
+    resume_from : string
+        checkpoint (stream entry ID) of an earlier session over the same range, frames up to it are skipped
+    sampling : Sampling
+        frames to return, None returns all
+    read_ahead : int
+        number of batches of stream entries read ahead
+    thread_type, thread_count :
+        decoder threading, see create_decoder
+    metrics : Metrics
+        records reads, decoding and queue depth, None measures nothing
+    """
+
+    def __init__(self, redis_conn, stream_name, fromtimestamp, totimestamp, resume_from=None, pix_fmt="bgr24", size=None, sampling=None, read_ahead=4, thread_type="SLICE", thread_count=0, metrics=None):
+        self.__redis_conn = redis_conn
+        self.stream_name = stream_name
+        self.fromtimestamp = fromtimestamp
+        self.totimestamp = totimestamp
+        self.__sampling = sampling
+        self.__read_ahead = read_ahead
+        self.__metrics = metrics
+        self.__chunker = Chunker(codec=create_decoder(thread_type=thread_type, thread_count=thread_count), pix_fmt=pix_fmt, size=size, metrics=metrics, stream_name=stream_name)
+        if isinstance(resume_from, bytes):
+            resume_from = resume_from.decode("utf-8")
+        self.__position = resume_from
+        self.__lock = threading.Lock()
+        self.__closed = threading.Event()
+        self.__stop_reader = None
+        self.__images = self.__play()
+        self.__ended = False
+
+    def next(self):
+        """
+        Next frame, blocks until it's decoded
+
+        Returns
+        -------
+        ChImage or None at the end of the range (or once closed)
+        """
+        with self.__lock:
+            if self.__ended:
+                return None
+            img = next(self.__images, None)
+            if img is None:
+                self.__close()
+                return None
+            self.__position = img.entry_id
+            return img
+
+    def checkpoint(self):
+        """
+        Returns
+        -------
+        Entry ID of the last returned frame (resume_from of a session continuing after it),
+        resume_from of this session if no frame was returned yet
+        """
+        with self.__lock:
+            return self.__position
+
+    @property
+    def ended(self):
+        """
+        True once the end of the range was reached or the session was closed
+        """
+        return self.__ended
+
+    def close(self):
+        """
+        Stops reading ahead, next returns None from now on
+        """
+        self.__closed.set()
+        # a next call waiting for entries in another thread returns
+        if self.__stop_reader is not None:
+            self.__stop_reader()
+        with self.__lock:
+            self.__close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        img = self.next()
+        if img is None:
+            raise StopIteration
+        return img
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __close(self):
+        self.__ended = True
+        self.__images.close()
+        if self.__stop_reader is not None:
+            self.__stop_reader()
+
+    def __play(self):
+        emit_from = self.fromtimestamp
+        decode_from = emit_from
+        skip_until = None
+        if self.__position is not None:
+            skip_until = id_tuple(self.__position)
+            emit_from = max(emit_from, skip_until[0])
+            # close to fromtimestamp the decoder is fed exactly as in the session the checkpoint comes from
+            decode_from = max(self.fromtimestamp, emit_from - RESUME_WARMUP_MS)
+
+        # start decoding from the closest keyframe so the first frame emitted is the one at emit_from
+        query = keyframe_before(self.__redis_conn, self.stream_name, decode_from)
+        if query is None:
+            query = str(decode_from)
+        reader = HistoryReader(self.__redis_conn, self.stream_name, query, self.totimestamp, depth=self.__read_ahead, metrics=self.__metrics)
+        # an abandoned session stops its reader when garbage collected
+        self.__stop_reader = weakref.finalize(self, reader.stop)
+        reader.start()
+
+        synced = True
+        end_reached = False
+        last_batch = []
+        while not self.__closed.is_set() and not end_reached:
+            batch = reader.get()
+            if batch is None:
+                # frames the decoder holds back are drained at the end of the range
+                end_reached = True
+                batch = reorder_tail(self.__redis_conn, self.stream_name, last_batch, self.__chunker.codec.has_b_frames)
+            elif len(batch) == 0:
+                continue
+            else:
+                last_batch = batch
+                if entry_timestamp(batch[0][0]) < decode_from:
+                    batch = drop_disposable_before(batch, decode_from)
+            if self.__sampling is not None:
+                images, synced = sampled_images(self.__chunker, batch, self.__sampling, synced, self.__redis_conn, self.stream_name, from_timestamp=emit_from, flush=end_reached)
+            else:
+                images = self.__chunker.images(batch, from_timestamp=emit_from, flush=end_reached)
+            for img in images:
+                if img.timestamp > self.totimestamp:
+                    return
+                if skip_until is not None and id_tuple(img.entry_id) <= skip_until:
+                    continue
+                yield img
@@ -0,0 +1,297 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import threading
+import time
+from .h264 import is_keyframe
+from .seek import entry_timestamp, next_id
+from .screenshot import merge_ranges
+
+# seconds between checks for keyframes trimmed from the stream
+EVICT_INTERVAL = 60
+
+class KeyframeIndex:
+    """
+    In-process index of keyframes in the video stream (timestamp -> stream entry ID).
+
+    Keyframes are found by parsing NAL headers of the packets, nothing is decoded. The index is maintained
+    incrementally over the time ranges asked for: every update only scans the parts of the ranges that
+    aren't covered yet, so no more of the stream is fetched than the searched ranges. Keyframes trimmed
+    from the stream are evicted.
+
+    redis_conn is only used by update, asyncio clients pass None and run queue_update and update_from
+    on their own pipeline.
+    """
+
+    def __init__(self, redis_conn, stream_name, scan_count=500, evict_interval=EVICT_INTERVAL):
+        self.__redis_conn = redis_conn
+        self.__stream_name = stream_name
+        self.__scan_count = scan_count
+        self.__evict_interval = evict_interval
+        self.__lock = threading.Lock()
+        # sorted keyframe timestamps (ms) and matching stream entry IDs
+        self.__timestamps = []
+        self.__ids = []
+        # covered parts of the stream, sorted non overlapping [from, to] timestamps (ms)
+        self.__covered = []
+        self.__last_evict = None
+
+    def __len__(self):
+        return len(self.__timestamps)
+
+    def update(self, ranges):
+        """
+        Makes sure the index covers the (from, to) time ranges (in ms)
+        """
+        pipe = self.__redis_conn.pipeline(transaction=False)
+        pending = self.queue_update(pipe, ranges)
+        while pending is not None:
+            pending = self.update_from(pending, pipe.execute(), pipe)
+
+    def queue_update(self, pipe, ranges):
+        """
+        Adds the reads update needs to a redis pipeline (sync or asyncio), replies are passed to update_from.
+        The first page of every uncovered part of the ranges (and the oldest entry of the stream) is read
+        in a single round trip.
+
+        Returns
+        -------
+        Pending update, None if the index covers the ranges already
+        """
+        with self.__lock:
+            gaps = []
+            for lo, hi in merge_ranges(ranges):
+                gaps.extend(self.__gaps(lo, hi))
+            now = time.monotonic()
+            evict = self.__last_evict is None or now - self.__last_evict > self.__evict_interval
+            if len(gaps) == 0 and not evict:
+                return None
+            if evict:
+                self.__last_evict = now
+            scans = [(lo, hi, None) for lo, hi in gaps]
+            self.__queue(pipe, scans)
+            if evict:
+                pipe.xrange(self.__stream_name, min="-", max="+", count=1)
+            return scans, evict
+
+    def update_from(self, pending, replies, pipe):
+        """
+        Applies the pipeline replies of a pending update. Parts longer than a page are read on,
+        their next pages are added to pipe.
+
+        Returns
+        -------
+        Pending update, None when the index is up to date
+        """
+        scans, evict = pending
+        replies = list(replies)
+        with self.__lock:
+            if evict:
+                oldest = replies.pop()
+                if len(oldest) > 0:
+                    self.__evict_until(entry_timestamp(oldest[0][0]) - 1)
+            more = []
+            for (lo, hi, last), entries in zip(scans, replies):
+                for entry_id, fields in entries:
+                    if is_keyframe(fields.get(b"frame")):
+                        self.__insert(entry_timestamp(entry_id), entry_id)
+                if len(entries) > 0:
+                    last = entries[-1][0]
+                if len(entries) >= self.__scan_count:
+                    more.append((lo, hi, last))
+                elif last is not None:
+                    # entries after the newest one may still be added to the stream
+                    self.__cover(lo, min(hi, entry_timestamp(last)))
+            if len(more) == 0:
+                return None
+            self.__queue(pipe, more)
+            return more, False
+
+    def __queue(self, pipe, scans):
+        # scans are (from, to, last entry ID read or None)
+        for lo, hi, last in scans:
+            pipe.xrange(self.__stream_name, min=str(lo) if last is None else next_id(last), max=str(hi), count=self.__scan_count)
+
+    def __gaps(self, lo, hi):
+        """
+        Parts of [lo, hi] not covered yet
+        """
+        gaps = []
+        for covered_lo, covered_hi in self.__covered:
+            if covered_hi < lo:
+                continue
+            if covered_lo > hi:
+                break
+            if covered_lo > lo:
+                gaps.append((lo, covered_lo - 1))
+            lo = covered_hi + 1
+        if lo <= hi:
+            gaps.append((lo, hi))
+        return gaps
+
+    def __insert(self, timestamp, entry_id):
+        pos = bisect.bisect_left(self.__timestamps, timestamp)
+        while pos < len(self.__timestamps) and self.__timestamps[pos] == timestamp:
+            if self.__ids[pos] == entry_id:
+                return
+            pos += 1
+        self.__timestamps.insert(pos, timestamp)
+        self.__ids.insert(pos, entry_id)
+
+    def __cover(self, lo, hi):
+        covered = []
+        for covered_lo, covered_hi in self.__covered:
+            if covered_hi + 1 < lo or covered_lo > hi + 1:
+                covered.append((covered_lo, covered_hi))
+            else:
+                lo, hi = min(lo, covered_lo), max(hi, covered_hi)
+        covered.append((lo, hi))
+        self.__covered = sorted(covered)
+
+    def nearest(self, timestamp, min_timestamp, max_timestamp):
+        """
+        Keyframe closest to timestamp between min_timestamp and max_timestamp (in ms)
+
+        Returns
+        -------
+        (timestamp, stream entry ID) or None
+        """
+        with self.__lock:
+            lo = bisect.bisect_left(self.__timestamps, min_timestamp)
+            hi = bisect.bisect_right(self.__timestamps, max_timestamp)
+            if lo >= hi:
+                return None
+            pos = bisect.bisect_left(self.__timestamps, timestamp, lo, hi)
+            best = None
+            for idx in (pos - 1, pos):
+                if lo <= idx < hi and (best is None or abs(self.__timestamps[idx] - timestamp) < abs(self.__timestamps[best] - timestamp)):
+                    best = idx
+            return self.__timestamps[best], self.__ids[best]
+
+    def at_or_before(self, timestamp):
+        """
+        Newest keyframe at or before timestamp (in ms)
+
+        Returns
+        -------
+        (timestamp, stream entry ID) or None
+        """
+        with self.__lock:
+            pos = bisect.bisect_right(self.__timestamps, timestamp)
+            if pos == 0:
+                return None
+            return self.__timestamps[pos - 1], self.__ids[pos - 1]
+
+    def evict_until(self, timestamp):
+        """
+        Removes keyframes at or before timestamp (in ms), e.g. when they were trimmed from the stream
+        """
+        with self.__lock:
+            self.__evict_until(timestamp)
+
+    def __evict_until(self, timestamp):
+        pos = bisect.bisect_right(self.__timestamps, timestamp)
+        del self.__timestamps[:pos]
+        del self.__ids[:pos]
+        # nothing is ever added to the stream before its oldest entry, that part stays covered
+        self.__cover(0, timestamp)
+
+class KeyframeLookup:
+    """
+    Screenshots at many times from a KeyframeIndex (see chrysalis.Connect.Screenshots): the keyframe closest to
+    every requested time is looked up and fetched once, no matter how many of the requests it serves.
+    Keyframes trimmed from the stream in the meantime are evicted and looked up again. Reads and decoding
+    are left to the caller, so sync and asyncio clients share it:
+
+        lookup = KeyframeLookup(index, stream_name, timestamps, ranges)
+        while lookup.queue(pipe):
+            for keyframe, entries in lookup.fetched(pipe.execute()):
+                lookup.resolve(keyframe, decode_keyframe(entries, keyframe[0]))
+        images = lookup.results
+
+    Attributes
+    ----------
+    timestamps : list
+        requested times (in ms)
+    ranges : list
+        (from, to) time range (in ms) to look for a keyframe in, one per requested time
+    cached : function
+        image of a keyframe stream entry ID or None, e.g. from a frame cache (default None, nothing cached)
+    """
+
+    def __init__(self, index, stream_name, timestamps, ranges, cached=None):
+        self.__index = index
+        self.__stream_name = stream_name
+        self.__timestamps = timestamps
+        self.__ranges = ranges
+        self.__cached = cached
+        # ChImage or None per request
+        self.results = [None] * len(timestamps)
+        self.__pending = list(range(len(timestamps)))
+        # (timestamp, entry ID) of queued keyframes -> indexes of the requests they serve
+        self.__found = {}
+        self.__keyframes = []
+
+    def queue(self, pipe):
+        """
+        Adds reads of the keyframes closest to the requests still open to a redis pipeline (sync or asyncio),
+        replies are passed to fetched
+
+        Returns
+        -------
+        False if there's nothing left to read
+        """
+        found = {}
+        for idx in self.__pending:
+            keyframe = self.__index.nearest(self.__timestamps[idx], self.__ranges[idx][0], self.__ranges[idx][1])
+            if keyframe is not None:
+                found.setdefault(keyframe, []).append(idx)
+        self.__pending = []
+        if self.__cached is not None:
+            for keyframe in list(found):
+                img = self.__cached(keyframe[1])
+                if img is not None:
+                    for idx in found.pop(keyframe):
+                        self.results[idx] = img
+        self.__found = found
+        self.__keyframes = sorted(found)
+        for keyframe_ts, keyframe_id in self.__keyframes:
+            pipe.xrange(self.__stream_name, min=keyframe_id, max=keyframe_id)
+        return len(self.__keyframes) > 0
+
+    def fetched(self, replies):
+        """
+        Keyframes read with the pipeline, each one is decoded and passed to resolve
+
+        Returns
+        -------
+        List of ((timestamp, stream entry ID), XRANGE reply entries)
+        """
+        fetched = []
+        for keyframe, entries in zip(self.__keyframes, replies):
+            if len(entries) == 0:
+                # keyframe was trimmed from the stream in the meantime, look again
+                self.__index.evict_until(keyframe[0])
+                self.__pending.extend(self.__found[keyframe])
+                continue
+            fetched.append((keyframe, entries))
+        return fetched
+
+    def resolve(self, keyframe, img):
+        """
+        Sets the decoded keyframe image (or None) as result of the requests it serves
+        """
+        for idx in self.__found[keyframe]:
+            self.results[idx] = img
@@ -0,0 +1,47 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+from .audio_chunker import AudioChunker
+
+class LiveAudio:
+    """
+    Live audio, returns consecutive windows of the audio stream starting from the time of the first request
+    """
+
+    def __init__(self, redis_conn, stream_name, codec=None, sample_rate=16000, channels=1, sample_format="float32", window_ms=1000):
+        self.__redis_conn = redis_conn
+        self.__stream_name = stream_name
+        self.__chunker = AudioChunker(codec=codec, sample_rate=sample_rate, channels=channels, sample_format=sample_format, window_ms=window_ms)
+        self.__chunks = collections.deque()
+        self.__last_query = None
+
+    def get_next_chunk(self):
+        """
+        Returns
+        -------
+        Next ChAudio window or None if it's not complete yet
+        """
+        if len(self.__chunks) == 0:
+            if self.__last_query is None:
+                redis_time = self.__redis_conn.time()
+                self.__last_query = str(int(redis_time[0] + (redis_time[1] / 1000000)) * 1000)
+            buffer = self.__redis_conn.xread({self.__stream_name:self.__last_query}, block=1000)
+            if len(buffer) > 0:
+                inner_buffer = buffer[0][1]
+                self.__last_query = inner_buffer[-1][0]
+                self.__chunks.extend(self.__chunker.chunks(inner_buffer))
+        if len(self.__chunks) > 0:
+            return self.__chunks.popleft()
+        return None
@@ -0,0 +1,162 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import threading
+import redis
+from .sampling import sampled_images
+from .chunker import Chunker, ChImage
+from .log import logger
+from .h264 import last_keyframe_index
+from .decoder import create_decoder
+
+class LiveVideoBuffer:
+    """
+    Background reader of the live video stream.
+
+    A worker thread keeps reading, decoding and converting the live stream into a ring of the last
+    buffer_size ChImage objects, so consumers never wait on redis, the decoder or pixel format conversion.
+    """
+
+    def __init__(self, redis_conn, stream_name, buffer_size=10, codec=None, frame_cache=None, pix_fmt="bgr24", size=None, sampling=None, metrics=None):
+        self.__redis_conn = redis_conn
+        self.__metrics = metrics
+        self.__sampling = sampling
+        self.__frame_cache = frame_cache
+        self.__stream_name = stream_name
+        self.__chunker = Chunker(codec=codec if codec is not None else create_decoder(), pix_fmt=pix_fmt, size=size, metrics=metrics, stream_name=stream_name)
+        # ring of (sequence number, ChImage), sequence numbers increase by one per decoded frame
+        self.__ring = collections.deque(maxlen=buffer_size)
+        self.__condition = threading.Condition()
+        self.__last_seq = 0
+        self.__last_returned_seq = 0
+        # newest sequence number handed to any consumer
+        self.__consumed_seq = 0
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name="chrysalis-live-" + stream_name, daemon=True)
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        with self.__condition:
+            self.__condition.notify_all()
+        if self.__thread.is_alive() and threading.current_thread() is not self.__thread:
+            self.__thread.join()
+
+    def get_latest_image(self):
+        """
+        Newest decoded frame, never blocks
+
+        Returns
+        -------
+        ChImage or None if no new frame was decoded since the previous call
+        """
+        with self.__condition:
+            if len(self.__ring) == 0:
+                return None
+            seq, img = self.__ring[-1]
+            if seq <= self.__last_returned_seq:
+                return None
+            dropped = seq - self.__last_returned_seq - 1
+            self.__last_returned_seq = seq
+            self.__consumed_seq = max(self.__consumed_seq, seq)
+        return self.__with_dropped(img, dropped)
+
+    def frames(self, timeout=None):
+        """
+        Iterates over decoded frames in stream order, blocking until the next frame is decoded.
+        Frames that fell out of the ring before they were consumed are reported in ChImage.dropped_frames.
+
+        Attributes
+        ----------
+        timeout : float
+            seconds to wait for the next frame before the iteration ends (default: wait forever)
+
+        Returns
+        -------
+        Generator of ChImage objects
+        """
+        # new iterators start from the newest frame
+        next_seq = None
+        while not self.__stopped.is_set():
+            with self.__condition:
+                ready = lambda: self.__stopped.is_set() or (len(self.__ring) > 0 and (next_seq is None or self.__last_seq >= next_seq))
+                if not self.__condition.wait_for(ready, timeout=timeout):
+                    return
+                if self.__stopped.is_set():
+                    return
+                if next_seq is None:
+                    next_seq = self.__last_seq
+                oldest_seq = self.__ring[0][0]
+                dropped = max(0, oldest_seq - next_seq)
+                img = self.__ring[max(next_seq, oldest_seq) - oldest_seq][1]
+                next_seq = max(next_seq, oldest_seq) + 1
+                self.__consumed_seq = max(self.__consumed_seq, next_seq - 1)
+            yield self.__with_dropped(img, dropped)
+
+    def __with_dropped(self, img, dropped):
+        if dropped > 0 and self.__metrics is not None:
+            self.__metrics.inc("dropped_frames", dropped, stream=self.__stream_name)
+        # ring images are shared between consumers, so they're never mutated
+        if dropped == 0:
+            return img
+        return img.with_dropped_frames(dropped)
+
+    def __run(self):
+        query_default_past_time = 30*1000
+        last_query = None
+        synced = True
+        while not self.__stopped.is_set():
+            try:
+                if last_query is None:
+                    redis_time = self.__redis_conn.time()
+                    redis_time = int(redis_time[0] + (redis_time[1] / 1000000)) * 1000
+                    last_query = str(redis_time - query_default_past_time)
+                    is_first_batch = True
+
+                buffer = self.__redis_conn.xread({self.__stream_name:last_query}, block=1000)
+                if len(buffer) == 0:
+                    continue
+                inner_buffer = buffer[0][1]
+                last_query = inner_buffer[-1][0]
+                if is_first_batch:
+                    # no point decoding the backlog we started from, only from its newest keyframe on
+                    inner_buffer = inner_buffer[last_keyframe_index([entry[1].get(b"frame") for entry in inner_buffer]):]
+                    is_first_batch = False
+
+                if self.__sampling is not None:
+                    images, synced = sampled_images(self.__chunker, inner_buffer, self.__sampling, synced, self.__redis_conn, self.__stream_name)
+                else:
+                    images = self.__chunker.images(inner_buffer)
+                for chImage in images:
+                    # converted here, consumers get images ready to use
+                    chImage.materialize()
+                    if self.__frame_cache is not None:
+                        self.__frame_cache.put(self.__stream_name, chImage, self.__chunker.output_format)
+                    with self.__condition:
+                        self.__last_seq += 1
+                        self.__ring.append((self.__last_seq, chImage))
+                        depth = min(len(self.__ring), self.__last_seq - self.__consumed_seq)
+                        self.__condition.notify_all()
+                    if self.__metrics is not None:
+                        self.__metrics.set("queue_depth", depth, stream=self.__stream_name, queue="live_buffer")
+            except redis.RedisError as ex:
+                # connection, timeout and server errors alike, reading is retried
+                logger.error("live video buffer failed reading " + self.__stream_name + ": " + str(ex))
+                self.__stopped.wait(1)
+            except Exception as ex:
+                # the rest of the batch is lost, the worker carries on with the next one
+                logger.error("live video buffer failed decoding " + self.__stream_name + ": " + repr(ex), exc_info=True)
@@ -18,7 +18,10 @@ import time
 from .chunker import Chunker, ChImage
 from .log import logger
 from .ch_errors import VideoFailedToStart, VideoHistoryNotFound, InfrequentException
-import av
+from .h264 import is_keyframe, is_disposable, last_keyframe_index, reorders
+from .seek import warmup_entries, entry_timestamp
+from .screenshot import decode_keyframe
+from .decoder import create_decoder
 import numpy
 import datetime
 import operator
@@ -26,46 +29,154 @@ from threading import Lock
 
 class LiveVideoImage:
 
-    def __init__(self, redis_conn, stream_name, codec=av.Codec('h264', 'r').create()):
+    def __init__(self, redis_conn, stream_name, codec=None, frame_cache=None, pix_fmt="bgr24", size=None, sampling=None, metrics=None):
         self.__redis_conn = redis_conn
+        self.__metrics = metrics
+        self.__sampling = sampling
         self.__stream_name = stream_name
-        self.__chunker = Chunker(codec=codec)
+        if codec is None:
+            # every player needs a decoder of its own
+            codec = create_decoder()
+        self.__chunker = Chunker(codec=codec, pix_fmt=pix_fmt, size=size, metrics=metrics, stream_name=stream_name)
         self.__codec = codec
+        self.__frame_cache = frame_cache
+        # set when cached images were returned instead of decoding, decoder needs to restart from a keyframe
+        self.__decoder_stale = False
         # all timestamps in ms
         self.__last_query = None
         self.__last_query_timestamp = 0
-    
+        # frames read from the stream but not returned since the last returned image
+        self.__pending_dropped = 0
+        self.dropped_frames = 0
+
     def get_latest_image(self):
+        redis_time = self.__redis_conn.time()
+        last_query = self.next_query(redis_time)
+
+        # logger.debug("query time from {} to {}".format(self.__last_query, datetime.datetime.fromtimestamp(redis_time/1000.0)))
+        buffer = self.__redis_conn.xread({self.__stream_name:last_query}, block=1000)
+        return self.latest_image(buffer)
+
+    def next_query(self, redis_time):
+        """
+        Stream ID to read the live stream from (no further than 30 seconds in the past)
+
+        Attributes
+        ----------
+        redis_time : tuple
+            reply of the redis TIME command
+
+        Returns
+        -------
+        stream ID or timestamp in ms as string
+        """
         # calculating default from time
         query_default_past_time = 30*1000
-        redis_time = self.__redis_conn.time()
         redis_time = int(redis_time[0] + (redis_time[1] / 1000000)) * 1000
         
         # convert last query timestamp to timestamp
         if abs(self.__last_query_timestamp - redis_time) > query_default_past_time:
             self.__last_query_timestamp = redis_time - query_default_past_time
             self.__last_query = str(self.__last_query_timestamp)
+        return self.__last_query
 
-        # logger.debug("query time from {} to {}".format(self.__last_query, datetime.datetime.fromtimestamp(redis_time/1000.0)))
-        start_time = time.time()
+    def latest_image(self, buffer):
+        """
+        Moves the stream cursor past the XREAD reply and decodes its newest frame
 
-        buffer = self.__redis_conn.xread({self.__stream_name:self.__last_query}, block=1000)
+        Returns
+        -------
+        ChImage or None
+        """
         if len(buffer) > 0:
             arr = buffer[0]
             inner_buffer = arr[1]
-            # logger.debug("returned packets: {} in {} s".format(len(inner_buffer), (time.time() - start_time)))
             last = inner_buffer[-1]
             self.__last_query = last[0]
             self.__last_query_timestamp = int(self.__last_query.decode('utf-8').split("-")[0])
             # logger.debug("stored last_query_timestamp {}".format(self.__last_query))
-            frames = self.__chunker.frames(inner_buffer)
-            if len(frames) > 0:
-                frame = None
-                pair = max(frames.items(), key=operator.itemgetter(0))
-                ts = pair[0]
-                frame = pair[1]
-                d = frame.to_ndarray(format="bgr24")
-                chImage = ChImage(data=d, width=frame.width, height=frame.height, timestamp=ts, frame_type=frame.pict_type.name)
+            self.__pending_dropped += len(inner_buffer)
+            # frames of streams with B frames are paired with entries in presentation order,
+            # packets can't be skipped without shifting the entries of the frames after them
+            reordered = self.__codec.has_b_frames or reorders([entry[1].get(b"frame") for entry in inner_buffer])
+            skipped_references = False
+            emit = None
+            if self.__sampling is not None:
+                selected = [idx for idx, entry in enumerate(inner_buffer) if self.__sampling.selected(entry[0], entry[1].get(b"frame"))]
+                newest = selected[-1] if len(selected) > 0 else -1
+                if reordered and not self.__sampling.keyframes:
+                    # the whole batch is decoded, only frames of selected packets are returned
+                    emit = set(inner_buffer[idx][0].decode('utf-8') for idx in selected)
+                    last = inner_buffer[newest] if newest >= 0 else None
+                else:
+                    # reference frames after the newest selected one aren't decoded now, decoder will have to catch up
+                    skipped_references = any(not is_disposable(entry[1].get(b"frame")) for entry in inner_buffer[newest + 1:])
+                    if newest < 0:
+                        self.__decoder_stale = self.__decoder_stale or skipped_references
+                        return None
+                    inner_buffer = inner_buffer[:newest + 1]
+                    last = inner_buffer[-1]
+            to_decode = self.__packets_to_decode(inner_buffer, reordered)
+            if self.__frame_cache is not None and last is not None:
+                cached = self.__frame_cache.get(self.__stream_name, last[0], self.__chunker.output_format)
+                if cached is not None:
+                    self.__decoder_stale = True
+                    return self.__returned(cached)
+            if self.__sampling is not None and self.__sampling.keyframes:
+                # keyframe decoded on its own, the decoder is reset afterwards
+                self.__decoder_stale = True
+                chImage = decode_keyframe(to_decode, entry_timestamp(last[0]), pix_fmt=self.__chunker.pix_fmt, size=self.__chunker.size, codec=self.__codec, metrics=self.__metrics, stream_name=self.__stream_name)
+                self.__chunker.reset()
+                if chImage is None:
+                    return None
+                if self.__frame_cache is not None:
+                    self.__frame_cache.put(self.__stream_name, chImage, self.__chunker.output_format)
+                return self.__returned(chImage)
+            if reordered and (self.__decoder_stale or to_decode[0] is not inner_buffer[0]):
+                # frames the decoder holds back may miss B frames that were skipped, they would be mislabeled
+                self.__chunker.reset()
+            if self.__decoder_stale and not is_keyframe(to_decode[0][1].get(b"frame")):
+                to_decode = warmup_entries(self.__redis_conn, self.__stream_name, to_decode[0][0]) + to_decode
+            self.__decoder_stale = skipped_references
+
+            latest = None
+            for latest in self.__chunker.frames(to_decode, emit=emit):
+                # only the newest frame is converted into an image
+                pass
+            if latest is not None:
+                entry_id, frame = latest
+                chImage = self.__chunker.image(entry_timestamp(entry_id), frame, entry_id=entry_id)
+                if self.__frame_cache is not None:
+                    self.__frame_cache.put(self.__stream_name, chImage, self.__chunker.output_format)
                 # logger.debug("img width: {}, height: {}, type: {}".format(chImage.width, chImage.height, chImage.frame_type))
-                return chImage
+                return self.__returned(chImage)
         return None
+
+    def __returned(self, img):
+        dropped = self.__pending_dropped - 1
+        self.__pending_dropped = 0
+        self.dropped_frames += dropped
+        if dropped > 0 and self.__metrics is not None:
+            self.__metrics.inc("dropped_frames", dropped, stream=self.__stream_name)
+        # images may be shared through the frame cache, so they're never mutated
+        return img.with_dropped_frames(dropped)
+
+    def __packets_to_decode(self, entries, reordered):
+        """
+        Only the newest frame is returned, so everything before the latest keyframe in the batch
+        and all disposable (non-reference) frames except the newest one are skipped before decode.
+        Streams with B frames (reordered) are decoded whole from the keyframe, their frames are paired with entries in presentation order.
+        Decoder keeps its state between calls, so decode time stays bounded by a single GOP
+        no matter how far behind the consumer is.
+
+        Returns
+        -------
+        List of stream entries worth decoding
+        """
+        payloads = [entry[1].get(b"frame") for entry in entries]
+        last = len(entries) - 1
+        to_decode = []
+        for idx in range(last_keyframe_index(payloads), len(entries)):
+            if idx == last or reordered or not is_disposable(payloads[idx]):
+                to_decode.append(entries[idx])
+        return to_decode
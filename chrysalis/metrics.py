@@ -0,0 +1,288 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing as mp
+import os
+import threading
+import time
+from .log import logger
+from .store import reopen
+
+COUNTER = "counter"
+GAUGE = "gauge"
+SUMMARY = "summary"
+
+# stream commands timed by an instrumented connection, their replies hold stream entries
+READ_COMMANDS = ("xread", "xrange", "xrevrange")
+
+class Metrics:
+    """
+    Registry of SDK measurements in the style of Prometheus: counters, gauges and summaries (count and sum
+    of observed values), every series labeled by stream. Pass it to Connect(metrics=...), nothing is
+    measured without one.
+
+    Measurements made in processes the SDK forks (VideoPastImage playback, parallel history decoding)
+    are forwarded to the registry of the parent process by a background thread.
+
+    Recorded metrics:
+    redis_seconds (summary, stream and command): round trip of stream reads, a blocking XREAD includes waiting for new entries
+    redis_bytes (counter, stream): bytes of entry fields fetched
+    batch_entries (summary, stream): entries per stream read
+    decode_seconds (summary, stream): decoding of a packet
+    convert_seconds (summary, stream): pixel format conversion and scaling of a frame
+    decode_errors (counter, stream): packets the decoder failed on
+    dropped_frames (counter, stream): live frames read but never returned (skipped to return the newest one or fell out of the buffer)
+    queue_depth (gauge, stream and queue): frames (live_buffer) or batches (history_reader) waiting for the consumer
+
+    Attributes
+    ----------
+    namespace : string
+        prefix of metric names in render output
+    """
+
+    def __init__(self, namespace="chrysalis"):
+        self.namespace = namespace
+        self.__lock = threading.Lock()
+        # metric name -> (kind, {labels: value}), summary values are [count, sum]
+        self.__metrics = {}
+        self.__listeners = []
+        self.__owner = os.getpid()
+        self.__forwarded = mp.Queue()
+        self.__forwarding = False
+        self.__drain = threading.Thread(target=self.__drain_forwarded, name="chrysalis-metrics", daemon=True)
+        self.__drain.start()
+
+    def inc(self, name, value=1, **labels):
+        """
+        Adds value to a counter
+        """
+        self.__record(COUNTER, name, value, labels)
+
+    def set(self, name, value, **labels):
+        """
+        Sets a gauge
+        """
+        self.__record(GAUGE, name, value, labels)
+
+    def observe(self, name, value, **labels):
+        """
+        Adds an observation (e.g. duration in seconds) to a summary
+        """
+        self.__record(SUMMARY, name, value, labels)
+
+    def add_listener(self, listener):
+        """
+        Calls listener(kind, name, value, labels) on every measurement, e.g. to feed another metrics library.
+        Listeners are called in the measuring thread (forwarded measurements in the registry's background thread),
+        so they have to be quick.
+        """
+        with self.__lock:
+            # replaced rather than appended to, measurements iterate over it outside the lock
+            self.__listeners = self.__listeners + [listener]
+
+    def value(self, name, **labels):
+        """
+        Returns
+        -------
+        Counter or gauge value, (count, sum) of a summary, None if nothing was recorded
+        """
+        key = self.__labels(labels)
+        with self.__lock:
+            metric = self.__metrics.get(name)
+            if metric is None or key not in metric[1]:
+                return None
+            value = metric[1][key]
+        return tuple(value) if metric[0] == SUMMARY else value
+
+    def snapshot(self):
+        """
+        Returns
+        -------
+        Dictionary of key = metric name, value = dictionary of key = labels (tuple of (label, value) pairs),
+        value = counter or gauge value or (count, sum) of a summary
+        """
+        with self.__lock:
+            return {name: {key: tuple(value) if kind == SUMMARY else value for key, value in series.items()} for name, (kind, series) in self.__metrics.items()}
+
+    def render(self):
+        """
+        Returns
+        -------
+        Metrics in the Prometheus text exposition format, e.g. to serve on a /metrics endpoint
+        """
+        lines = []
+        with self.__lock:
+            for name in sorted(self.__metrics):
+                kind, series = self.__metrics[name]
+                full_name = self.namespace + "_" + name if self.namespace else name
+                lines.append("# TYPE " + full_name + " " + kind)
+                for key in sorted(series):
+                    labels = ",".join(label + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"' for label, value in key)
+                    labels = "{" + labels + "}" if labels else ""
+                    if kind == SUMMARY:
+                        lines.append(full_name + "_count" + labels + " " + repr(series[key][0]))
+                        lines.append(full_name + "_sum" + labels + " " + repr(float(series[key][1])))
+                    else:
+                        lines.append(full_name + labels + " " + repr(series[key]))
+        return "\n".join(lines) + "\n"
+
+    def __record(self, kind, name, value, labels):
+        if os.getpid() != self.__owner:
+            # forked process, the registry lives in the parent
+            if not self.__forwarding:
+                # measurements still queued when the process exits are dropped instead of blocking its exit
+                self.__forwarded.cancel_join_thread()
+                self.__forwarding = True
+            self.__forwarded.put((kind, name, value, labels))
+            return
+        self.__apply(kind, name, value, labels)
+
+    def __apply(self, kind, name, value, labels):
+        key = self.__labels(labels)
+        with self.__lock:
+            metric = self.__metrics.get(name)
+            if metric is None:
+                metric = self.__metrics[name] = (kind, {})
+            elif metric[0] != kind:
+                raise ValueError("metric " + name + " is a " + metric[0] + ", not a " + kind)
+            series = metric[1]
+            if kind == COUNTER:
+                series[key] = series.get(key, 0) + value
+            elif kind == GAUGE:
+                series[key] = value
+            else:
+                observed = series.setdefault(key, [0, 0])
+                observed[0] += 1
+                observed[1] += value
+            listeners = self.__listeners
+        for listener in listeners:
+            listener(kind, name, value, labels)
+
+    def __labels(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def __drain_forwarded(self):
+        while True:
+            kind, name, value, labels = self.__forwarded.get()
+            try:
+                self.__apply(kind, name, value, labels)
+            except Exception as e:
+                logger.warning("failed to record forwarded metric " + str(name) + ": " + str(e))
+
+class InstrumentedConnection:
+    """
+    Redis connection (or stream store) recording stream reads into metrics: redis_seconds,
+    redis_bytes and batch_entries. Pipelines are timed as a whole (command pipeline).
+    Everything else is passed through to the wrapped connection.
+    """
+
+    def __init__(self, redis_conn, metrics):
+        self.redis_conn = redis_conn
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.redis_conn, name)
+
+    def xread(self, streams, *args, **kwargs):
+        started = time.perf_counter()
+        reply = self.redis_conn.xread(streams, *args, **kwargs)
+        elapsed = time.perf_counter() - started
+        for stream_name in streams:
+            self.metrics.observe("redis_seconds", elapsed, stream=stream_label(stream_name), command="xread")
+        for stream_name, entries in reply:
+            record_entries(self.metrics, stream_label(stream_name), entries)
+        return reply
+
+    def xrange(self, name, *args, **kwargs):
+        return self.__timed("xrange", name, args, kwargs)
+
+    def xrevrange(self, name, *args, **kwargs):
+        return self.__timed("xrevrange", name, args, kwargs)
+
+    def pipeline(self, *args, **kwargs):
+        return InstrumentedPipeline(self.redis_conn.pipeline(*args, **kwargs), self.metrics)
+
+    def reopen(self):
+        """
+        (callable, arguments) opening the same connection in another process, instrumented with the same metrics
+        """
+        return _instrumented_connection, (reopen(self.redis_conn), self.metrics)
+
+    def __timed(self, command, name, args, kwargs):
+        started = time.perf_counter()
+        entries = getattr(self.redis_conn, command)(name, *args, **kwargs)
+        stream_name = stream_label(name)
+        self.metrics.observe("redis_seconds", time.perf_counter() - started, stream=stream_name, command=command)
+        record_entries(self.metrics, stream_name, entries)
+        return entries
+
+class InstrumentedPipeline:
+    """
+    Pipeline of an InstrumentedConnection, the round trip is recorded on execute for every stream queued
+    """
+
+    def __init__(self, pipe, metrics):
+        self.__pipe = pipe
+        self.__metrics = metrics
+        # (command, stream name) of every queued command, in reply order
+        self.__queued = []
+
+    def __getattr__(self, name):
+        attr = getattr(self.__pipe, name)
+        if not callable(attr):
+            return attr
+
+        def queued(*args, **kwargs):
+            stream_name = args[0] if len(args) > 0 else kwargs.get("name", kwargs.get("streams"))
+            self.__queued.append((name, stream_name))
+            attr(*args, **kwargs)
+            return self
+        return queued
+
+    def execute(self, *args, **kwargs):
+        queued = self.__queued
+        self.__queued = []
+        started = time.perf_counter()
+        replies = self.__pipe.execute(*args, **kwargs)
+        elapsed = time.perf_counter() - started
+        stream_names = set()
+        for (command, name), reply in zip(queued, replies):
+            names = list(name) if isinstance(name, dict) else [name]
+            stream_names.update(stream_label(n) for n in names if n is not None)
+            if command not in READ_COMMANDS or isinstance(reply, Exception):
+                continue
+            if command == "xread":
+                for stream_name, entries in reply:
+                    record_entries(self.__metrics, stream_label(stream_name), entries)
+            else:
+                record_entries(self.__metrics, stream_label(name), reply)
+        for stream_name in stream_names:
+            self.__metrics.observe("redis_seconds", elapsed, stream=stream_name, command="pipeline")
+        return replies
+
+def stream_label(stream_name):
+    if isinstance(stream_name, bytes):
+        return stream_name.decode("utf-8")
+    return str(stream_name)
+
+def record_entries(metrics, stream_name, entries):
+    """
+    Counts entries of a stream read and bytes of their fields
+    """
+    metrics.observe("batch_entries", len(entries), stream=stream_name)
+    metrics.inc("redis_bytes", sum(len(value) for _, fields in entries for value in fields.values()), stream=stream_name)
+
+def _instrumented_connection(opened, metrics):
+    open_connection, args = opened
+    return InstrumentedConnection(open_connection(*args), metrics)
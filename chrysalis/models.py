@@ -14,6 +14,8 @@
 # limitations under the License.
 
 import math
+import av
+import numpy
 
 class ProbeInfo(object):
     """
@@ -27,52 +29,222 @@ class ProbeInfo(object):
         Latest contained media data in video stream cache
     duration : int
         Duration of the buffered media stream in seconds
+    fps : int
+        Frame rate over the newest frames of the stream
+    frames : int
+        Number of frames in the video stream cache
     """
     start_timestamp = 0
     end_timestamp = 0
     duration = 0
     fps = 0
+    frames = 0
 
-    def __init__(self, start, end, fps=0):
+    def __init__(self, start, end, fps=0, frames=0):
         self.start_timestamp = start
         self.end_timestamp = end
         self.duration = math.ceil((end-start) / 1000)
         self.fps = fps
+        self.frames = frames
 
 
+# bytes per pixel of converted image data
+BYTES_PER_PIXEL = {"bgr24": 3, "rgb24": 3, "gray": 1, "yuv420p": 1.5}
+
 class ChImage(object):
     """
     Chrysalis Image object
 
+    Images are slotted and keep the decoded frame until data is first accessed, only then it's converted
+    (and cached). Images skipped after looking at their timestamp or frame_type cost nothing beyond decoding.
+
     Attributes
     ----------
     data : numpy.ndarray
-        Image data in BGR24 format
+        Image data in the requested pixel format (BGR24 by default), yuv420p planes are stacked vertically,
+        with the planes pixel format it's the first (luma) plane. Converted on first access
     timestamp: int
         Timestamp of the image stored in video cache
     width: int
         width of the image
     height: int
         height of the image
+    dropped_frames: int
+        Number of frames in the stream since the previously returned live image that were skipped
+    entry_id: string
+        ID of the video stream entry the image was decoded from
+    pix_fmt: string
+        Pixel format of data, with the planes pixel format the decoder's format of planes (e.g. yuv420p, nv12)
+    planes: tuple
+        Read-only numpy views of the decoded frame's planes (e.g. Y, U, V) without any conversion or copy,
+        set with the planes pixel format only
+    frame: av.VideoFrame
+        Decoded frame the planes are views of
 
     Methods
     -------
     describe()
         Describes the acquired image
+    materialize()
+        Converts data right away instead of on first access
+    to_bgr()
+        Image converted to BGR24
     """
 
-    data = None # numpy 
-    timestamp = 0
-    width = 0
-    height = 0
-    frame_type = None # can be one of the I, B, P
+    __slots__ = ("timestamp", "width", "height", "frame_type", "dropped_frames", "entry_id", "pix_fmt", "planes", "frame", "__data", "__convert")
 
-    def __init__(self, data, width=0, height=0, timestamp=0, frame_type=None):
-        self.data = data
+    def __init__(self, data=None, width=0, height=0, timestamp=0, frame_type=None, dropped_frames=0, entry_id=None, pix_fmt="bgr24", planes=None, frame=None, convert=None):
+        self.__data = data
+        # called on first access of data, e.g. pixel format conversion of the decoded frame
+        self.__convert = convert if data is None else None
         self.width = width
         self.height = height
         self.timestamp = timestamp
-        self.frame_type = frame_type
+        self.frame_type = frame_type # can be one of the I, B, P
+        self.dropped_frames = dropped_frames
+        self.entry_id = entry_id
+        self.pix_fmt = pix_fmt
+        self.planes = planes
+        self.frame = frame
+
+    @property
+    def data(self):
+        """
+        Image data, converted from the decoded frame on first access
+        """
+        convert = self.__convert
+        if convert is not None:
+            # images may be shared between threads, a concurrent first access converts twice at worst
+            self.__data = convert()
+            self.__convert = None
+        return self.__data
+
+    @data.setter
+    def data(self, data):
+        self.__data = data
+        self.__convert = None
+
+    @property
+    def converted(self):
+        """
+        True if data doesn't need a conversion anymore
+        """
+        return self.__convert is None
+
+    @property
+    def nbytes(self):
+        """
+        Size of the image data (all planes) in bytes, estimated from the pixel format until data is converted
+        """
+        if self.planes is not None:
+            return sum(plane.nbytes for plane in self.planes)
+        if self.__convert is not None:
+            return int(self.width * self.height * BYTES_PER_PIXEL.get(self.pix_fmt, 3))
+        return self.__data.nbytes if self.__data is not None else 0
+
+    def materialize(self):
+        """
+        Converts data right away instead of on first access, e.g. in a worker thread before handing the image over
+
+        Returns
+        -------
+        numpy.ndarray, the image data
+        """
+        return self.data
+
+    def to_bgr(self):
+        """
+        Image converted to BGR24, on every call (BGR24 data is returned as is)
+
+        Returns
+        -------
+        numpy.ndarray of shape (height, width, 3)
+        """
+        if self.planes is None and self.pix_fmt == "bgr24":
+            return self.data
+        frame = self.frame
+        if frame is None and self.planes is not None:
+            # planes were copied out of the decoded frame (e.g. handed over from another process)
+            frame = av.VideoFrame(self.width, self.height, self.pix_fmt)
+            for view, plane in zip(frame_planes(frame, writeable=True), self.planes):
+                view[...] = plane
+        elif frame is None:
+            frame = av.VideoFrame.from_ndarray(self.data, format=self.pix_fmt)
+        return frame.to_ndarray(format="bgr24")
+
+    def with_dropped_frames(self, dropped_frames):
+        """
+        Copy of the image with another dropped_frames count, pixel data is shared (and converted once)
+        """
+        data = self.__data if self.__convert is None else None
+        return ChImage(data=data, width=self.width, height=self.height, timestamp=self.timestamp, frame_type=self.frame_type, dropped_frames=dropped_frames, entry_id=self.entry_id, pix_fmt=self.pix_fmt, planes=self.planes, frame=self.frame, convert=self.__shared_data)
+
+    def __shared_data(self):
+        return self.data
+
+    def __getstate__(self):
+        # decoded frames can't be pickled, data is converted and plane views are pickled as copies
+        return {"data": self.data if self.planes is None else None, "width": self.width, "height": self.height, "timestamp": self.timestamp, "frame_type": self.frame_type,
+                "dropped_frames": self.dropped_frames, "entry_id": self.entry_id, "pix_fmt": self.pix_fmt, "planes": self.planes}
+
+    def __setstate__(self, state):
+        if state["planes"] is not None:
+            state["data"] = state["planes"][0]
+        self.__init__(**state)
 
     def describe(self):
-        print("TBD")
\ No newline at end of file
+        print("TBD")
+
+def frame_planes(frame, writeable=False):
+    """
+    numpy views of the planes of a decoded frame, no data is copied. Planes of a decoder's frame are
+    read-only, the decoder may still reference them for decoding following frames.
+
+    Returns
+    -------
+    Tuple of numpy.ndarray, (height, width) per plane or (height, width, components) for planes of interleaved components (e.g. UV of nv12)
+    """
+    components = frame.format.components
+    views = []
+    for idx, plane in enumerate(frame.planes):
+        bits = [c.bits for c in components if c.plane == idx]
+        dtype = numpy.uint8 if max(bits) <= 8 else numpy.uint16
+        itemsize = numpy.dtype(dtype).itemsize
+        view = numpy.frombuffer(plane, dtype=dtype).reshape(plane.height, plane.line_size // itemsize)
+        view = view[:, :plane.width * len(bits)]
+        if len(bits) > 1:
+            view = view.reshape(plane.height, plane.width, len(bits))
+        view.flags.writeable = writeable
+        views.append(view)
+    return tuple(views)
+
+class ChAudio(object):
+    """
+    Chrysalis Audio chunk, a fixed window of decoded audio samples
+
+    Attributes
+    ----------
+    data : numpy.ndarray
+        Samples of shape (samples, channels), float32 in [-1, 1] or int16
+    timestamp: int
+        Timestamp of the first sample in ms, on the same clock as ChImage timestamps
+    sample_rate: int
+        Samples per second
+    channels: int
+        Number of audio channels
+    duration: int
+        Length of the chunk in ms
+    """
+
+    data = None # numpy
+    timestamp = 0
+    sample_rate = 0
+    channels = 0
+    duration = 0
+
+    def __init__(self, data, timestamp=0, sample_rate=0, channels=0):
+        self.data = data
+        self.timestamp = timestamp
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.duration = int(len(data) * 1000 / sample_rate) if sample_rate > 0 else 0
@@ -0,0 +1,59 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .live_video_image import LiveVideoImage
+from .decoder import create_decoder
+
+class MultiLiveVideoImage:
+    """
+    Latest images of many live video streams read with a single blocking XREAD per poll.
+    Each stream keeps its own cursor and decoder.
+    """
+
+    def __init__(self, redis_conn, stream_names, frame_cache=None, pix_fmt="bgr24", size=None, thread_type="SLICE", thread_count=0, metrics=None):
+        self.__redis_conn = redis_conn
+        self.__players = {}
+        for stream_name in stream_names:
+            self.__players[stream_name] = LiveVideoImage(redis_conn=redis_conn, stream_name=stream_name, codec=create_decoder(thread_type=thread_type, thread_count=thread_count), frame_cache=frame_cache, pix_fmt=pix_fmt, size=size, metrics=metrics)
+
+    def get_latest_images(self):
+        """
+        Returns
+        -------
+        Dictionary of key = stream name, value = ChImage or None if the stream has no new frame
+        """
+        redis_time = self.__redis_conn.time()
+        buffer = self.__redis_conn.xread(self.next_queries(redis_time), block=1000)
+        return self.latest_images(buffer)
+
+    def next_queries(self, redis_time):
+        """
+        Dictionary of key = stream name, value = stream ID to XREAD from
+        """
+        streams = {}
+        for stream_name, player in self.__players.items():
+            streams[stream_name] = player.next_query(redis_time)
+        return streams
+
+    def latest_images(self, buffer):
+        """
+        Decodes newest frame per stream of the XREAD reply
+        """
+        images = dict.fromkeys(self.__players)
+        for stream_buffer in buffer:
+            stream_name = stream_buffer[0]
+            if isinstance(stream_name, bytes):
+                stream_name = stream_name.decode('utf-8')
+            images[stream_name] = self.__players[stream_name].latest_image([stream_buffer])
+        return images
@@ -0,0 +1,89 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from .past_video_image import iter_past_images
+from .store import reopen
+
+# decoding starts from a keyframe at least this long before a segment (more than any reordering delay)
+SEGMENT_WARMUP_MS = 1000
+# redis connection and metrics of a pool worker process
+_worker_redis_conn = None
+_worker_metrics = None
+
+def segments(fromtimestamp, totimestamp, segment_ms):
+    """
+    Splits [fromtimestamp, totimestamp] into consecutive half open [from, to) time segments
+
+    Returns
+    -------
+    List of (from timestamp, to timestamp) in ms
+    """
+    result = []
+    seg_from = fromtimestamp
+    while seg_from <= totimestamp:
+        seg_to = min(seg_from + segment_ms, totimestamp + 1)
+        result.append((seg_from, seg_to))
+        seg_from = seg_to
+    return result
+
+def _init_worker(open_connection, args, metrics):
+    global _worker_redis_conn, _worker_metrics
+    _worker_redis_conn = open_connection(*args)
+    _worker_metrics = metrics
+
+def _decode_segment(stream_name, seg_from, seg_to, warmup_ms, pix_fmt, size, count, sampling):
+    # processes already keep every CPU busy, decoders run single threaded
+    # every segment decodes on its own from a keyframe before seg_from, frames up to seg_to are
+    # paired with the same entries as in a sequential playback
+    return list(iter_past_images(_worker_redis_conn, stream_name, seg_from, seg_to - 1, pix_fmt=pix_fmt, size=size, count=count, warmup_ms=warmup_ms, sampling=sampling, thread_type="NONE", metrics=_worker_metrics))
+
+def iter_parallel_images(redis_conn, stream_name, fromtimestamp, totimestamp, ordered=True, processes=None, segment_seconds=10, pix_fmt="bgr24", size=None, count=100, sampling=None, metrics=None):
+    """
+    Decodes history between fromtimestamp and totimestamp (in ms) in a pool of processes.
+
+    The range is split into segments of segment_seconds, each one decoded independently starting from
+    a keyframe before it (up to a GOP and a second before a segment boundary is decoded twice).
+    At most two segments per process are decoded ahead of the consumer.
+    With sampling, every segment samples on its own (every Nth and fps schedules restart at segment boundaries).
+
+    Returns
+    -------
+    Generator of ChImage objects, in stream order if ordered, otherwise as segments finish decoding
+    """
+    processes = processes or os.cpu_count() or 1
+    pending_segments = collections.deque(segments(fromtimestamp, totimestamp, segment_seconds * 1000))
+    executor = ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=reopen(redis_conn) + (metrics,))
+    in_flight = collections.deque()
+    try:
+        while len(pending_segments) > 0 or len(in_flight) > 0:
+            while len(pending_segments) > 0 and len(in_flight) < processes * 2:
+                seg_from, seg_to = pending_segments.popleft()
+                # segments after the first one continue a playback started at fromtimestamp
+                warmup_ms = SEGMENT_WARMUP_MS if seg_from > fromtimestamp else 0
+                segment_sampling = sampling.copy() if sampling is not None else None
+                in_flight.append(executor.submit(_decode_segment, stream_name, seg_from, seg_to, warmup_ms, pix_fmt, size, count, segment_sampling))
+            if ordered:
+                done = in_flight.popleft()
+            else:
+                done = next(iter(wait(in_flight, return_when=FIRST_COMPLETED).done))
+                in_flight.remove(done)
+            for img in done.result():
+                yield img
+    finally:
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=False)
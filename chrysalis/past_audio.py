@@ -0,0 +1,45 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .audio_chunker import AudioChunker
+from .seek import next_id
+
+# audio decoded ahead of the requested window start, primes the AAC decoder
+AUDIO_WARMUP_MS = 100
+
+def iter_past_audio(redis_conn, stream_name, fromtimestamp, totimestamp, codec=None, sample_rate=16000, channels=1, sample_format="float32", window_ms=1000, count=500):
+    """
+    Historical audio in windows starting at fromtimestamp, the last window is partial if the stream
+    ends before it's complete
+
+    Returns
+    -------
+    Generator of ChAudio windows starting from fromtimestamp and before totimestamp (in ms)
+    """
+    chunker = AudioChunker(codec=codec, sample_rate=sample_rate, channels=channels, sample_format=sample_format, window_ms=window_ms, window_start=fromtimestamp)
+    min_id = str(fromtimestamp - AUDIO_WARMUP_MS)
+    # entries up to the end of the window totimestamp falls in
+    max_id = str(totimestamp + window_ms)
+    while True:
+        buffer = redis_conn.xrange(stream_name, min=min_id, max=max_id, count=count)
+        for chunk in chunker.chunks(buffer):
+            if chunk.timestamp >= totimestamp:
+                return
+            yield chunk
+        if len(buffer) < count:
+            break
+        min_id = next_id(buffer[-1][0])
+    chunk = chunker.flush()
+    if chunk is not None and chunk.timestamp < totimestamp:
+        yield chunk
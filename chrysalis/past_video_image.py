@@ -1,5 +1,3 @@
-import multiprocessing
-
 # Copyright 2020 Wearless Tech Inc All Rights Reserved.
 #
 # Licensed under the Apache License, Version 2.0 (the "License");
@@ -15,122 +13,261 @@ import multiprocessing
 # limitations under the License.
 
 import time
-from .chunker import Chunker, ChImage
+from .chunker import Chunker, ChImage, output_format
 from .log import logger
 from .ch_errors import VideoFailedToStart, VideoHistoryNotFound, InfrequentException
-import av
+from .frame_ring import SharedFrameRing
+from .sampling import sampled_images
+from .history_reader import HistoryReader
+from .seek import keyframe_before, warmup_entries, drop_disposable_before, reorder_tail, entry_timestamp
+from .h264 import is_keyframe
+from .decoder import create_decoder
 import numpy
 import datetime
 import operator
 import multiprocessing as mp
 import sys
 
+def iter_past_images(redis_conn, stream_name, fromtimestamp, totimestamp, pix_fmt="bgr24", size=None, count=10, warmup_ms=0, sampling=None, thread_type="SLICE", thread_count=0, metrics=None):
+    """
+    History playback in the calling thread. Reads count entries at a time and decodes them lazily,
+    so at most one batch of packets and one image are held at once no matter how long the range is.
+
+    Attributes
+    ----------
+    warmup_ms : int
+        decode at least this long before fromtimestamp, so frames from fromtimestamp on come out of the
+        decoder exactly as in a playback started earlier (no initial reordering delay)
+    sampling : Sampling
+        frames to return, None returns all
+    thread_type, thread_count :
+        decoder threading, see create_decoder
+    metrics : Metrics
+        records decode and conversion times, None measures nothing
+
+    Returns
+    -------
+    Generator of ChImage objects between fromtimestamp and totimestamp (in ms)
+    """
+    chunker = Chunker(codec=create_decoder(thread_type=thread_type, thread_count=thread_count), pix_fmt=pix_fmt, size=size, metrics=metrics, stream_name=stream_name)
+    # start decoding from the closest keyframe so the first image is the one at fromtimestamp
+    decode_from = fromtimestamp - warmup_ms
+    last_query = keyframe_before(redis_conn, stream_name, decode_from)
+    if last_query is None:
+        last_query = str(decode_from)
+    last_query_timestamp = None
+    synced = True
+
+    while last_query_timestamp is None or last_query_timestamp < totimestamp:
+        buffer = redis_conn.xread({stream_name:last_query}, block=1000, count=count)
+        if len(buffer) == 0:
+            continue
+        inner_buffer = buffer[0][1]
+        last_query = inner_buffer[-1][0]
+        last_query_timestamp = entry_timestamp(last_query)
+        if entry_timestamp(inner_buffer[0][0]) < decode_from:
+            inner_buffer = drop_disposable_before(inner_buffer, decode_from)
+        # frames the decoder holds back are drained with the last batch
+        end_reached = last_query_timestamp >= totimestamp
+        if end_reached:
+            inner_buffer = inner_buffer + reorder_tail(redis_conn, stream_name, inner_buffer, chunker.codec.has_b_frames)
+        if sampling is not None:
+            images, synced = sampled_images(chunker, inner_buffer, sampling, synced, redis_conn, stream_name, from_timestamp=fromtimestamp, flush=end_reached)
+        else:
+            images = chunker.images(inner_buffer, from_timestamp=fromtimestamp, flush=end_reached)
+        for chImage in images:
+            if chImage.timestamp > totimestamp:
+                return
+            yield chImage
+
 class PastVideoImage:
+    """
+    History playback. Frames are read and decoded in a separate process and handed over
+    through a shared memory ring of buffer_size frames, slots are as large as the first frame
+    up to max_frame_bytes (None doesn't limit them).
+    """
 
-    def __init__(self, redis_conn, stream_name, audio_stream_name, codec=av.Codec('h264', 'r').create()):
+    def __init__(self, redis_conn, stream_name, audio_stream_name, codec=None, buffer_size=10, max_frame_bytes=None, frame_cache=None, pix_fmt="bgr24", size=None, sampling=None, thread_type="SLICE", thread_count=0, metrics=None):
         self.__redis_conn = redis_conn
+        self.__metrics = metrics
+        self.__decoder_options = {"thread_type": thread_type, "thread_count": thread_count}
+        self.__sampling = sampling
+        self.__frame_cache = frame_cache
+        self.__pix_fmt = pix_fmt
+        self.__size = size
+        self.__output_format = output_format(pix_fmt, size)
         self.__stream_name = stream_name
         self.__audio_stream_name = audio_stream_name
+        self.__buffer_size = buffer_size
+        self.__max_frame_bytes = max_frame_bytes
 
-        self.__last_history_query = None
-        self.__last_history_query_timestamp = 0
-        self.__history_chunker = None
+        self.__lock = mp.RLock()
         self.__last_history_request_time = 0
-        self.__history_queue = mp.Queue()
-        self.__is_first_run = True
-        self.__lock = mp.Lock()
+        self.__process = None
+        self.__ring = None
+        self.__stop = None
+        # [generation, timestamp] shared with the playback process, generation increases on every seek
+        self.__position = mp.Array('q', 2)
 
     def get_latest_image_from(self, fromtimestamp, totimestamp) -> ChImage:
-
-        redis_time = self.__redis_conn.time()
-        redis_time = int(redis_time[0] + (redis_time[1] / 1000000)) * 1000
-
-        self.__process = mp.Process(target=self.fetch_next_frames, args=(totimestamp,True,))
+        now = time.monotonic()
 
         with self.__lock:
-            if self.__last_history_request_time == 0:    
-                self.__last_history_request_time = redis_time
-
-            if self.__last_history_query_timestamp == 0:
-                self.__last_history_query_timestamp = fromtimestamp
-                self.__last_history_query = str(self.__last_history_query_timestamp)
-                self.__history_chunker = Chunker(codec=av.Codec('h264', 'r').create())
-                self.__history_queue = mp.Queue()
-            else:
+            if self.__process is None:
+                with self.__position.get_lock():
+                    self.__position[0] += 1
+                    self.__position[1] = fromtimestamp
+                self.__ring = SharedFrameRing(slots=self.__buffer_size, max_slot_bytes=self.__max_frame_bytes, pix_fmt=self.__pix_fmt)
+                self.__stop = mp.Event()
+                self.__process = mp.Process(target=self.fetch_next_frames, args=(totimestamp, self.__ring, self.__stop,), daemon=True)
+                self.__process.start()
+            elif now - self.__last_history_request_time > 10:
                 # check if more than 10 seconds between 2 queries, throw exception
-                last_query_diff = abs(self.__last_history_request_time - redis_time)
-                if last_query_diff > 10*1000:
-                    self.__history_cleanup()
-                    raise InfrequentException
-        
-       
-            self.__last_history_request_time = redis_time
-
-        if self.__is_first_run:
-            self.__process.start()
-            self.__is_first_run = False
-
-        while True:
-            if self.__history_queue.qsize() > 0:
-                img = self.__history_queue.get()
-                if img.timestamp == 0 and img.data is None:
-                    # sentinel img received (no more data)
-                    break
-                else:
-                    return img
-            else:
-                time.sleep(0.1)
+                self.__history_cleanup()
+                raise InfrequentException
+            self.__last_history_request_time = now
+            ring = self.__ring
+            process = self.__process
+            stopped = self.__stop.is_set()
 
-        self.__history_cleanup()
-        return None
+        if stopped:
+            self.__history_cleanup()
+            return None
+
+        img = ring.get(self.__position[0], is_alive=process.is_alive)
+        if img is not None and self.__frame_cache is not None:
+            self.__frame_cache.put(self.__stream_name, img, self.__output_format)
+        if img is None:
+            # end of stream (or stopped)
+            self.__history_cleanup()
+        return img
 
     def stop_now(self):
+        """
+        Stops the playback process, next get_latest_image_from returns None
+        """
         with self.__lock:
-            self.__last_history_query_timestamp = sys.maxsize
-
-    def fetch_next_frames(self, totimestamp, is_forward_process=False):
-
-        while True:
-            if self.__last_history_query_timestamp < totimestamp:
-                if self.__history_queue.qsize() < 10:
-                    # dt_object = datetime.datetime.fromtimestamp(int(self.__last_history_query_timestamp / 1000))
-                    # logger.debug("running process {}".format(self.__last_history_query_timestamp))
-
-                    buffer = self.__redis_conn.xread({self.__stream_name:self.__last_history_query}, block=1000, count=10)
-
-                    # start_time = time.time()
-                    if len(buffer) > 0:
-                        arr = buffer[0]
-                        inner_buffer = arr[1]
-                        # logger.debug("returned packets: {} in {} s".format(len(inner_buffer), (time.time() - start_time)))
-                        last = inner_buffer[-1]
-                        with self.__lock:
-                            self.__last_history_query = last[0]
-                            self.__last_history_query_timestamp = int(self.__last_history_query.decode('utf-8').split("-")[0])
-                        # logger.debug("NEXT ONE should query FROM: {}".format(self.__last_history_query))
-                        frames = self.__history_chunker.frames(inner_buffer)
-                        if len(frames) > 0:
-                            for frame_ts, frame in frames.items():
-                                d = frame.to_ndarray(format="bgr24")
-                                chImage = ChImage(data=d, width=frame.width, height=frame.height, timestamp=frame_ts, frame_type=frame.pict_type.name)
-                                self.__history_queue.put(chImage)
-                else: 
-                    if is_forward_process:
-                        time.sleep(0.15)
+            if self.__stop is not None:
+                self.__stop.set()
+
+    def seek(self, timestamp):
+        """
+        Continues the running playback from timestamp (in ms), frames already buffered are discarded
+        """
+        with self.__position.get_lock():
+            self.__position[0] += 1
+            self.__position[1] = timestamp
+
+    def fetch_next_frames(self, totimestamp, ring, stop):
+        """
+        Playback process, reads and decodes the video stream forward into the frame ring until totimestamp is reached
+        """
+        generation = None
+        from_timestamp = 0
+        history_chunker = None
+        history_reader = None
+        reader_done = False
+        end_reached = False
+        decoder_stale = False
+        last_batch = []
+
+        while not stop.is_set():
+            with self.__position.get_lock():
+                is_seek = self.__position[0] != generation
+                generation = self.__position[0]
+                if is_seek:
+                    from_timestamp = self.__position[1]
+
+            if is_seek:
+                reader_done = False
+                last_batch = []
+                history_chunker = Chunker(codec=create_decoder(**self.__decoder_options), pix_fmt=self.__pix_fmt, size=self.__size, metrics=self.__metrics, stream_name=self.__stream_name)
+                end_reached = False
+                decoder_stale = False
+                if self.__sampling is not None:
+                    self.__sampling.reset()
+                # start decoding from the closest keyframe so the first frame emitted is the one at from_timestamp
+                last_history_query = keyframe_before(self.__redis_conn, self.__stream_name, from_timestamp)
+                if last_history_query is None:
+                    last_history_query = str(from_timestamp)
+                if history_reader is not None:
+                    history_reader.stop()
+                history_reader = HistoryReader(self.__redis_conn, self.__stream_name, last_history_query, totimestamp, metrics=self.__metrics)
+                history_reader.start()
+
+            if reader_done:
+                if not end_reached:
+                    history_reader.stop()
+                    end_reached = ring.put(None, generation, stop)
+                # stay around for a seek until stopped
+                stop.wait(0.1)
+                continue
+
+            inner_buffer = history_reader.get()
+            images = []
+            if inner_buffer is None:
+                reader_done = True
+                # frames the decoder holds back at the end of the range
+                tail = [] if decoder_stale else reorder_tail(self.__redis_conn, self.__stream_name, last_batch, history_chunker.codec.has_b_frames)
+                images = history_chunker.images(tail, from_timestamp=from_timestamp, flush=True)
+            elif len(inner_buffer) > 0:
+                last_batch = inner_buffer
+                if self.__sampling is not None:
+                    images, synced = sampled_images(history_chunker, inner_buffer, self.__sampling, not decoder_stale, self.__redis_conn, self.__stream_name, from_timestamp=from_timestamp)
+                    decoder_stale = not synced
+                else:
+                    images = self.__cached_images(inner_buffer, from_timestamp)
+                    if images is not None:
+                        decoder_stale = True
                     else:
-                        break
-            else:
-                sentinel_img = ChImage(data=None, width=0, height=0, timestamp=0)
-                self.__history_queue.put(sentinel_img)
-                self.__history_queue.close()
-                break
+                        emit_from = from_timestamp
+                        if decoder_stale and not is_keyframe(inner_buffer[0][1].get(b"frame")):
+                            # images served from the cache weren't decoded, decoder has to catch up from a keyframe
+                            emit_from = max(from_timestamp, entry_timestamp(inner_buffer[0][0]))
+                            inner_buffer = warmup_entries(self.__redis_conn, self.__stream_name, inner_buffer[0][0]) + inner_buffer
+                        decoder_stale = False
+                        if entry_timestamp(inner_buffer[0][0]) < emit_from:
+                            inner_buffer = drop_disposable_before(inner_buffer, emit_from)
+                        images = history_chunker.images(inner_buffer, from_timestamp=emit_from)
+
+            for chImage in images:
+                if chImage.timestamp > totimestamp:
+                    break
+                if self.__position[0] != generation or not ring.put(chImage, generation, stop):
+                    # seek or stop
+                    break
+
+        if history_reader is not None:
+            history_reader.stop()
+        ring.close()
+
+    def __cached_images(self, entries, from_timestamp):
+        """
+        Images of all entries from from_timestamp on if every one of them is in the frame cache, None otherwise
+        """
+        if self.__frame_cache is None:
+            return None
+        entry_ids = [entry[0] for entry in entries if entry_timestamp(entry[0]) >= from_timestamp]
+        if len(entry_ids) == 0:
+            return None
+        for entry_id in entry_ids:
+            if not self.__frame_cache.contains(self.__stream_name, entry_id, self.__output_format):
+                return None
+        images = [self.__frame_cache.get(self.__stream_name, entry_id, self.__output_format) for entry_id in entry_ids]
+        if None in images:
+            # evicted meanwhile
+            return None
+        return images
 
     def __history_cleanup(self):
         with self.__lock:
-            self.__last_history_query_timestamp = 0
-            self.__last_history_query = None
+            if self.__stop is not None:
+                self.__stop.set()
+            if self.__process is not None:
+                self.__process.join(timeout=2)
+            if self.__ring is not None:
+                self.__ring.close(unlink=True)
             self.__last_history_request_time = 0
-            self.__history_chunker = None
-
-        if self.__history_queue is not None:
-            self.__history_queue.close()
\ No newline at end of file
+            self.__process = None
+            self.__ring = None
+            self.__stop = None
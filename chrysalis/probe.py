@@ -12,39 +12,101 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
 import redis
 from .models import ProbeInfo
-import math
+from .seek import entry_timestamp
+
+# newest entries the frame rate is estimated from
+FPS_WINDOW = 30
+# seconds a probe result is reused for
+PROBE_TTL = 1.0
 
 class Probe:
+    """
+    Stream stats from XINFO STREAM (first entry, last entry, length) and the frame rate over the newest
+    FPS_WINDOW entries, both queried in a single pipelined round trip. Results are reused for ttl seconds.
+    """
 
-    def __init__(self, redis, stream_name):
+    def __init__(self, redis, stream_name, ttl=PROBE_TTL):
         self.redis = redis
         self.stream_name = stream_name
+        self.ttl = ttl
+        # (monotonic time, ProbeInfo) of the last query
+        self.__cached = None
+
+    def info(self, max_age=None):
+        """
+        Returns
+        -------
+        ProbeInfo no older than max_age seconds (default ttl)
+        """
+        return probe_all(self.redis, [self], max_age=max_age)[0]
+
+    def cached(self, max_age=None):
+        """
+        Returns
+        -------
+        ProbeInfo of the last query if it isn't older than max_age seconds (default ttl), otherwise None
+        """
+        if max_age is None:
+            max_age = self.ttl
+        cached = self.__cached
+        if cached is None or time.monotonic() - cached[0] > max_age:
+            return None
+        return cached[1]
+
+    def queue(self, pipe):
+        """
+        Adds the probe queries to a redis pipeline, replies are passed to info_from
+        """
+        pipe.xinfo_stream(self.stream_name)
+        pipe.xrevrange(self.stream_name, max="+", min="-", count=FPS_WINDOW)
+
+    def info_from(self, stream_info, recent):
+        """
+        ProbeInfo from XINFO STREAM and XREVRANGE count=FPS_WINDOW replies of the stream (pipeline executed
+        with raise_on_error=False), the result is cached
+        """
+        if isinstance(stream_info, redis.ResponseError):
+            # no such stream
+            stream_info, recent = None, []
+        elif isinstance(stream_info, Exception):
+            raise stream_info
+        if isinstance(recent, Exception):
+            raise recent
+
+        info = ProbeInfo(0, 0)
+        if stream_info is not None and stream_info.get("first-entry") is not None and stream_info.get("last-entry") is not None:
+            info = ProbeInfo(entry_timestamp(stream_info["first-entry"][0]), entry_timestamp(stream_info["last-entry"][0]), fps=self.__fps(recent), frames=stream_info.get("length", 0))
+        self.__cached = (time.monotonic(), info)
+        return info
+
+    def __fps(self, recent):
+        if len(recent) < 2:
+            return 0
+        # newest first
+        span = entry_timestamp(recent[0][0]) - entry_timestamp(recent[-1][0])
+        if span <= 0:
+            return 0
+        return round((len(recent) - 1) * 1000 / span)
+
+def probe_all(redis_conn, probes, max_age=None):
+    """
+    Probes many streams, the ones without a fresh enough cached result in a single pipelined round trip
 
-    def info(self):
-        first_frame = self.redis.xrevrange(self.stream_name, min="-", max="+", count=1)
-        ts_first = 0
-        ts_last = 0
-        fps = 0
-        if len(first_frame) > 0:
-            if len(first_frame[0]) > 0:
-                ts_str = first_frame[0][0].decode("utf-8")
-                ts_first = int(ts_str.split("-")[0])
-        
-        last_frame = self.redis.xrange(self.stream_name, min="-", max="+", count=60)
-        if len(last_frame) > 0:
-            if len(last_frame[0]) > 0:
-                ts_str = last_frame[0][0].decode("utf-8")
-                ts_last = int(ts_str.split("-")[0])
-            
-            # asses FPS
-            lf = last_frame[-1:]
-            ts_str = lf[0][0].decode("utf-8")
-            ts = int(ts_str.split("-")[0])
-
-            fps = math.floor(len(last_frame) / abs(ts_last - ts) * 1000)
-
-        return ProbeInfo(ts_last, ts_first, fps=fps)
-        
-        
\ No newline at end of file
+    Returns
+    -------
+    List of ProbeInfo, one per probe
+    """
+    results = [probe.cached(max_age) for probe in probes]
+    stale = [idx for idx, info in enumerate(results) if info is None]
+    if len(stale) == 0:
+        return results
+    pipe = redis_conn.pipeline(transaction=False)
+    for idx in stale:
+        probes[idx].queue(pipe)
+    replies = pipe.execute(raise_on_error=False)
+    for n, idx in enumerate(stale):
+        results[idx] = probes[idx].info_from(replies[2 * n], replies[2 * n + 1])
+    return results
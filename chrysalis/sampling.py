@@ -0,0 +1,170 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .h264 import is_keyframe, is_disposable, is_bidirectional, reorders
+from .seek import entry_timestamp, warmup_entries
+from .screenshot import decode_keyframe
+
+class Sampling:
+    """
+    Frame sampling policy, selects which frames of a stream are returned. Frames that aren't returned
+    are only decoded when a returned frame references them, and are never converted into images.
+
+    Attributes
+    ----------
+    keyframes : bool
+        return keyframes only, every keyframe is decoded on its own and nothing else is decoded (default False)
+    every : int
+        return every Nth frame (default 1)
+    fps : float
+        return at most fps frames per second of the stream (default None, no limit)
+    """
+
+    def __init__(self, keyframes=False, every=1, fps=None):
+        if every < 1:
+            raise ValueError("every must be at least 1")
+        if fps is not None and fps <= 0:
+            raise ValueError("fps must be positive")
+        self.keyframes = keyframes
+        self.every = every
+        self.fps = fps
+        # stream has B frames, batches without any B slice are part of it too
+        self.__reordered = False
+        self.reset()
+
+    def copy(self):
+        """
+        Same policy with its own state, for sampling another playback
+        """
+        return Sampling(keyframes=self.keyframes, every=self.every, fps=self.fps)
+
+    def reset(self):
+        """
+        Starts sampling over, e.g. after a seek
+        """
+        self.__count = 0
+        self.__next_timestamp = None
+        self.__tail = False
+
+    def selected(self, entry_id, payload):
+        """
+        Decides whether the frame of the next stream entry is returned, entries have to be passed in stream order
+        """
+        if self.keyframes and not is_keyframe(payload):
+            return False
+        if self.fps is not None:
+            ts = entry_timestamp(entry_id)
+            if self.__next_timestamp is not None and ts < self.__next_timestamp:
+                return False
+            interval = 1000 / self.fps
+            # keep the schedule unless the stream jumped ahead (gap or seek)
+            if self.__next_timestamp is None or ts - self.__next_timestamp > interval:
+                self.__next_timestamp = ts
+            self.__next_timestamp += interval
+        self.__count += 1
+        return (self.__count - 1) % self.every == 0
+
+    def plan(self, entries, synced, from_timestamp=0):
+        """
+        Picks entries of a batch to decode: selected ones and reference frames before them back to their keyframe.
+        Everything after the last selected entry of a GOP is skipped. Frames of streams with B frames are paired
+        with entries in presentation order, there every frame before a selected one is decoded and so are
+        the B frames after it (they are shown before it).
+
+        Attributes
+        ----------
+        synced : bool
+            decoder decoded every reference frame before the batch
+        from_timestamp : int
+            entries before this timestamp (in ms) aren't selected
+
+        Returns
+        -------
+        (entries to decode, set of entry ID strings to convert into images,
+        True if the decoder has to catch up from a keyframe before the batch first,
+        True if the decoder is in sync after decoding the entries)
+        """
+        payloads = [entry[1].get(b"frame") for entry in entries]
+        self.__reordered = self.__reordered or reorders(payloads)
+        reordered = self.__reordered
+        keep = [False] * len(entries)
+        emit = set()
+        for idx, entry in enumerate(entries):
+            if entry_timestamp(entry[0]) >= from_timestamp and self.selected(entry[0], payloads[idx]):
+                keep[idx] = True
+                emit.add(entry[0].decode('utf-8') if isinstance(entry[0], bytes) else entry[0])
+
+        # walking back, reference frames are needed until the keyframe of a selected frame's GOP
+        needed = False
+        for idx in reversed(range(len(entries))):
+            if keep[idx]:
+                needed = True
+            elif needed and (reordered or not is_disposable(payloads[idx])):
+                keep[idx] = True
+            if is_keyframe(payloads[idx]):
+                needed = False
+        needs_warmup = needed and not synced
+
+        if reordered:
+            # B frames following the last entry decoded, possibly from the previous batch
+            tail = self.__tail
+            for idx in range(len(entries)):
+                if keep[idx]:
+                    tail = True
+                elif tail and is_bidirectional(payloads[idx]):
+                    keep[idx] = True
+                else:
+                    tail = False
+            self.__tail = tail
+
+        synced = synced or needs_warmup
+        for idx in range(len(entries)):
+            if is_keyframe(payloads[idx]):
+                synced = keep[idx]
+            elif not keep[idx] and (reordered or not is_disposable(payloads[idx])):
+                synced = False
+        to_decode = [entry for idx, entry in enumerate(entries) if keep[idx]]
+        return to_decode, emit, needs_warmup, synced
+
+def sampled_images(chunker, entries, sampling, synced, redis_conn, stream_name, from_timestamp=0, flush=False):
+    """
+    Decodes the frames of a batch sampling selects
+
+    Attributes
+    ----------
+    flush : bool
+        last batch of a range, frames the decoder holds back are drained
+
+    Returns
+    -------
+    (list of ChImage, True if the chunker's decoder is in sync after the batch)
+    """
+    if sampling.keyframes:
+        images = []
+        for entry in entries:
+            ts = entry_timestamp(entry[0])
+            if ts >= from_timestamp and sampling.selected(entry[0], entry[1].get(b"frame")):
+                img = decode_keyframe([entry], ts, pix_fmt=chunker.pix_fmt, size=chunker.size, codec=chunker.codec, metrics=chunker.metrics, stream_name=chunker.stream_name)
+                if img is not None:
+                    images.append(img)
+        # decoder was reset after every keyframe
+        chunker.reset()
+        return images, False
+
+    to_decode, emit, needs_warmup, synced = sampling.plan(entries, synced, from_timestamp)
+    if len(to_decode) == 0 and not flush:
+        return [], synced
+    if needs_warmup:
+        to_decode = warmup_entries(redis_conn, stream_name, to_decode[0][0]) + to_decode
+    return list(chunker.images(to_decode, emit=emit, flush=flush)), synced
@@ -0,0 +1,95 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .log import logger
+from .chunker import Chunker
+from .decoder import create_decoder
+from .seek import entry_timestamp
+
+def search_range(timestamp, within_seconds, now_ms):
+    """
+    Time range an I frame is looked for in, within_seconds back from the latest time
+    otherwise +/- within_seconds/2 around timestamp
+
+    Returns
+    -------
+    (from timestamp, to timestamp) in ms
+    """
+    # if less than 10 ms from time it's the latest time
+    if abs(now_ms - timestamp) > 10:
+        half = int(within_seconds / 2 * 1000)
+        return timestamp - half, timestamp + half
+    return timestamp - within_seconds * 1000, timestamp
+
+def merge_ranges(ranges):
+    """
+    Merges overlapping (from, to) time ranges
+
+    Returns
+    -------
+    Sorted list of non overlapping (from, to) ranges
+    """
+    merged = []
+    for lo, hi in sorted(ranges):
+        if len(merged) > 0 and lo <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+    return merged
+
+def decode_keyframe(entries, timestamp, pix_fmt="bgr24", size=None, codec=None, metrics=None, stream_name=""):
+    """
+    Decodes the keyframe entry (XRANGE reply) on its own
+
+    Attributes
+    ----------
+    codec : av.CodecContext
+        decoder to use, it's reset afterwards so it can be reused (default a new decoder)
+    metrics : Metrics
+        records decode and conversion times, labeled with stream_name
+
+    Returns
+    -------
+    ChImage or None
+    """
+    chunker = Chunker(codec if codec is not None else create_decoder(), pix_fmt=pix_fmt, size=size, metrics=metrics, stream_name=stream_name)
+    found = closest_iframe(chunker.frames(entries, flush=True), timestamp)
+    img = None
+    if found is not None:
+        entry_id, frame = found
+        img = chunker.image(entry_timestamp(entry_id), frame, entry_id=entry_id)
+    if codec is not None:
+        chunker.reset()
+    return img
+
+def closest_iframe(frames, timestamp):
+    """
+    I frame closest to timestamp among decoded frames (iterable of (stream entry ID, av.frame.Frame)),
+    only the closest one found so far is kept around
+
+    Returns
+    -------
+    (stream entry ID, av.frame.Frame) of the I frame or None if there's no I frame
+    """
+    closest = None
+    min_diff = None
+    for entry_id, frame in frames:
+        if frame.pict_type.name == "I":
+            ts = entry_timestamp(entry_id)
+            logger.debug("found I frame at " + str(ts))
+            diff = abs(timestamp - ts)
+            if min_diff is None or diff < min_diff:
+                closest = (entry_id, frame)
+                min_diff = diff
+    return closest
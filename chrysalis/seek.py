@@ -0,0 +1,134 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .h264 import is_keyframe, is_disposable, is_bidirectional, reorders
+
+MAX_SEQUENCE = 18446744073709551615
+
+# most B frames read past the end of a range
+MAX_TAIL = 16
+
+def entry_timestamp(entry_id):
+    """
+    Millisecond part of a stream entry ID
+    """
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode('utf-8')
+    return int(entry_id.split("-")[0])
+
+def previous_id(entry_id):
+    """
+    Stream ID right before entry_id, XREAD from it returns entry_id first
+    """
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode('utf-8')
+    ms, seq = entry_id.split("-")
+    if int(seq) > 0:
+        return ms + "-" + str(int(seq) - 1)
+    return str(int(ms) - 1) + "-" + str(MAX_SEQUENCE)
+
+def next_id(entry_id):
+    """
+    Stream ID right after entry_id, XRANGE from it excludes entry_id
+    """
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode('utf-8')
+    ms, seq = entry_id.split("-")
+    if int(seq) < MAX_SEQUENCE:
+        return ms + "-" + str(int(seq) + 1)
+    return str(int(ms) + 1) + "-0"
+
+def keyframe_query(entries):
+    """
+    Finds the newest keyframe in a XREVRANGE reply (newest entry first)
+
+    Returns
+    -------
+    Stream ID to XREAD from so that the keyframe is the first entry read, None if there's no keyframe
+    """
+    for entry in entries:
+        if is_keyframe(entry[1].get(b"frame")):
+            return previous_id(entry[0])
+    return None
+
+def keyframe_before(redis_conn, stream_name, timestamp, within_seconds=10, count=60):
+    """
+    Walks the stream back from timestamp (in ms) looking for the closest keyframe at or before it
+
+    Returns
+    -------
+    Stream ID to XREAD from, None if no keyframe within_seconds before timestamp
+    """
+    max_id = str(timestamp)
+    min_id = str(timestamp - within_seconds * 1000)
+    while True:
+        entries = redis_conn.xrevrange(stream_name, max=max_id, min=min_id, count=count)
+        if len(entries) == 0:
+            return None
+        query = keyframe_query(entries)
+        if query is not None:
+            return query
+        max_id = previous_id(entries[-1][0])
+
+def warmup_entries(redis_conn, stream_name, entry_id):
+    """
+    Entries a decoder that skipped part of the stream needs to decode before entry_id:
+    from the closest keyframe before it (without disposable frames, unless the stream has B frames)
+
+    Returns
+    -------
+    XRANGE reply entries, empty if entry_id is a keyframe or there's no keyframe before it
+    """
+    query = keyframe_before(redis_conn, stream_name, entry_timestamp(entry_id))
+    if query is None:
+        return []
+    entries = redis_conn.xrange(stream_name, min=next_id(query), max=previous_id(entry_id))
+    return drop_disposable_before(entries, entry_timestamp(entry_id))
+
+def drop_disposable_before(entries, timestamp):
+    """
+    Frames before timestamp are only decoded to warm up the decoder, non-reference ones can be skipped.
+    Streams with B frames are left whole: frames are paired with entries in presentation order,
+    dropping a frame shifts the entries of the frames after it.
+    """
+    if reorders([entry[1].get(b"frame") for entry in entries]):
+        return entries
+    return [entry for entry in entries if entry_timestamp(entry[0]) >= timestamp or not is_disposable(entry[1].get(b"frame"))]
+
+def reorder_tail(redis_conn, stream_name, entries, reordered=False):
+    """
+    B frames right after the last of entries. A range ending on a reference frame needs them before the
+    decoder is flushed: they are shown before it, without them it's paired with the entry of one of them.
+
+    Attributes
+    ----------
+    reordered : bool
+        stream is known to have B frames (e.g. the decoder's has_b_frames), otherwise entries are checked for them
+
+    Returns
+    -------
+    XRANGE reply entries, empty if the stream has no B frames
+    """
+    if len(entries) == 0 or not (reordered or reorders([entry[1].get(b"frame") for entry in entries])):
+        return []
+    return leading_bidirectional(redis_conn.xrange(stream_name, min=next_id(entries[-1][0]), max="+", count=MAX_TAIL))
+
+def leading_bidirectional(entries):
+    """
+    Entries up to the first one that isn't a B frame
+    """
+    for idx, entry in enumerate(entries):
+        if not is_bidirectional(entry[1].get(b"frame")):
+            return entries[:idx]
+    return entries
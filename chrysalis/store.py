@@ -0,0 +1,443 @@
+# Copyright 2020 Wearless Tech Inc All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+import redis
+from .seek import MAX_SEQUENCE, next_id
+
+# spool file header and record header (ms, sequence, length of the encoded fields)
+SPOOL_MAGIC = b"CHRSPL01"
+RECORD_HEADER = struct.Struct("<QQI")
+FIELD_HEADER = struct.Struct("<II")
+# how often blocking reads check a spool for records appended by another process (in seconds)
+SPOOL_POLL_INTERVAL = 0.01
+
+def parse_id(entry_id, seq=0):
+    """
+    (milliseconds, sequence) of a stream ID as passed to redis commands: - and + for the first and last
+    possible IDs, ms-seq, or only ms (int, str or bytes) in which case the sequence is seq
+
+    Returns
+    -------
+    tuple, comparable with other parsed IDs
+    """
+    if isinstance(entry_id, int):
+        return (max(entry_id, 0), seq)
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode('utf-8')
+    if entry_id == "-":
+        return (0, 0)
+    if entry_id == "+":
+        return (MAX_SEQUENCE, MAX_SEQUENCE)
+    if entry_id.startswith("-"):
+        # before the first possible ID
+        return (0, 0)
+    ms, _, entry_seq = entry_id.partition("-")
+    return (int(ms), int(entry_seq) if entry_seq else seq)
+
+def format_id(entry_id):
+    return (str(entry_id[0]) + "-" + str(entry_id[1])).encode('utf-8')
+
+class StreamStore:
+    """
+    Local store of recorded stream entries, a drop-in for the redis connection the SDK reads from
+    (see Connect store argument). Implements the subset of redis commands the SDK uses (TIME, XADD, XRANGE,
+    XREVRANGE, XREAD, XINFO STREAM and pipelines of them) with redis-py's reply formats: stream IDs as bytes
+    and fields as a dictionary of bytes.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+
+    def time(self):
+        now = time.time()
+        return (int(now), int((now % 1) * 1000000))
+
+    def xadd(self, name, fields, id="*", maxlen=None, approximate=True):
+        """
+        Appends an entry, id * picks the next ID from the local clock
+
+        Returns
+        -------
+        Stream ID of the entry
+        """
+        fields = {self.__bytes(key): self.__bytes(value) for key, value in fields.items()}
+        with self._condition:
+            ids = self._ids(name)
+            last = ids[-1] if len(ids) > 0 else (0, 0)
+            if id == "*":
+                now_ms = int(time.time() * 1000)
+                entry_id = (now_ms, 0) if now_ms > last[0] else (last[0], last[1] + 1)
+            else:
+                entry_id = parse_id(id)
+                if entry_id <= last:
+                    raise redis.ResponseError("The ID specified in XADD is equal or smaller than the target stream top item")
+            self._append(name, entry_id, fields)
+            if maxlen is not None:
+                self._trim(name, maxlen)
+            self._condition.notify_all()
+        return format_id(entry_id)
+
+    def xrange(self, name, min="-", max="+", count=None):
+        with self._condition:
+            ids = self._ids(name)
+            lo = bisect.bisect_left(ids, parse_id(min))
+            hi = bisect.bisect_right(ids, parse_id(max, MAX_SEQUENCE))
+            if count is not None and hi > lo + count:
+                hi = lo + count
+            return [self.__entry(name, ids, idx) for idx in range(lo, hi)]
+
+    def xrevrange(self, name, max="+", min="-", count=None):
+        with self._condition:
+            ids = self._ids(name)
+            lo = bisect.bisect_left(ids, parse_id(min))
+            hi = bisect.bisect_right(ids, parse_id(max, MAX_SEQUENCE))
+            if count is not None and lo < hi - count:
+                lo = hi - count
+            return [self.__entry(name, ids, idx) for idx in reversed(range(lo, hi))]
+
+    def xread(self, streams, count=None, block=None):
+        """
+        Entries after the given ID of every stream, block (in ms, 0 forever) waits until one of them has any
+        """
+        deadline = None if block is None or block == 0 else time.monotonic() + block / 1000
+        with self._condition:
+            # $ reads only entries added from now on
+            streams = {name: (self.__last_id(name) if last == "$" else parse_id(last)) for name, last in streams.items()}
+            while True:
+                reply = []
+                for name, last in streams.items():
+                    ids = self._ids(name)
+                    lo = bisect.bisect_right(ids, last)
+                    hi = len(ids) if count is None else min(len(ids), lo + count)
+                    if hi > lo:
+                        stream_name = name.encode('utf-8') if isinstance(name, str) else name
+                        reply.append([stream_name, [self.__entry(name, ids, idx) for idx in range(lo, hi)]])
+                if len(reply) > 0 or block is None:
+                    return reply
+                timeout = self._poll_interval()
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return reply
+                    timeout = remaining if timeout is None else min(timeout, remaining)
+                self._condition.wait(timeout)
+
+    def xinfo_stream(self, name):
+        with self._condition:
+            ids = self._ids(name)
+            if len(ids) == 0 and not self._exists(name):
+                raise redis.ResponseError("no such key")
+            return {
+                "length": len(ids),
+                "first-entry": self.__entry(name, ids, 0) if len(ids) > 0 else None,
+                "last-entry": self.__entry(name, ids, len(ids) - 1) if len(ids) > 0 else None,
+            }
+
+    def pipeline(self, transaction=True):
+        return StorePipeline(self)
+
+    def reopen(self):
+        """
+        (callable, arguments) opening the store in another process
+        """
+        raise NotImplementedError
+
+    def _ids(self, name):
+        """
+        Sorted list of (ms, sequence) entry IDs of a stream
+        """
+        raise NotImplementedError
+
+    def _fields(self, name, idx):
+        raise NotImplementedError
+
+    def _append(self, name, entry_id, fields):
+        raise NotImplementedError
+
+    def _trim(self, name, maxlen):
+        raise NotImplementedError
+
+    def _exists(self, name):
+        return len(self._ids(name)) > 0
+
+    def _poll_interval(self):
+        """
+        Seconds between checks for new entries while blocking, None if appends always notify
+        """
+        return None
+
+    def __entry(self, name, ids, idx):
+        return (format_id(ids[idx]), self._fields(name, idx))
+
+    def __last_id(self, name):
+        ids = self._ids(name)
+        return ids[-1] if len(ids) > 0 else (0, 0)
+
+    def __bytes(self, value):
+        if isinstance(value, bytes):
+            return value
+        if isinstance(value, (bytearray, memoryview)):
+            return bytes(value)
+        return str(value).encode('utf-8')
+
+class StorePipeline:
+    """
+    Queues store commands and runs them on execute, replies in the order of the commands
+    """
+
+    def __init__(self, store):
+        self.__store = store
+        self.__commands = []
+
+    def __getattr__(self, command):
+        def queue(*args, **kwargs):
+            self.__commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self, raise_on_error=True):
+        replies = []
+        commands, self.__commands = self.__commands, []
+        for command, args, kwargs in commands:
+            try:
+                replies.append(getattr(self.__store, command)(*args, **kwargs))
+            except Exception as e:
+                if raise_on_error:
+                    raise
+                replies.append(e)
+        return replies
+
+class MemoryStore(StreamStore):
+    """
+    Streams held in process memory, e.g. for benchmarks and tests. Processes started by the SDK
+    (history playback, parallel decoding) work on a copy made when they start.
+
+    Attributes
+    ----------
+    maxlen : int
+        entries kept per stream, oldest ones are dropped (default None, unbounded)
+    """
+
+    def __init__(self, maxlen=None):
+        super().__init__()
+        self.maxlen = maxlen
+        # stream name -> (list of IDs, list of fields)
+        self.__streams = {}
+
+    def reopen(self):
+        with self._condition:
+            streams = {name: (list(ids), list(fields)) for name, (ids, fields) in self.__streams.items()}
+        return _memory_store, (streams, self.maxlen)
+
+    def _ids(self, name):
+        return self.__stream(name)[0]
+
+    def _fields(self, name, idx):
+        return self.__stream(name)[1][idx]
+
+    def _append(self, name, entry_id, fields):
+        ids, entries = self.__streams.setdefault(self.__name(name), ([], []))
+        ids.append(entry_id)
+        entries.append(fields)
+        if self.maxlen is not None:
+            self._trim(name, self.maxlen)
+
+    def _trim(self, name, maxlen):
+        ids, entries = self.__stream(name)
+        if len(ids) > maxlen:
+            del ids[:len(ids) - maxlen]
+            del entries[:len(entries) - maxlen]
+
+    def _exists(self, name):
+        return self.__name(name) in self.__streams
+
+    def _restore(self, streams):
+        self.__streams = streams
+
+    def __stream(self, name):
+        return self.__streams.get(self.__name(name), ([], []))
+
+    def __name(self, name):
+        return name.decode('utf-8') if isinstance(name, bytes) else name
+
+def _memory_store(streams, maxlen):
+    store = MemoryStore(maxlen=maxlen)
+    store._restore(streams)
+    return store
+
+class FileStore(StreamStore):
+    """
+    Streams spooled into append only files of a directory (one file per stream, <stream name>.spool).
+    Spools are memory mapped for reading, records appended by another process (e.g. a local recorder)
+    are picked up as they're written.
+
+    Attributes
+    ----------
+    directory : string
+        spool directory, created if missing
+    """
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.__spools = {}
+
+    def reopen(self):
+        return FileStore, (self.directory,)
+
+    def close(self):
+        with self._condition:
+            for spool in self.__spools.values():
+                spool.close()
+            self.__spools = {}
+
+    def _ids(self, name):
+        spool = self.__spool(name)
+        spool.refresh()
+        return spool.ids
+
+    def _fields(self, name, idx):
+        return self.__spool(name).fields(idx)
+
+    def _append(self, name, entry_id, fields):
+        self.__spool(name).append(entry_id, fields)
+
+    def _trim(self, name, maxlen):
+        raise redis.ResponseError("spool files are append only, MAXLEN isn't supported")
+
+    def _exists(self, name):
+        return os.path.exists(self.__spool(name).path)
+
+    def _poll_interval(self):
+        return SPOOL_POLL_INTERVAL
+
+    def __spool(self, name):
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
+        if name not in self.__spools:
+            self.__spools[name] = Spool(os.path.join(self.directory, name + ".spool"))
+        return self.__spools[name]
+
+class Spool:
+    """
+    Append only file of stream entries: SPOOL_MAGIC, then per entry a RECORD_HEADER followed by its
+    fields, each one a FIELD_HEADER (key and value length), key and value
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.ids = []
+        # (offset, length) of every entry's encoded fields
+        self.__records = []
+        self.__indexed_to = len(SPOOL_MAGIC)
+        self.__map = None
+        self.__writer = None
+
+    def refresh(self):
+        """
+        Indexes records appended since the last refresh, a record still being written is left for later
+        """
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return
+        if size <= self.__indexed_to:
+            return
+        if self.__map is not None:
+            self.__map.close()
+        with open(self.path, "rb") as f:
+            self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.__map[:len(SPOOL_MAGIC)] != SPOOL_MAGIC:
+            raise ValueError(self.path + " is not a chrysalis spool file")
+        pos = self.__indexed_to
+        while pos + RECORD_HEADER.size <= size:
+            ms, seq, length = RECORD_HEADER.unpack_from(self.__map, pos)
+            if pos + RECORD_HEADER.size + length > size:
+                break
+            self.ids.append((ms, seq))
+            self.__records.append((pos + RECORD_HEADER.size, length))
+            pos += RECORD_HEADER.size + length
+        self.__indexed_to = pos
+
+    def fields(self, idx):
+        offset, length = self.__records[idx]
+        fields = {}
+        end = offset + length
+        while offset < end:
+            key_length, value_length = FIELD_HEADER.unpack_from(self.__map, offset)
+            offset += FIELD_HEADER.size
+            key = self.__map[offset:offset + key_length]
+            offset += key_length
+            fields[key] = self.__map[offset:offset + value_length]
+            offset += value_length
+        return fields
+
+    def append(self, entry_id, fields):
+        if self.__writer is None:
+            self.__writer = open(self.path, "ab")
+            if self.__writer.tell() == 0:
+                self.__writer.write(SPOOL_MAGIC)
+        encoded = b"".join(FIELD_HEADER.pack(len(key), len(value)) + key + value for key, value in fields.items())
+        # a record is written in one go, readers never index a partial one
+        self.__writer.write(RECORD_HEADER.pack(entry_id[0], entry_id[1], len(encoded)) + encoded)
+        self.__writer.flush()
+        self.refresh()
+
+    def close(self):
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+
+def copy_stream(source, target, stream_name, fromtimestamp="-", totimestamp="+", count=500):
+    """
+    Records entries of a stream (e.g. from redis) into a store, keeping their stream IDs
+
+    Returns
+    -------
+    Number of copied entries
+    """
+    copied = 0
+    min_id = fromtimestamp
+    while True:
+        entries = source.xrange(stream_name, min=min_id, max=totimestamp, count=count)
+        for entry_id, fields in entries:
+            target.xadd(stream_name, fields, id=entry_id)
+        copied += len(entries)
+        if len(entries) < count:
+            return copied
+        min_id = next_id(entries[-1][0])
+
+def reopen(redis_conn):
+    """
+    (callable, arguments) opening a connection to the same redis server or store in another process
+    """
+    if hasattr(redis_conn, "reopen"):
+        # stream stores and wrapped connections know how to open themselves
+        return redis_conn.reopen()
+    pool = redis_conn.connection_pool
+    return _redis_connection, (pool.connection_class, pool.connection_kwargs)
+
+def _redis_connection(connection_class, connection_kwargs):
+    pool = redis.ConnectionPool(connection_class=connection_class, **connection_kwargs)
+    return redis.StrictRedis(connection_pool=pool)
@@ -29,5 +29,5 @@ setup(
         'Topic :: Multimedia :: Video :: Conversion'
     ],
     install_requires=['redis', 'av', "numpy"],
-    python_requires='>=3.6',
+    python_requires='>=3.8',
 )
\ No newline at end of file
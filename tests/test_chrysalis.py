@@ -16,8 +16,16 @@ from unittest import TestCase
 import unittest
 import time
 from datetime import datetime, timedelta
+import asyncio
+import io
+from concurrent.futures import ThreadPoolExecutor
 import chrysalis
+import chrysalis.aio
 from chrysalis.ch_errors import VideoFailedToStart
+from chrysalis.history_reader import HistoryReader, id_tuple
+from chrysalis.seek import entry_timestamp
+from benchmarks.fixture import video_packets, load
+import redis
 
 ch = chrysalis.Connect(host="127.0.0.1", port="1111", password="aaaaaaaa", ssl_ca_cert="server.crt")
 
@@ -33,6 +41,15 @@ class TestInit(TestCase):
         print(p.end_timestamp)
         print(p.fps)
 
+    def test_probe_cached(self):
+        p = ch.Probe(max_age=0)
+        self.assertLessEqual(p.start_timestamp, p.end_timestamp)
+        self.assertGreater(p.frames, 0)
+        # reused within max_age
+        self.assertIs(ch.Probe(max_age=60), ch.Probe(max_age=60))
+        probes = ch.ProbeMulti(["input_rtmp_stream", "input_rtmp_stream_2"])
+        self.assertEqual(probes["input_rtmp_stream"].start_timestamp, ch.Probe().start_timestamp)
+
     def test_past_buffered_video(self):
         p = ch.Probe()
         end = p.start_timestamp + (1000 * 30)
@@ -44,11 +61,147 @@ class TestInit(TestCase):
             print(img)
             count += 1
 
+    def test_past_buffered_video_seek(self):
+        p = ch.Probe()
+        end = p.start_timestamp + (1000 * 30)
+        img = ch.VideoPastImage(p.start_timestamp, end)
+        print(img.timestamp)
+        ch.VideoPastImageSeek(p.start_timestamp + (1000 * 20))
+        img = ch.VideoPastImage(p.start_timestamp, end)
+        print(img.timestamp)
+        ch.VideoPastImageStopNow()
+        self.assertIsNone(ch.VideoPastImage(p.start_timestamp, end))
+
+    def test_past_video_iterator(self):
+        p = ch.Probe()
+        end = p.start_timestamp + (1000 * 5)
+        timestamps = [img.timestamp for img in ch.VideoPastImages(p.start_timestamp, end)]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertLessEqual(timestamps[-1], end)
+
+    def test_past_video_parallel(self):
+        p = ch.Probe()
+        end = p.start_timestamp + (1000 * 20)
+        serial = [img.entry_id for img in ch.VideoPastImages(p.start_timestamp, end)]
+        parallel = [img.entry_id for img in ch.VideoPastImagesParallel(p.start_timestamp, end, processes=2, segment_seconds=5)]
+        self.assertEqual(serial, parallel)
+
+    def test_past_video_b_frames(self):
+        store = chrysalis.MemoryStore()
+        start, end = load(store, video_packets(seconds=3, fps=25, width=160, height=96, gop=25, bframes=2))
+        local_ch = chrysalis.Connect(store=store, pix_fmt="planes")
+        full = {img.entry_id: img.planes[0].copy() for img in local_ch.VideoPastImages(start, end)}
+        # ranges starting and ending mid GOP get the same picture for every entry as a full playback
+        for offset in range(1000, 1400, 40):
+            images = list(local_ch.VideoPastImages(start + offset, start + offset + 400))
+            with local_ch.OpenHistory(start + offset, start + offset + 400) as session:
+                images += list(session)
+            for img in images:
+                self.assertTrue((img.planes[0] == full[img.entry_id]).all())
+
+    def test_history_reader(self):
+        store = chrysalis.MemoryStore()
+        for i in range(3000):
+            # uneven spacing, some entries share a millisecond
+            store.xadd("video", {"frame": b"\x00" * (i % 7)}, id=str(1000000 + (i // 3) * 40 + (i % 3 == 2) * 13) + "-" + str(i % 3 if i % 3 < 2 else 0))
+        ids = [id_tuple(entry[0]) for entry in store.xrange("video")]
+        reader = HistoryReader(store, "video", "1001000", 1030000, depth=3, min_count=5, max_count=200)
+        reader.start()
+        read = []
+        while True:
+            batch = reader.get(timeout=5)
+            if batch is None:
+                break
+            read.extend(id_tuple(entry[0]) for entry in batch)
+        reader.stop()
+        # every entry of the range exactly once and in order, windows end at until_timestamp
+        expected = [entry_id for entry_id in ids if (1001000, 0) < entry_id and entry_id[0] <= 1030000]
+        self.assertEqual(read, expected)
+        self.assertGreater(reader.count, 5)
+
+        class FailingStore(chrysalis.MemoryStore):
+            def xrevrange(self, name, max="+", min="-", count=None):
+                raise redis.ResponseError("LOADING")
+        reader = HistoryReader(FailingStore(), "video", "1001000", 1030000)
+        reader.start()
+        # a failed reader still ends the batches
+        self.assertIsNone(reader.get(timeout=5))
+        reader.stop()
+
+    def test_history_session(self):
+        p = ch.Probe()
+        start, end = p.end_timestamp - 10000, p.end_timestamp - 5000
+        serial = [img.entry_id for img in ch.VideoPastImages(start, end)]
+        with ch.OpenHistory(start, end) as session:
+            first = [session.next().entry_id for _ in range(20)]
+            checkpoint = session.checkpoint()
+        self.assertEqual(first, serial[:20])
+        self.assertEqual(checkpoint, serial[19])
+        resumed = [img.entry_id for img in ch.OpenHistory(start, end, resume_from=checkpoint)]
+        self.assertEqual(first + resumed, serial)
+        # concurrent sessions don't interfere
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            played = list(pool.map(lambda _: [img.entry_id for img in ch.OpenHistory(start, end)], range(2)))
+        self.assertEqual(played, [serial, serial])
+
+    def test_past_audio(self):
+        p = ch.Probe()
+        chunks = list(ch.AudioPastChunks(p.start_timestamp, p.start_timestamp + (1000 * 5)))
+        self.assertEqual([chunk.timestamp for chunk in chunks], [p.start_timestamp + i * 1000 for i in range(len(chunks))])
+        self.assertEqual(chunks[0].data.shape, (16000, 1))
+
+    def test_export_clip(self):
+        p = ch.Probe()
+        clip = io.BytesIO()
+        frames = ch.ExportClip(p.start_timestamp, p.start_timestamp + (1000 * 5), clip)
+        self.assertGreater(frames, 0)
+        self.assertGreater(len(clip.getvalue()), 0)
+
+    def test_export_clip_b_frames(self):
+        import av
+        store = chrysalis.MemoryStore()
+        packets = video_packets(seconds=4, fps=25, width=160, height=96, gop=25, bframes=2)
+        start, end = load(store, packets, end_timestamp=int(time.time() * 1000) - 1000)
+        local_ch = chrysalis.Connect(store=store)
+        codec = av.CodecContext.create("h264", "r")
+        expected = []
+        for payload in packets + [None]:
+            for frame in codec.decode(av.Packet(payload) if payload is not None else None):
+                expected.append(bytes(frame.planes[0]))
+        for container in ("mp4", "matroska"):
+            clip = io.BytesIO()
+            self.assertEqual(local_ch.ExportClip(start, end, clip, container=container), len(packets))
+            clip.seek(0)
+            with av.open(clip) as exported:
+                frames = list(exported.decode(video=0))
+            # frames are presented in the order they're decoded in
+            pts = [frame.pts for frame in frames]
+            self.assertEqual(pts, sorted(pts))
+            self.assertEqual(len(set(pts)), len(pts))
+            self.assertEqual([bytes(frame.planes[0]) for frame in frames], expected)
+
     def test_screenshot(self):
         d = datetime.today() - timedelta(hours=0, minutes=0, seconds=20)
         img = ch.Screenshot(dt=d)
         print(img.width, img.height)
 
+    def test_screenshots(self):
+        now = datetime.today()
+        dts = [now - timedelta(seconds=s) for s in range(5, 60, 5)]
+        imgs = ch.Screenshots(dts)
+        self.assertEqual(len(imgs), len(dts))
+        for img in imgs:
+            print(img)
+
+    def test_screenshots_keyframe_index(self):
+        store = chrysalis.MemoryStore()
+        start, end = load(store, video_packets(seconds=8, fps=25, width=160, height=96, gop=50), end_timestamp=int(time.time() * 1000) - 2000)
+        local_ch = chrysalis.Connect(store=store)
+        # a keyframe every 2 seconds, the closest one is returned
+        imgs = local_ch.Screenshots([datetime.fromtimestamp((start + ms) / 1000) for ms in (100, 3100, 5900)])
+        self.assertEqual([img.timestamp - start for img in imgs], [0, 4000, 6000])
+        self.assertEqual([img.frame_type for img in imgs], ["I", "I", "I"])
+
     def test_screenshot_latest(self):
         img = ch.Screenshot()
         print(img)
@@ -58,5 +211,161 @@ class TestInit(TestCase):
             _ = ch.VideoLatestImage()
             time.sleep(0.05)
 
+    def test_live_video_skips_to_keyframe(self):
+        for bframes in (0, 2):
+            store = chrysalis.MemoryStore()
+            # GOP of 25 frames, three GOPs are in the stream before the first call
+            packets = video_packets(seconds=4, fps=25, width=320, height=240, gop=25, bframes=bframes)
+            end = int(time.time() * 1000)
+            load(store, packets[:75], end_timestamp=end - 1000)
+            metrics = chrysalis.Metrics()
+            local_ch = chrysalis.Connect(store=store, metrics=metrics)
+            batch = store.xrange("input_rtmp_stream")
+            img = local_ch.VideoLatestImage()
+            if bframes == 0:
+                self.assertEqual(img.entry_id, batch[-1][0].decode('utf-8'))
+            else:
+                # the decoder holds back the newest frames until the B frames shown before them arrive
+                self.assertIn(img.entry_id, [entry[0].decode('utf-8') for entry in batch[50:]])
+            self.assertEqual(img.dropped_frames, len(batch) - 1)
+            # decoding starts at the latest keyframe
+            self.assertEqual(metrics.value("decode_seconds", stream="input_rtmp_stream")[0], 25)
+            history = list(local_ch.VideoPastImages(img.timestamp, img.timestamp))
+            self.assertEqual(img.entry_id, history[-1].entry_id)
+            self.assertTrue((img.data == history[-1].data).all())
+
+            # the decoder keeps its state, only new packets are decoded
+            load(store, packets[75:85], end_timestamp=end)
+            decoded = metrics.value("decode_seconds", stream="input_rtmp_stream")[0]
+            img = local_ch.VideoLatestImage()
+            if bframes == 0:
+                self.assertEqual(img.entry_id, store.xrange("input_rtmp_stream")[-1][0].decode('utf-8'))
+            self.assertEqual(img.dropped_frames, 9)
+            self.assertEqual(metrics.value("decode_seconds", stream="input_rtmp_stream")[0] - decoded, 10)
+            history = list(local_ch.VideoPastImages(img.timestamp, img.timestamp))
+            self.assertEqual(img.entry_id, history[-1].entry_id)
+            self.assertTrue((img.data == history[-1].data).all())
+
+    def test_live_video_prefetch(self):
+        prefetch_ch = chrysalis.Connect(host="127.0.0.1", port="1111", password="aaaaaaaa", ssl_ca_cert="server.crt", buffer_size=10, prefetch=True)
+        count = 0
+        for img in prefetch_ch.VideoLatestImages(timeout=5):
+            print(img.timestamp, img.dropped_frames)
+            count += 1
+            if count > 50:
+                break
+        prefetch_ch.Close()
+
+    def test_frame_cache(self):
+        cache = chrysalis.FrameCache(max_bytes=64 * 1024 * 1024)
+        cached_ch = chrysalis.Connect(host="127.0.0.1", port="1111", password="aaaaaaaa", ssl_ca_cert="server.crt", frame_cache=cache)
+        d = datetime.today() - timedelta(seconds=20)
+        first = cached_ch.Screenshot(dt=d)
+        second = cached_ch.Screenshot(dt=d)
+        self.assertEqual(first.entry_id, second.entry_id)
+        self.assertGreaterEqual(cache.stats()["hits"], 1)
+
+    def test_pixel_format(self):
+        gray_ch = chrysalis.Connect(host="127.0.0.1", port="1111", password="aaaaaaaa", ssl_ca_cert="server.crt", pix_fmt="gray", size=(320, 180))
+        img = gray_ch.Screenshot(dt=datetime.today() - timedelta(seconds=20))
+        self.assertEqual(img.data.shape, (180, 320))
+        self.assertEqual((img.width, img.height), (320, 180))
+
+    def test_planes(self):
+        planes_ch = chrysalis.Connect(host="127.0.0.1", port="1111", password="aaaaaaaa", ssl_ca_cert="server.crt", pix_fmt="planes")
+        img = planes_ch.Screenshot(dt=datetime.today() - timedelta(seconds=20))
+        self.assertEqual(img.planes[0].shape, (img.height, img.width))
+        self.assertIs(img.data, img.planes[0])
+        self.assertFalse(img.data.flags.writeable)
+        self.assertEqual(img.to_bgr().shape, (img.height, img.width, 3))
+
+    def test_lazy_image(self):
+        p = ch.Probe()
+        images = list(ch.VideoPastImages(p.end_timestamp - 3000, p.end_timestamp))
+        self.assertFalse(any(img.converted for img in images))
+        iframes = [img for img in images if img.frame_type == "I"]
+        self.assertEqual(iframes[0].data.shape, (iframes[0].height, iframes[0].width, 3))
+        self.assertTrue(iframes[0].converted)
+        self.assertEqual(images[-1].materialize().shape, (images[-1].height, images[-1].width, 3))
+        self.assertTrue(images[-1].converted)
+        with self.assertRaises(AttributeError):
+            iframes[0].label = "keyframe"
+
+    def test_sampling(self):
+        keyframes_ch = chrysalis.Connect(host="127.0.0.1", port="1111", password="aaaaaaaa", ssl_ca_cert="server.crt", sampling=chrysalis.Sampling(keyframes=True))
+        p = keyframes_ch.Probe()
+        for img in keyframes_ch.VideoPastImages(p.end_timestamp - 10000, p.end_timestamp - 5000):
+            self.assertEqual(img.frame_type, "I")
+        fps_ch = chrysalis.Connect(host="127.0.0.1", port="1111", password="aaaaaaaa", ssl_ca_cert="server.crt", sampling=chrysalis.Sampling(fps=1))
+        timestamps = [img.timestamp for img in fps_ch.VideoPastImages(p.end_timestamp - 10000, p.end_timestamp - 5000)]
+        for previous, ts in zip(timestamps, timestamps[1:]):
+            self.assertGreaterEqual(ts - previous, 1000)
+
+    def test_sampling_b_frames(self):
+        store = chrysalis.MemoryStore()
+        start, end = load(store, video_packets(seconds=4, fps=25, width=160, height=96, gop=25, bframes=2))
+        full = {img.entry_id: img.planes[0].copy() for img in chrysalis.Connect(store=store, pix_fmt="planes").VideoPastImages(start, end)}
+        for sampling in (chrysalis.Sampling(every=5), chrysalis.Sampling(fps=2)):
+            sampled_ch = chrysalis.Connect(store=store, pix_fmt="planes", sampling=sampling)
+            images = list(sampled_ch.VideoPastImages(start + 1360, end - 800))
+            self.assertGreater(len(images), 0)
+            # a sampled frame is the picture full playback pairs with its entry
+            for img in images:
+                self.assertTrue((img.planes[0] == full[img.entry_id]).all())
+
+    def test_decoder_threads(self):
+        threaded_ch = chrysalis.Connect(host="127.0.0.1", port="1111", password="aaaaaaaa", ssl_ca_cert="server.crt", thread_type="FRAME", thread_count=4)
+        for _ in range(3):
+            # screenshot decoders are reused
+            img = threaded_ch.Screenshot(dt=datetime.today() - timedelta(seconds=20))
+            self.assertEqual(img.frame_type, "I")
+        # frames held back by frame threading keep their own entries, and the end of the range is drained
+        p = threaded_ch.Probe()
+        single_ch = chrysalis.Connect(host="127.0.0.1", port="1111", password="aaaaaaaa", ssl_ca_cert="server.crt", thread_type="NONE")
+        threaded = [(img.entry_id, img.data.sum()) for img in threaded_ch.VideoPastImages(p.end_timestamp - 5000, p.end_timestamp - 1000)]
+        single = [(img.entry_id, img.data.sum()) for img in single_ch.VideoPastImages(p.end_timestamp - 5000, p.end_timestamp - 1000)]
+        self.assertEqual(threaded, single)
+        with self.assertRaises(ValueError):
+            chrysalis.Connect(host="127.0.0.1", port="1111", password="aaaaaaaa", ssl_ca_cert="server.crt", thread_type="PARALLEL")
+
+    def test_metrics(self):
+        metrics = chrysalis.Metrics()
+        measured_ch = chrysalis.Connect(host="127.0.0.1", port="1111", password="aaaaaaaa", ssl_ca_cert="server.crt", metrics=metrics)
+        p = measured_ch.Probe()
+        images = list(measured_ch.VideoPastImages(p.end_timestamp - 3000, p.end_timestamp))
+        count, seconds = metrics.value("convert_seconds", stream="input_rtmp_stream")
+        self.assertEqual(count, len(images))
+        self.assertGreater(metrics.value("redis_bytes", stream="input_rtmp_stream"), 0)
+        self.assertIn("chrysalis_decode_seconds_count", metrics.render())
+
+    def test_memory_store(self):
+        p = ch.Probe()
+        store = chrysalis.MemoryStore()
+        copied = chrysalis.copy_stream(ch.redis_conn, store, "input_rtmp_stream", p.end_timestamp - 10000, p.end_timestamp)
+        self.assertGreater(copied, 0)
+        local_ch = chrysalis.Connect(store=store)
+        self.assertEqual(local_ch.Probe().frames, copied)
+        remote = [img.timestamp for img in ch.VideoPastImages(p.end_timestamp - 5000, p.end_timestamp - 1000)]
+        local = [img.timestamp for img in local_ch.VideoPastImages(p.end_timestamp - 5000, p.end_timestamp - 1000)]
+        self.assertEqual(local, remote)
+
+    def test_live_video_multi(self):
+        for _ in range(50):
+            images = ch.VideoLatestImageMulti(["input_rtmp_stream", "input_rtmp_stream_2"])
+            print(images)
+            time.sleep(0.05)
+
+    def test_aio_live_video(self):
+        async def consume():
+            async with chrysalis.aio.Connect(host="127.0.0.1", port="1111", password="aaaaaaaa", ssl_ca_cert="server.crt") as aio_ch:
+                p = await aio_ch.Probe()
+                print(p.duration)
+                for _ in range(50):
+                    img = await aio_ch.VideoLatestImage()
+                    print(img)
+                img = await aio_ch.Screenshot()
+                print(img)
+        asyncio.run(consume())
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file